@@ -21,9 +21,12 @@ import random
 import time
 import hashlib
 from email.message import EmailMessage
-from src.data_store import U_NAME_FIRST_IDX, U_NAME_LAST_IDX, data_store
-from src.data_store import U_EMAIL_IDX, U_PASSWORD_IDX, U_ID_IDX, U_HANDLE_IDX, U_PW_RESET_CODE_IDX
+from src.data_store import U_NAME_FIRST_IDX, U_NAME_LAST_IDX, data_store, transactional
+from src.data_store import add_session, add_user, remove_session, remove_user_sessions, \
+    user_by_email
+from src.data_store import U_PASSWORD_IDX, U_ID_IDX, U_PW_RESET_CODE_IDX
 from src.error import InputError, AccessError
+from src.verify_session import forget_tokens
 from datetime import datetime
 from src.config import url as URL
 
@@ -47,13 +50,8 @@ def auth_login_v2(email, password):
     '''
     store = data_store.get()
     # Validate email
-    email_found = False
-    for user in store['users']:
-        if user[U_EMAIL_IDX] == email:
-            email_found = True
-            found_user = user
-
-    if email_found is False:
+    found_user = user_by_email(store, email)
+    if found_user is None:
         raise InputError(description="User not found")
 
     hash_object = hashlib.sha1(password.encode())
@@ -66,7 +64,7 @@ def auth_login_v2(email, password):
     user_token = create_token(found_user[U_ID_IDX])
 
     # Store the token into the list of current session's
-    store['sessions'].append(user_token)
+    add_session(store, user_token, found_user[U_ID_IDX])
     data_store.set(store)
 
     return ({'auth_user_id': found_user[U_ID_IDX],  'token': user_token})
@@ -78,7 +76,7 @@ def create_handle(name_first, name_last):
         create a unique handle for each user.
 
         It combines the user's first and last name into a concatenated all-lowercase string which 
-        is then searched for in data_store to ensure there are no duplicates.
+        is then looked up in the handle_suffixes counts of data_store to ensure there are no duplicates.
 
         If a duplicate is found, an integer corresponding to the number of prior duplicates
         is added to that handle
@@ -109,23 +107,14 @@ def create_handle(name_first, name_last):
     handle_str_alphabetic = re.compile("[^a-zA-Z]")
     handle_str = re.sub(handle_str_alphabetic, "", handle_str)
 
-    num_duplicates = 0
     handle_str = handle_str[0:20]
 
-    for user in store['users']:
-        handle = user[U_HANDLE_IDX]
-
-        handle = handle[0:20]
-
-        # Removes any numbers from the handle
-        handle = re.sub(r'[0-9]+', '', handle)
-        if handle == handle_str:
-            num_duplicates += 1
-        # Matched but user has been removed so register will reuse that handle
-        if handle == handle_str and handle in store['removed_handles']:
-            store['removed_handles'].remove(handle)
-            handle_str = handle
-            return handle_str
+    # How many handles are handle_str once their numbers are removed
+    num_duplicates = store['handle_suffixes'].get(handle_str, 0)
+    # Matched but user has been removed so register will reuse that handle
+    if num_duplicates > 0 and handle_str in store['removed_handles']:
+        store['removed_handles'].remove(handle_str)
+        return handle_str
 
     if num_duplicates > 0:
         handle_str += str(num_duplicates - 1)
@@ -153,6 +142,7 @@ def create_token(auth_user_id):
     return user_token
 
 
+@transactional
 def auth_register_v2(email, password, name_first, name_last):
     '''
     Description: auth_register_v2 registers a new user in data_store.
@@ -208,11 +198,10 @@ def auth_register_v2(email, password, name_first, name_last):
         raise InputError(
             description="Last name must be between 1 and 50 characters")
 
-    for user in store['users']:
-        if user[U_EMAIL_IDX] == email and (email not in store['removed_emails']):
+    if user_by_email(store, email) is not None:
+        if email not in store['removed_emails']:
             raise InputError(description="Email already in use")
-        elif user[U_EMAIL_IDX] == email and (email in store['removed_emails']):
-            store['removed_emails'].remove(email)
+        store['removed_emails'].remove(email)
 
     #Password is hashed
     # password_encrypted = pbkdf2_sha256.encrypt(password)
@@ -225,11 +214,10 @@ def auth_register_v2(email, password, name_first, name_last):
 
     handle_str = create_handle(name_first, name_last)
 
-    new_id = store['register_counter'] + 1
-    store['register_counter'] = new_id
+    new_id = data_store.next_id('register_counter')
     # Global permission
     time_now = int(datetime.timestamp(datetime.now()))
-    if store['register_counter'] == 1:
+    if not store['users']:
         store['global_owner'].append(new_id)
         # If its the first user, start tracking workplace stats
         workplace_ch = {'num_channels_exist': 0, 'time_stamp': time_now}
@@ -246,8 +234,8 @@ def auth_register_v2(email, password, name_first, name_last):
     user_notifications = []
 
     default_img = f"{URL}/imgurl/0.jpg"
-    store['users'].append(
-        [new_id, email, password_encrypted, name_first, name_last, handle_str, default_img, reset_code, user_notifications])
+    add_user(store,
+             [new_id, email, password_encrypted, name_first, name_last, handle_str, default_img, reset_code, user_notifications])
 
     # keep track of the users channels, dms and messages
 
@@ -285,16 +273,13 @@ def auth_logout_v1(token):
     '''
     store = data_store.get()
 
-    # Search the sessions list for the specified token. If found, remove that entry from the list
-    found_session = False
-    for idx, session in enumerate(store['sessions']):
-        if session == token:
-            found_session = True
-            del store['sessions'][idx]
+    # Look the token up in the session registry. If found, remove that entry from it
+    found_session = remove_session(store, token)
 
     if not found_session:
         raise AccessError(description="Unknown Session")
     else:
+        forget_tokens([token])
         data_store.set(store)
     return {}
 
@@ -318,13 +303,8 @@ def password_reset_request_v1(email):
     '''
     store = data_store.get()
     # search for email in data store
-    email_found = False
-    for user in store['users']:
-        if user[U_EMAIL_IDX] == email:
-            email_found = True
-            found_user = user
-
-    if email_found:
+    found_user = user_by_email(store, email)
+    if found_user is not None:
         # generate secret code
         secret_code = random.randint(100000, 999999)
         # store this code in data store so that it can be verified
@@ -390,14 +370,8 @@ def password_reset_reset_v1(new_password, secret_code):
 
     u_id = user[U_ID_IDX]
 
-    logout_list = []
-    for session in store['sessions']:
-        data = jwt.decode(session, key="BADGER", algorithms=['HS256'])
-        if u_id == data['auth_user_id']:
-            logout_list.append(session)
-
+    # log the user out of every session they have
+    forget_tokens(remove_user_sessions(store, u_id))
     data_store.set(store)
-    for session in logout_list:
-        auth_logout_v1(session)
 
     return {}, 200
@@ -20,11 +20,13 @@ from datetime import datetime
 from src import auth
 from src.data_store import CH_MEMBER_IDX, CH_ID_IDX, CH_NAME_IDX, CH_OWN_IDX, \
     CH_SET_IDX, U_EMAIL_IDX, U_HANDLE_IDX, U_ID_IDX, \
-    U_NAME_FIRST_IDX, U_NAME_LAST_IDX, U_PFP_IDX, data_store
+    U_NAME_FIRST_IDX, U_NAME_LAST_IDX, U_PFP_IDX, add_membership, data_store, \
+    is_channel_member, remove_membership, user_by_id
 from src.error import InputError
 from src.error import AccessError
 from src.notifications import generate_notifcation
 from src.other import check_channel_id, check_auth_user
+from src.render import render_messages
 from src.verify_session import verify_session
 from src.stats import update_ch_stats
 
@@ -55,25 +57,20 @@ def channel_invite_v1(auth_user_id, channel_id, u_id):
     channel = check_channel_id(channel_id)
 
     # U_id valid user
-    uid_exists = False
-    for user in store['users']:
-        if user[U_ID_IDX] == u_id:
-            uid_exists = True
-            break
-
-    if uid_exists is False:
+    if user_by_id(store, u_id) is None:
         raise InputError(description="Incorrect user_id")
 
     # Checking if user is apart of chanel (all owners are members)
-    if u_id in channel[CH_MEMBER_IDX]:
+    if is_channel_member(store, u_id, channel[CH_ID_IDX]):
         raise InputError(description="Already apart of this team")
 
     # Trying to acces private channel
-    if channel[CH_SET_IDX] is False and auth_user_id not in channel[CH_MEMBER_IDX]:
+    if channel[CH_SET_IDX] is False and not is_channel_member(store, auth_user_id, channel[CH_ID_IDX]):
         raise AccessError(description="This is a private channel")
 
     # Add to channel
     channel[CH_MEMBER_IDX].append(u_id)
+    add_membership(store, 'user_channels', u_id, channel[CH_ID_IDX])
 
     # notifications
     data_store.set(store)
@@ -123,23 +120,18 @@ def channel_details_v1(auth_user_id, channel_id):
     channel = check_channel_id(channel_id)
 
     # Checking member of channel or is global
-    if auth_user_id not in channel[CH_MEMBER_IDX]:
+    if not is_channel_member(store, auth_user_id, channel[CH_ID_IDX]):
         raise AccessError(description="Not a member of the channel")
 
     member_list = channel[CH_MEMBER_IDX][:]
     owner_list = channel[CH_OWN_IDX][:]
-    users = store['users']
 
     # Replacing number lists with actual details
     for idx, owner_id in enumerate(owner_list):
-        for entry in users:
-            if entry[U_ID_IDX] == owner_id:
-                owner_list[idx] = entry
+        owner_list[idx] = user_by_id(store, owner_id)
 
     for idx, member_id in enumerate(member_list):
-        for entry in users:
-            if entry[U_ID_IDX] == member_id:
-                member_list[idx] = entry
+        member_list[idx] = user_by_id(store, member_id)
 
     # Making the lists into dictionaries for the output as per given example
     user_dict = {}
@@ -184,15 +176,15 @@ def channel_messages_v1(auth_user_id, channel_id, start):
     Return Value:
         Returns messages(list of dictionaries), start(int), end(int)
     '''
-    store = data_store.get()
-
     # Helper function to check if ID is valid
     channel = check_channel_id(channel_id)
 
-    if auth_user_id not in channel[CH_MEMBER_IDX]:
+    if not is_channel_member(data_store.get(), auth_user_id, channel[CH_ID_IDX]):
         raise AccessError(description="You are not a member of this channel")
 
-    total_messages = len(store['messages'][channel_id])
+    # only the page is read if the messages are not in memory
+    total_messages, recent_messages = data_store.recent_messages(
+        'messages', channel_id, start, 50)
 
     if total_messages == 0 and start > total_messages:
         raise InputError(
@@ -202,27 +194,16 @@ def channel_messages_v1(auth_user_id, channel_id, start):
         raise InputError(
             description="You have set a start larger than the total number of messages")
 
-    page_of_messages = []
     time_now = int(datetime.timestamp(datetime.now()))
-    for idx, message in enumerate(reversed(store['messages'][channel_id])):
-        if start <= idx < start + 50:
-            if message['time_sent'] <= time_now:
-                page_of_messages.append(message)
+    page_of_messages = render_messages(
+        [message for message in recent_messages
+         if message['time_sent'] <= time_now], auth_user_id)
 
     if total_messages - start < 50:
         end = -1
     else:
         end = start + 50
 
-    for msg_idx, message in enumerate(page_of_messages):
-        for r_idx, react in enumerate(message['reacts']):
-            for u_id in react['u_ids']:
-                if u_id == auth_user_id:
-                    page_of_messages[msg_idx]['reacts'][r_idx]['is_this_user_reacted'] = True
-                else:
-                    page_of_messages[msg_idx]['reacts'][r_idx]['is_this_user_reacted'] = False
-
-    data_store.set(store)
     return {
         'messages': page_of_messages,
         'start': start,
@@ -251,11 +232,13 @@ def channel_leave_v1(auth_user_id, channel_id):
     # Helper function to check if ID is valid
     channel = check_channel_id(channel_id)
 
-    if auth_user_id not in channel[CH_MEMBER_IDX]:
+    if not is_channel_member(store, auth_user_id, channel[CH_ID_IDX]):
         raise AccessError(description="You are not a member of this channel")
 
     else:
         channel[CH_MEMBER_IDX].remove(auth_user_id)
+        remove_membership(store, 'user_channels', auth_user_id,
+                          channel[CH_ID_IDX])
 
     if auth_user_id in channel[CH_OWN_IDX]:
         channel[CH_OWN_IDX].remove(auth_user_id)
@@ -291,7 +274,7 @@ def channel_join_v1(auth_user_id, channel_id):
 
     # Already a member of the channels
     is_in_ch = False
-    if auth_user_id in channel[CH_OWN_IDX] or auth_user_id in channel[CH_MEMBER_IDX]:
+    if is_channel_member(store, auth_user_id, channel[CH_ID_IDX]):
         is_in_ch = True
         raise InputError(description="Already apart of this team")
 
@@ -301,6 +284,7 @@ def channel_join_v1(auth_user_id, channel_id):
 
     # Add to channel
     channel[CH_MEMBER_IDX].append(auth_user_id)
+    add_membership(store, 'user_channels', auth_user_id, channel[CH_ID_IDX])
     data_store.set(store)
     update_ch_stats(auth_user_id, True)
     return {}
@@ -331,7 +315,7 @@ def channel_addowner_v1(token, channel_id, u_id):
     caller_id = verify_session(token)
     store = data_store.get()
 
-    check_channel_id(channel_id)
+    corr_channel = check_channel_id(channel_id)
 
     check_auth_user(u_id)
 
@@ -339,22 +323,17 @@ def channel_addowner_v1(token, channel_id, u_id):
     global_owner_trig = False
     owner_valid = False
     global_member = False
-    corr_channel = None
     if caller_id in store['global_owner']:
         global_owner_trig = True
 
-    for channel in store['channels']:
-        if channel[CH_ID_IDX] == channel_id:
-            corr_channel = channel
-
     if caller_id in corr_channel[CH_OWN_IDX]:
         owner_valid = True
-    elif caller_id in corr_channel[CH_MEMBER_IDX] and global_owner_trig == True:
+    elif is_channel_member(store, caller_id, corr_channel[CH_ID_IDX]) and global_owner_trig == True:
         global_member = True
     else:
         raise AccessError(description='This user is not authorised to call')
 
-    if u_id not in corr_channel[CH_MEMBER_IDX]:
+    if not is_channel_member(store, u_id, corr_channel[CH_ID_IDX]):
         raise InputError(
             description='This u_id does not belong to a member of the channel')
 
@@ -394,7 +373,7 @@ def channel_removeowner_v1(token, channel_id, u_id):
     caller_id = verify_session(token)
     store = data_store.get()
 
-    check_channel_id(channel_id)
+    corr_channel = check_channel_id(channel_id)
 
     check_auth_user(u_id)
 
@@ -402,17 +381,12 @@ def channel_removeowner_v1(token, channel_id, u_id):
     global_owner_trig = False
     owner_valid = False
     global_member = False
-    corr_channel = None
     if caller_id in store['global_owner']:
         global_owner_trig = True
 
-    for channel in store['channels']:
-        if channel[CH_ID_IDX] == channel_id:
-            corr_channel = channel
-
     if caller_id in corr_channel[CH_OWN_IDX]:
         owner_valid = True
-    elif caller_id in corr_channel[CH_MEMBER_IDX] and global_owner_trig == True:
+    elif is_channel_member(store, caller_id, corr_channel[CH_ID_IDX]) and global_owner_trig == True:
         global_member = True
     else:
         raise AccessError(description='This user is not authorised to call')
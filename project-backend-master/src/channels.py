@@ -9,7 +9,8 @@ Functions:
     channels_listall_v1(auth_user_id)
     channels_create_v1(auth_user_id, name, is_public)
 '''
-from src.data_store import CH_ID_IDX, CH_MEMBER_IDX, CH_NAME_IDX, data_store
+from src.data_store import CH_ID_IDX, CH_MEMBER_IDX, CH_NAME_IDX, data_store, \
+    add_membership, channel_by_id, memberships
 from src.error import InputError
 from datetime import datetime
 from src.stats import update_ch_stats, update_workplace_ch_stats
@@ -36,14 +37,13 @@ def channels_list_v1(auth_user_id):
     CH_MEMBER_IDX
     CH_NAME_IDX
 
-    # Go through all the channels, and check if the user is in the members list
-    # If they are, add it to the all_channels list
+    # Go through the channels the user is a member of, and add them to the
+    # all_channels list
 
-    for channel in store['channels']:
-        for user_id in channel[CH_MEMBER_IDX]:
-            if user_id == auth_user_id:
-                all_channels.append(
-                    {'channel_id': channel[CH_ID_IDX], 'name': channel[CH_NAME_IDX]})
+    for channel_id in memberships(store, 'user_channels', auth_user_id):
+        channel = channel_by_id(store, channel_id)
+        all_channels.append(
+            {'channel_id': channel[CH_ID_IDX], 'name': channel[CH_NAME_IDX]})
 
     return {
 
@@ -116,6 +116,7 @@ def channels_create_v1(auth_user_id, name, is_public):
     member_list = [auth_user_id]
     store['channels'].append(
         [new_channel_id, name, is_public, owner_list, member_list])
+    add_membership(store, 'user_channels', auth_user_id, new_channel_id)
     store['messages'].append([])
     store['wordle_ch'].append({})
     # Keep track of the user's channels
@@ -7,3 +7,76 @@ Port configuration for data
 port = 8080
 
 url = f"http://localhost:{port}/"
+
+# Where the Datastore keeps its data
+#   'json'   - src/data_store.json and a file per top level key under
+#              src/data_store.segments/ (see segments.py), persisted
+#              according to store_mode
+#   'sqlite' - normalized tables in src/data_store.db (see sqlite_store.py),
+#              migrated from data_store.json the first time it is used
+#   'service' - a replica of the store kept by the daemon started with
+#               `python -m src.store_service` (see store_service.py), which
+#               keeps the store using service_backend and store_mode
+store_backend = 'json'
+
+# The daemon's socket, how it stores the data, and how many commits of ops
+# it keeps for workers catching up (those further behind get the whole store)
+store_socket = 'src/data_store.sock'
+service_backend = 'json'
+service_history = 1000
+
+# SQLite's synchronous setting: 'FULL' | 'NORMAL' | 'OFF'
+sqlite_synchronous = 'NORMAL'
+
+# Datastore persistence
+#   'sync'         - every data_store.set() rewrites the files it changed
+#   'write_behind' - the in-memory store is authoritative and a background
+#                    thread flushes it to disk every `flush_interval` seconds
+#   'journal'      - the in-memory store is authoritative and each set()
+#                    appends what changed to a write ahead log (see below)
+store_mode = 'sync'
+
+# Number of server processes sharing the port. More than one needs the
+# 'service' backend, or store_mode 'sync' with the 'json' backend, where each
+# transaction locks the files and first reads in whatever the other
+# processes have written.
+workers = 1
+
+# Seconds between background flushes when store_mode is 'write_behind'
+flush_interval = 1
+
+# When store_mode is 'journal' every set() appends the changes made since the
+# last set() to src/data_store.wal instead of rewriting src/data_store.json.
+#   wal_fsync: 'always' | 'interval' (every wal_fsync_interval ms) | 'never'
+# Once the log is wal_compact_size bytes it is folded into data_store.json.
+wal_fsync = 'interval'
+wal_fsync_interval = 100
+wal_compact_size = 4 * 1024 * 1024
+
+# Each channel's (and dm's) messages are kept in their own file under
+# src/data_store.segments/ and only read in when first used. Once those in
+# memory add up to more than segment_cache_size bytes of json, the least
+# recently used ones are dropped until they are needed again.
+segment_cache_size = 64 * 1024 * 1024
+
+# Each process reserves this many ids at a time from the store's counters
+# (message_counter, register_counter) and hands them out without writing to
+# the store. With more than one worker ids are unique but no longer in order
+# (1 keeps them in order, at the cost of writing the counter for every id).
+# None reserves 100 with one worker and 1 with more, so ids are always in
+# order.
+id_block_size = None
+
+# How many tokens verify_session keeps the decoded claims of, per process
+# (see verify_session.py)
+token_cache_size = 10000
+
+# A session ends once its token has not been used for session_idle_ttl
+# seconds, or session_ttl seconds after logging in, whichever is first. Each
+# process' sweeper thread writes down when its sessions were last used and
+# removes expired ones every session_sweep_interval seconds, at most
+# session_sweep_batch in each transaction.
+session_idle_ttl = 24 * 60 * 60
+session_ttl = 30 * 24 * 60 * 60
+session_sweep_interval = 60
+session_sweep_batch = 500
@@ -23,10 +23,41 @@ Example usage:
     print(store) # Prints { 'names': ['Emily', 'Hayden', 'Jake', 'Nick'] }
     data_store.set(store)
 '''
+import atexit
+import bisect
+import copy
+import fcntl
+import functools
+import itertools
 import json
+import re
+import jwt
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from src import config
 from src.error import AccessError
+from src.locks import LocationLocks, WorkspaceLock
+from src.message_log import message_place
+from src.tracking import (DERIVED_KEYS, SEGMENTED_KEYS, Segment, Unloaded,
+                          find_path, track, undo)
+from src.wal import WriteAheadLog, apply, read_records
+from src.segments import (LazyLocations, SegmentFiles, manifest, read_main,
+                          read_store)
+from src.snapshots import FrozenDict, FrozenList, FrozenLocations, freeze
+from src.sqlite_store import SqliteBackend
+from src.store_service import ServiceClient
 from os.path import exists
 import os
+
+DATA_PATH = 'src/data_store.json'
+STORE_MODES = ('sync', 'write_behind', 'journal')
+STORE_BACKENDS = ('json', 'sqlite', 'service')
+POSITION_CACHE_SIZE = 100000
+USER_INDEXES = ('user_index', 'email_index', 'handle_index', 'handle_suffixes')
+SESSION_INDEXES = ('session_index', 'user_sessions', 'session_times')
+
 # YOU SHOULD MODIFY THIS OBJECT BELOW
 U_ID_IDX = 0
 U_EMAIL_IDX = 1
@@ -48,6 +79,7 @@ SDUP_INIUSER_ID = 0
 SDUP_CH_ID = 1
 SDUP_T_END_ID = 2
 SDUP_MSGS_ID = 3
+SDUP_BUFFER_ID = 4
 
 M_ID_IDX = 0
 M_U_ID_IDX = 1
@@ -80,21 +112,28 @@ initial_object = {
     # ch_set_idx = 2
     # ch_own_idx = 3
     # ch_member_idx = 4
-    'standups': [],
-    # >standup: [[initiator_id, ch_id, time_finish, new_msg_id]]
+    'standups': {},
+    # the standup running in each channel, see start_standup()
+    # >standups: {str(ch_id): [initiator_id, ch_id, time_finish, new_msg_id, buffer]}
     # SDUP_INIUSER_ID = 0
     # SDUP_CH_ID = 1
     # SDUP_T_END_ID = 2
     # SDUP_MSGS_ID = 3
-    #   >new_msg_id
+    #   >new_msg_id: the message in 'messages_later' sent when it finishes
     #   !!! Deprecated !!! >SDUP_MSGS: [message_id1, message_id2, ...]
+    # SDUP_BUFFER_ID = 4
+    #   >buffer: ['handle: message\n', ...] joined into that message
+    'standup_archive': [],
+    # the standups which have finished, see finish_standup()
+    # >standup: [[initiator_id, ch_id, time_finish, new_msg_id]]
     'messages': [[]],
     # [none, ch1, ch2, ch3, ch4]
     #   >ch1 = [{'message_id': X, 'u_id': X, 'message': X, 'time_sent': X, 'is_pinned' : TRUE,
-    #               'reacts':[{'react_id' : X, 'u_ids' : [X, X], 'is_this_user_reacted': True}, {} ]},
+    #               'reacts':[{'react_id' : X, 'u_ids' : [X, X]}, {} ]},
     #           {'message_id': X, 'u_id': X, 'message': X, 'time_sent': X, 'is_pinned' : TRUE,
-    #               'reacts':[{'react_id' : X, 'u_ids' : [X, X], 'is_this_user_reacted': True}, {} ]}}]
+    #               'reacts':[{'react_id' : X, 'u_ids' : [X, X]}, {} ]}}]
     # Item 0 of 'messages' is empty beacuse channel_id's start with id 1
+    # A removed message is left as a tombstone, see 'message_tombstones'
 
     'dm_messages': [[]],
     # [none, dm1, dm2, dm3, dm4]
@@ -108,6 +147,7 @@ initial_object = {
     # dm_m_pinned_idx = 4
     'messages_later': [],
     # contains the messages which should be sent later (dms and channels in same list)
+    # in order of time_sent, see queue_message()
     # each element in the form: {'channel' : True/False, 'location_id': (int), 'message_data': message_data}
     # 'channel' --> Whether the message is going to a channel or dm
     # 'location_id' --> channel_id or dm_id
@@ -119,9 +159,9 @@ initial_object = {
     #   'is_pinned': False,
     # }
     #   >dm1 = [{'message_id': X, 'u_id': X, 'message': X, 'time_sent': X, 'is_pinned' : TRUE,
-    #               'reacts':[{'react_id' : X, 'u_ids' : [X, X], 'is_this_user_reacted': True}, {} ]},
+    #               'reacts':[{'react_id' : X, 'u_ids' : [X, X]}, {} ]},
     #           {'message_id': X, 'u_id': X, 'message': X, 'time_sent': X, 'is_pinned' : TRUE,
-    #               'reacts':[{'react_id' : X, 'u_ids' : [X, X], 'is_this_user_reacted': True}, {} ]}}]
+    #               'reacts':[{'react_id' : X, 'u_ids' : [X, X]}, {} ]}}]
     # Item 0 of 'dm_messages' is empty beacuse dm_id's start with id 1
 
     'dms': [],
@@ -167,45 +207,1002 @@ initial_object = {
     'valid_reacts': [1],
     'wordle_ch': [[]],
     'wordle_dm': [[]],
+
+    'user_index': {},
+    # each element in the form --> {str(u_id): position of the user in 'users'}
+    # users are never taken out of 'users', so a position never changes
+    'email_index': {},
+    # each element in the form --> {email: u_id of the last user given it}
+    'handle_index': {},
+    # each element in the form --> {handle_str: u_id of the last user given it}
+    # removed users keep their email and handle until someone else reuses it
+    'handle_suffixes': {},
+    # each element in the form --> {handle base: number of handles with it}
+    # see handle_base(), create_handle() gives the next one the suffix count - 1
+    'message_index': {},
+    # each element in the form --> {str(message_id): [key, location_id, position]}
+    # where key is 'messages' or 'dm_messages', for every message which has
+    # been sent and not removed (messages waiting in 'messages_later' are not)
+    'message_tombstones': {'messages': {}, 'dm_messages': {}},
+    # each element in the form --> {key: {str(location_id): [position, ...]}}
+    # in ascending order, where a removed message's tombstone
+    # {'message_id': X, 'is_removed': True} has been left, see tombstone_message()
+    # neither is saved: both are built from the locations whenever the store
+    # is read in, see index_messages()
+    'user_channels': {},
+    # each element in the form --> {str(u_id): [channel_id, ...]}
+    # the channels the user is a member of, in ascending order
+    'user_dms': {},
+    # each element in the form --> {str(u_id): [dm_id, ...]}
+    # the dms the user is a member of, in ascending order
+    'session_index': {},
+    # each element in the form --> {token: position of the token in 'sessions'}
+    'user_sessions': {},
+    # each element in the form --> {str(u_id): [token, ...]}
+    # the user's tokens in the order they logged in
+    'session_times': {},
+    # each element in the form --> {token: [issued, last_seen]} in seconds
+    # last_seen is brought up to date by each process' sweeper (see
+    # verify_session.py), so may lag by up to config.session_sweep_interval
 }
 
 
+def handle_base(handle):
+    '''the handle without its digits, which create_handle() counts'''
+    return re.sub(r'[0-9]+', '', handle[0:20])
+
+
+def index_users(users):
+    '''
+    Builds the indexes of store['users'] from scratch
+
+    Arguments:
+        users (list) - Every user, as in store['users']
+
+    Return Value:
+        Returns {key: index} for each key in USER_INDEXES
+    '''
+    indexes = {key: {} for key in USER_INDEXES}
+    for position, user in enumerate(users):
+        _index_user(indexes, user, position)
+    return indexes
+
+
+def _index_user(store, user, position):
+    '''add the user at position in store['users'] to the indexes'''
+    u_id = user[U_ID_IDX]
+    store['user_index'][str(u_id)] = position
+    store['email_index'][user[U_EMAIL_IDX]] = u_id
+    store['handle_index'][user[U_HANDLE_IDX]] = u_id
+    _count_handle(store, user[U_HANDLE_IDX], 1)
+
+
+def _count_handle(store, handle, step):
+    '''add step to the number of handles sharing handle's base'''
+    suffixes = store['handle_suffixes']
+    base = handle_base(handle)
+    count = suffixes.get(base, 0) + step
+    if count:
+        suffixes[base] = count
+    else:
+        del suffixes[base]
+
+
+def add_user(store, user):
+    '''
+    Appends a newly registered user to store['users'] and adds them to
+    the indexes
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        user (list) - The new user
+    '''
+    _index_user(store, user, len(store['users']))
+    store['users'].append(user)
+
+
+def set_user_email(store, user, email):
+    '''
+    Changes a user's email, keeping email_index up to date
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        user (list) - The user, as found in store['users']
+        email (str) - The new email
+    '''
+    index = store['email_index']
+    if index.get(user[U_EMAIL_IDX]) == user[U_ID_IDX]:
+        del index[user[U_EMAIL_IDX]]
+    index[email] = user[U_ID_IDX]
+    user[U_EMAIL_IDX] = email
+
+
+def set_user_handle(store, user, handle_str):
+    '''
+    Changes a user's handle, keeping handle_index and handle_suffixes up to
+    date
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        user (list) - The user, as found in store['users']
+        handle_str (str) - The new handle
+    '''
+    index = store['handle_index']
+    if index.get(user[U_HANDLE_IDX]) == user[U_ID_IDX]:
+        del index[user[U_HANDLE_IDX]]
+    _count_handle(store, user[U_HANDLE_IDX], -1)
+    index[handle_str] = user[U_ID_IDX]
+    _count_handle(store, handle_str, 1)
+    user[U_HANDLE_IDX] = handle_str
+
+
+def user_by_id(store, u_id):
+    '''
+    Finds a user through store['user_index'] rather than by searching
+    store['users']
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        u_id (int) - The id of the user
+
+    Return Value:
+        Returns the user (list), or None if there is no user with that u_id
+    '''
+    position = store['user_index'].get(str(u_id))
+    if position is None:
+        return None
+    user = store['users'][position]
+    return user if user[U_ID_IDX] == u_id else None
+
+
+def user_by_email(store, email):
+    '''
+    Finds the user who was last given an email through store['email_index']
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        email (str) - The email
+
+    Return Value:
+        Returns the user (list), or None if no user has that email
+    '''
+    user = user_by_id(store, store['email_index'].get(email))
+    return user if user is not None and user[U_EMAIL_IDX] == email else None
+
+
+def user_by_handle(store, handle_str):
+    '''
+    Finds the user who was last given a handle through store['handle_index']
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        handle_str (str) - The handle
+
+    Return Value:
+        Returns the user (list), or None if no user has that handle
+    '''
+    user = user_by_id(store, store['handle_index'].get(handle_str))
+    if user is not None and user[U_HANDLE_IDX] == handle_str:
+        return user
+    return None
+
+
+def index_messages(locations):
+    '''
+    Builds the message_index from scratch
+
+    Arguments:
+        locations (dict) - {key: the places of every location's messages}
+                           for 'messages' and 'dm_messages', where a place
+                           is the message_id, or ~message_id for a tombstone
+                           (see message_place())
+
+    Return Value:
+        Returns the message_index (dict)
+    '''
+    return {str(place): [key, location_id, position]
+            for key in SEGMENTED_KEYS
+            for location_id, places in enumerate(locations[key])
+            for position, place in enumerate(places)
+            if place >= 0}
+
+
+def index_tombstones(locations):
+    '''
+    Builds the message_tombstones from scratch
+
+    Arguments:
+        locations (dict) - {key: the places of every location's messages}
+                           for 'messages' and 'dm_messages', as for
+                           index_messages()
+
+    Return Value:
+        Returns the message_tombstones (dict)
+    '''
+    tombstones = {key: {} for key in SEGMENTED_KEYS}
+    for key in SEGMENTED_KEYS:
+        for location_id, places in enumerate(locations[key]):
+            positions = [position for position, place in enumerate(places)
+                         if place < 0]
+            if positions:
+                tombstones[key][str(location_id)] = positions
+    return tombstones
+
+
+def index_message(store, message_id, key, location_id, position):
+    '''
+    Records where a message was sent in store['message_index']
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        message_id (int) - The id of the message
+        key (str) - 'messages' or 'dm_messages'
+        location_id (int) - The channel_id or dm_id
+        position (int) - Where it is in the channel's or dm's messages
+    '''
+    store['message_index'][str(message_id)] = [key, location_id, position]
+
+
+def is_removed(message):
+    '''whether a message is the tombstone of one which was removed'''
+    return message.get('is_removed', False)
+
+
+def tombstone_message(store, message_id):
+    '''
+    Removes a message by putting a tombstone in its place, so no other
+    message moves and only that one position has to be written. Once more
+    than half of the channel's or dm's messages would be tombstones, they
+    are all dropped instead. Call record_removal() after it.
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        message_id (int) - The id of the message
+    '''
+    key, location_id, position = store['message_index'][str(message_id)]
+    messages = store[key][location_id]
+    messages[position] = {'message_id': message_id, 'is_removed': True}
+    removed = store['message_tombstones'][key].get(str(location_id), [])
+    if (len(removed) + 1) * 2 > len(messages):
+        messages[:] = [message for message in messages
+                       if not is_removed(message)]
+
+
+def record_removal(store, message_id):
+    '''
+    Takes a message removed by tombstone_message() out of
+    store['message_index'] and records its tombstone in
+    store['message_tombstones'], or if the tombstones were dropped,
+    indexes where the channel's or dm's messages now are
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        message_id (int) - The id of the message
+    '''
+    place = store['message_index'].pop(str(message_id), None)
+    if place is None:
+        return
+    key, location_id, position = place
+    messages = store[key][location_id]
+    if position < len(messages) and is_removed(messages[position]) \
+            and messages[position]['message_id'] == message_id:
+        removed = store['message_tombstones'][key].setdefault(
+            str(location_id), [])
+        idx = bisect.bisect_left(removed, position)
+        if idx == len(removed) or removed[idx] != position:
+            removed.insert(idx, position)
+    else:
+        _reindex_location(store, key, location_id)
+
+
+def _reindex_location(store, key, location_id):
+    '''index where every message and tombstone of a location is again'''
+    removed = []
+    for position, message in enumerate(store[key][location_id]):
+        if is_removed(message):
+            removed.append(position)
+        else:
+            index_message(store, message['message_id'], key, location_id,
+                          position)
+    if removed:
+        store['message_tombstones'][key][str(location_id)] = removed
+    else:
+        store['message_tombstones'][key].pop(str(location_id), None)
+
+
+def unindex_message(store, message_id):
+    '''
+    Takes a message out of store['message_index']
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        message_id (int) - The id of the message
+    '''
+    store['message_index'].pop(str(message_id), None)
+
+
+def clear_messages(store, key, location_id):
+    '''
+    Removes every message in a channel or dm
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        key (str) - 'messages' or 'dm_messages'
+        location_id (int) - The channel_id or dm_id
+
+    Return Value:
+        Returns how many messages were removed, not counting tombstones
+    '''
+    messages = store[key][location_id]
+    removed = store['message_tombstones'][key].pop(str(location_id), [])
+    for message in messages:
+        unindex_message(store, message['message_id'])
+    num_msgs = len(messages) - len(removed)
+    messages.clear()
+    return num_msgs
+
+
+def live_span(total, removed, start, count):
+    '''
+    Where the page of a location's messages is among its tombstones
+
+    Arguments:
+        total (int) - How many messages and tombstones the location holds
+        removed (list) - The positions of its tombstones, in ascending order
+        start (int) - How many of the most recent messages to skip
+        count (int) - The most messages on the page
+
+    Return Value:
+        Returns (live, skip, span) where live is how many messages are not
+        tombstones, and the page is among the span messages and tombstones
+        after skipping the skip most recent
+    '''
+    live = total - len(removed)
+    if start >= live or count <= 0:
+        return live, 0, 0
+    newest = _live_position(removed, live - 1 - start)
+    oldest = _live_position(removed, max(live - start - count, 0))
+    return live, total - 1 - newest, newest - oldest + 1
+
+
+def _live_position(removed, index):
+    '''the position of the index-th message which is not a tombstone'''
+    low, high = index, index + len(removed)
+    while low < high:
+        middle = (low + high) // 2
+        if middle + 1 - bisect.bisect_right(removed, middle) > index:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def _page(messages, removed, start, count):
+    '''
+    (total, page) of a location's messages, newest first, skipping the start
+    newest, where removed are the positions of its tombstones
+    '''
+    total = len(messages)
+    live, skip, span = live_span(total, removed, start, count)
+    page = [messages[total - 1 - idx] for idx in range(skip, skip + span)]
+    return live, [message for message in page if not is_removed(message)]
+
+
+def find_message(store, message_id):
+    '''
+    Finds a message through store['message_index']
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        message_id (int) - The id of the message
+
+    Return Value:
+        Returns (key, location_id, message) where key is 'messages' or
+        'dm_messages', or None if there is no such message
+    '''
+    place = store['message_index'].get(str(message_id))
+    if place is None:
+        return None
+    key, location_id, position = place
+    return key, location_id, store[key][location_id][position]
+
+
+def _time_sent(later):
+    '''when a message in store['messages_later'] is due to be sent'''
+    return later['message_data']['time_sent']
+
+
+def _due_by(queue, time_sent):
+    '''
+    how many messages at the front of a queue in order of time_sent are
+    due by time_sent, as bisect_right() would find with key=_time_sent,
+    which older versions of python do not have
+    '''
+    low, high = 0, len(queue)
+    while low < high:
+        middle = (low + high) // 2
+        if _time_sent(queue[middle]) > time_sent:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def queue_message(store, later):
+    '''
+    Adds a message to store['messages_later'], keeping it in order of
+    time_sent (after any others due at the same time)
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        later (dict) - {'channel', 'location_id', 'message_data'}
+    '''
+    queue = store['messages_later']
+    queue.insert(_due_by(queue, _time_sent(later)), later)
+
+
+def count_due(store, now):
+    '''
+    How many messages at the front of store['messages_later'] are due
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        now (float) - The time in seconds
+
+    Return Value:
+        Returns the number of messages due by now (int)
+    '''
+    return _due_by(store['messages_later'], now)
+
+
+def index_standups(standups, queue):
+    '''
+    Builds store['standups'] and store['standup_archive'] from the list of
+    every standup an older version kept, in which the running standup's
+    message held its buffer
+
+    Arguments:
+        standups (list) - Every standup, [initiator_id, ch_id, time_finish,
+                          new_msg_id]
+        queue (list) - The messages waiting, as in store['messages_later']
+
+    Return Value:
+        Returns {'standups': index, 'standup_archive': archive}
+    '''
+    waiting = {later['message_data']['message_id']: later for later in queue}
+    indexes = {'standups': {}, 'standup_archive': []}
+    for standup in reversed(standups):
+        standup = standup[:SDUP_BUFFER_ID]
+        if isinstance(standup[SDUP_MSGS_ID], dict):
+            # kept as message_sendlater_v1() returned it
+            standup[SDUP_MSGS_ID] = standup[SDUP_MSGS_ID]['message_id']
+        later = waiting.get(standup[SDUP_MSGS_ID])
+        if later is None:
+            indexes['standup_archive'].append(standup)
+            continue
+        text = later['message_data']['message']
+        indexes['standups'][str(standup[SDUP_CH_ID])] = \
+            standup + [[text] if text else []]
+    return indexes
+
+
+def start_standup(store, u_id, channel_id, time_finish, message_id):
+    '''
+    Makes a standup the one running in a channel. The channel's last
+    standup may have finished without its message having been sent yet, in
+    which case its message is given what was sent to it now, as
+    finish_standup() can no longer find it
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        u_id (int) - The id of the user who started it
+        channel_id (int) - The channel it is running in
+        time_finish (int) - When it finishes
+        message_id (int) - The message in store['messages_later'] sent when
+                           it finishes
+    '''
+    last = store['standups'].get(str(channel_id))
+    if last is not None:
+        queue = store['messages_later']
+        # the queue is in order of time_sent, so its message is among those
+        # due at the moment the standup finished
+        position = _due_by(queue, last[SDUP_T_END_ID]) - 1
+        while position >= 0 and \
+                _time_sent(queue[position]) == last[SDUP_T_END_ID]:
+            message_data = queue[position]['message_data']
+            if message_data['message_id'] == last[SDUP_MSGS_ID]:
+                message_data['message'] = _archive_standup(store, last)
+                break
+            position -= 1
+    store['standups'][str(channel_id)] = [u_id, channel_id, time_finish,
+                                          message_id, []]
+
+
+def active_standup(store, channel_id, now):
+    '''
+    The standup running in a channel
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        channel_id (int) - The id of the channel
+        now (int) - The time in seconds
+
+    Return Value:
+        Returns the standup (list), or None if none is running
+    '''
+    standup = store['standups'].get(str(channel_id))
+    if standup is None or now >= standup[SDUP_T_END_ID]:
+        return None
+    return standup
+
+
+def finish_standup(store, channel_id, message_id):
+    '''
+    Ends a channel's standup if message_id is its message, moving it to
+    store['standup_archive']
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        channel_id (int) - The id of the channel
+        message_id (int) - The id of a message being sent from
+                           store['messages_later']
+
+    Return Value:
+        Returns everything sent to the standup as one message (str), or
+        None if message_id is not a standup's
+    '''
+    standup = store['standups'].get(str(channel_id))
+    if standup is None or standup[SDUP_MSGS_ID] != message_id:
+        return None
+    del store['standups'][str(channel_id)]
+    return _archive_standup(store, standup)
+
+
+def _archive_standup(store, standup):
+    '''
+    adds a standup to store['standup_archive'], returning everything sent
+    to it as one message
+    '''
+    store['standup_archive'].append(standup[:SDUP_BUFFER_ID])
+    return ''.join(standup[SDUP_BUFFER_ID])
+
+
+def channel_by_id(store, channel_id):
+    '''
+    Finds a channel without searching store['channels'], where a channel's
+    position is always one less than its channel_id
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        channel_id (int) - The id of the channel
+
+    Return Value:
+        Returns the channel (list), or None if there is no such channel
+    '''
+    channels = store['channels']
+    if isinstance(channel_id, int) and 0 < channel_id <= len(channels):
+        channel = channels[channel_id - 1]
+        if channel[CH_ID_IDX] == channel_id:
+            return channel
+    return None
+
+
+def dm_by_id(store, dm_id):
+    '''
+    Finds a dm the same way as channel_by_id(). A removed dm's id is made
+    negative, so it is not found.
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        dm_id (int) - The id of the dm
+
+    Return Value:
+        Returns the dm (list), or None if there is no such dm
+    '''
+    dms = store['dms']
+    if isinstance(dm_id, int) and 0 < dm_id <= len(dms):
+        dm = dms[dm_id - 1]
+        if dm[DM_ID_IDX] == dm_id:
+            return dm
+    return None
+
+
+def index_memberships(channels, dms):
+    '''
+    Builds user_channels and user_dms from scratch
+
+    Arguments:
+        channels (list) - Every channel, as in store['channels']
+        dms (list) - Every dm, as in store['dms']
+
+    Return Value:
+        Returns {'user_channels': index, 'user_dms': index}
+    '''
+    indexes = {'user_channels': {}, 'user_dms': {}}
+    for channel in channels:
+        for u_id in channel[CH_MEMBER_IDX]:
+            add_membership(indexes, 'user_channels', u_id, channel[CH_ID_IDX])
+    for dm in dms:
+        for member in dm[DM_MEMBERS_IDX]:
+            add_membership(indexes, 'user_dms', member[U_ID_IDX], dm[DM_ID_IDX])
+    return indexes
+
+
+def memberships(store, key, u_id):
+    '''
+    The channels or dms a user is a member of
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        key (str) - 'user_channels' or 'user_dms'
+        u_id (int) - The id of the user
+
+    Return Value:
+        Returns the channel_ids or dm_ids (list), in ascending order
+    '''
+    return store[key].get(str(u_id), [])
+
+
+def is_channel_member(store, u_id, channel_id):
+    '''
+    Whether a user is a member of a channel, found through the channels
+    they are a member of rather than the channel's members
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        u_id (int) - The id of the user
+        channel_id (int) - The id of the channel
+
+    Return Value:
+        Returns True or False
+    '''
+    return channel_id in memberships(store, 'user_channels', u_id)
+
+
+def is_dm_member(store, u_id, dm_id):
+    '''
+    Whether a user is a member of a dm, the same way as is_channel_member()
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        u_id (int) - The id of the user
+        dm_id (int) - The id of the dm
+
+    Return Value:
+        Returns True or False
+    '''
+    return dm_id in memberships(store, 'user_dms', u_id)
+
+
+def add_membership(store, key, u_id, location_id):
+    '''
+    Records in store[key] that a user joined a channel ('user_channels') or
+    dm ('user_dms'), alongside adding them to its members
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        key (str) - 'user_channels' or 'user_dms'
+        u_id (int) - The id of the user
+        location_id (int) - The channel_id or dm_id
+    '''
+    location_ids = store[key].setdefault(str(u_id), [])
+    position = bisect.bisect_left(location_ids, location_id)
+    if location_ids[position:position + 1] != [location_id]:
+        location_ids.insert(position, location_id)
+
+
+def remove_membership(store, key, u_id, location_id):
+    '''
+    Records in store[key] that a user left a channel ('user_channels') or dm
+    ('user_dms'), alongside taking them out of its members
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        key (str) - 'user_channels' or 'user_dms'
+        u_id (int) - The id of the user
+        location_id (int) - The channel_id or dm_id
+    '''
+    location_ids = store[key].get(str(u_id))
+    if location_ids is None or location_id not in location_ids:
+        return
+    location_ids.remove(location_id)
+    if not location_ids:
+        del store[key][str(u_id)]
+
+
+def token_user(token):
+    '''the auth_user_id a token was issued to, without checking its signature'''
+    return jwt.decode(token, options={'verify_signature': False})['auth_user_id']
+
+
+def index_sessions(sessions, now):
+    '''
+    Builds session_index, user_sessions and session_times from scratch
+
+    Arguments:
+        sessions (list) - Every token, as in store['sessions']
+        now (int) - When tokens whose times were not kept count as issued
+
+    Return Value:
+        Returns {key: index} for each key in SESSION_INDEXES
+    '''
+    indexes = {key: {} for key in SESSION_INDEXES}
+    for position, token in enumerate(sessions):
+        indexes['session_index'][token] = position
+        indexes['user_sessions'].setdefault(
+            str(token_user(token)), []).append(token)
+        indexes['session_times'][token] = [now, now]
+    return indexes
+
+
+def add_session(store, token, u_id):
+    '''
+    Appends a newly issued token to store['sessions'] and adds it to the
+    indexes
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        token (str) - The new token
+        u_id (int) - The id of the user it was issued to
+    '''
+    now = int(time.time())
+    store['session_index'][token] = len(store['sessions'])
+    store['sessions'].append(token)
+    store['user_sessions'].setdefault(str(u_id), []).append(token)
+    store['session_times'][token] = [now, now]
+
+
+def has_session(store, token):
+    '''
+    Whether a token is one of the current sessions
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        token (str) - The token
+
+    Return Value:
+        Returns True or False
+    '''
+    return token in store['session_index']
+
+
+def remove_session(store, token):
+    '''
+    Ends a session. The last token in store['sessions'] is moved into its
+    place, so only two positions change however many sessions there are.
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        token (str) - The token
+
+    Return Value:
+        Returns True, or False if the token was not a current session
+    '''
+    position = store['session_index'].pop(token, None)
+    if position is None:
+        return False
+    store['session_times'].pop(token, None)
+    sessions = store['sessions']
+    last = sessions.pop()
+    if last != token:
+        sessions[position] = last
+        store['session_index'][last] = position
+
+    u_id = str(token_user(token))
+    tokens = store['user_sessions'][u_id]
+    tokens.remove(token)
+    if not tokens:
+        del store['user_sessions'][u_id]
+    return True
+
+
+def user_sessions(store, u_id):
+    '''
+    The current tokens of a user
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        u_id (int) - The id of the user
+
+    Return Value:
+        Returns the tokens (list), in the order they were issued
+    '''
+    return store['user_sessions'].get(str(u_id), [])
+
+
+def remove_user_sessions(store, u_id):
+    '''
+    Ends every session of a user (logs them out everywhere)
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        u_id (int) - The id of the user
+
+    Return Value:
+        Returns the tokens which were ended (list)
+    '''
+    tokens = list(user_sessions(store, u_id))
+    for token in tokens:
+        remove_session(store, token)
+    return tokens
+
+
 class Datastore:
     '''
     Data store object that handles the data access between backend and database
     member function:
-        __init__()
+        __init__(path, mode, flush_interval, backend)
         get()
         set()
+        begin()
+        commit()
+        rollback()
+        in_transaction()
+        transaction()
+        lock()
+        defer()
+        next_id()
+        flush()
+        compact()
+        close()
+
+    In 'sync' mode every set() writes what changed to disk, and several
+    processes can share the same files: a transaction holds an fcntl lock
+    on <file>.lock from begin() until it commits, and get() holds a shared
+    one. Each write bumps the generation number kept in <file>.gen, and
+    whenever it has moved on since this process last looked the top level
+    keys other processes rewrote are read in again. Unless a stat() shows
+    the data file or generation file has been replaced nothing is read. In
+    'write_behind' mode the in-memory store is authoritative: get() returns
+    it straight away, set() only marks it dirty and a background thread
+    flushes it every flush_interval seconds. In 'journal' mode the in-memory
+    store is also authoritative and set() appends the changes made since
+    the last set() to the write ahead log, which is folded back into the
+    data file in the background once it gets too big.
+
+    The store is made of tracked containers (see tracking.py), so the changes
+    made since the last set() are known without comparing whole stores.
+
+    With the 'json' backend each channel's (and dm's) messages are kept in a
+    segment file of their own (see segments.py), which is read the first
+    time they are used and only rewritten when they change. Once the
+    segments in memory add up to more than config.segment_cache_size bytes,
+    the least recently used ones which have no unsaved changes are dropped
+    and read back in from disk the next time they are needed. The message
+    indexes (DERIVED_KEYS) are not saved at all, but built whenever the
+    store is read in from where each log's index says its messages and
+    tombstones are, so sending or removing a message only writes to the
+    log of its channel (or dm).
+
+    With the 'sqlite' backend the data lives in a database instead (see
+    sqlite_store.py) and only the rows of the items which changed are
+    written. 'sync' and 'journal' mode then commit each transaction straight
+    to the database, whose own write ahead log provides the journal, while
+    'write_behind' mode batches them up for the background flusher.
+
+    With the 'service' backend the store daemon (see store_service.py) owns
+    the data and this object keeps a replica of it. Mutations are recorded
+    as log ops, as in 'journal' mode, and shipped to the daemon when the
+    transaction commits. Each transaction first catches up with the ops
+    other workers committed, holding the daemon's write lease until it
+    ends.
+
+    A transaction groups every get() and set() made inside it into a single
+    atomic commit: set() only marks the store as changed, and the store is
+    persisted once when the outermost transaction commits. If it rolls back
+    instead, every change made since it began is undone. A thread holds the
+    store's lock for the whole of its transaction, unless the transaction is
+    scoped: scoped transactions lock only the channels and dms whose
+    messages they change (see locks.py), keep their changes to themselves
+    until they commit and then merge them in one at a time, so several can
+    run at once. In 'journal' mode the log is fsynced after the lock is
+    released, so transactions committing at the same time share one fsync.
+    A set() outside a transaction is committed straight away.
+
+    Every commit also publishes a read-only snapshot of the store (see
+    snapshots.py), copying only the items it changed. A shared transaction
+    reads the latest snapshot without taking the lock, so requests which
+    only read are never held up by one which writes, and never see it half
+    done.
     '''
 
-    def __init__(self):
+    def __init__(self, path=DATA_PATH, mode=None, flush_interval=None,
+                 backend=None):
         '''initialize data_store'''
+        if mode is None:
+            mode = config.store_mode
+        if mode not in STORE_MODES:
+            raise ValueError(f'unknown store mode {mode!r}')
+        if flush_interval is None:
+            flush_interval = config.flush_interval
+        if backend is None:
+            backend = config.store_backend
+        if backend not in STORE_BACKENDS:
+            raise ValueError(f'unknown store backend {backend!r}')
 
-        if exists('src/data_store.json'):  # file exist
+        self.__path = path
+        self.__wal_path = os.path.splitext(path)[0] + '.wal'
+        self.__generation_path = os.path.splitext(path)[0] + '.gen'
+        self.__mode = mode
+        self.__flush_interval = flush_interval
+        self.__lock = threading.RLock()
+        self.__dirty = False
+        self.__flusher = None
+        self.__compactor = None
+        self.__fold_lock = threading.Lock()
+        self.__closing = threading.Event()
+        self.__segments = {}
+        self.__positions = {}
+        self.__pending = []
+        self.__local = threading.local()
+        self.__workspace = WorkspaceLock()
+        self.__locations = LocationLocks()
+        self.__wal = None
+        self.__backend = None
+        self.__changes = {}
+        self.__files = SegmentFiles(path)
+        self.__manifest = None
+        self.__resident = OrderedDict()
+        self.__resident_size = 0
+        self.__cache_size = config.segment_cache_size
+        self.__unfolded = set()
+        self.__folding = set()
+        self.__generation = 0
+        self.__stamp = None
+        self.__key_stamps = {}
+        self.__lock_path = None
+        self.__lock_fd = None
+        self.__lock_pid = None
+        self.__file_locks = 0
+        self.__service = None
+        self.__version = None
+        self.__replaying = False
+        self.__view = None
+        self.__unpublished = {}
+        self.__blocks = {}
 
-            if os.stat("src/data_store.json").st_size == 0:  # file empty
-                self.__store = initial_object
-                with open('src/data_store.json', 'w', encoding="utf8") as file:
-                    json.dump(self.__store, file)
-            else:  # load from file if not empyt and exists
-                with open('src/data_store.json', 'r', encoding="utf8") as file:
-                    file_contents = json.load(file)
-                    self.__store = file_contents
-        # else initialise it
-        else:
-            self.__store = initial_object
-            with open('src/data_store.json', 'w', encoding="utf8") as file:
-                json.dump(self.__store, file)
+        if backend == 'sqlite':
+            self.__backend = SqliteBackend(os.path.splitext(path)[0] + '.db')
+            with self.__lock:
+                self.__load_backend()
+                self.__publish()
+            return
+        if backend == 'service':
+            self.__service = ServiceClient(config.store_socket)
+            with self.__lock:
+                self.__version, store = self.__service.snapshot()
+                self.__store = self.__track(store)
+                self.__publish()
+            return
 
-    def get(self):
-        '''call data_store object to get database'''
+        if mode == 'sync':
+            # the files are the only copy of the store, which other
+            # processes may share
+            self.__lock_path = os.path.splitext(path)[0] + '.lock'
+        with self.__lock:
+            self.__lock_files(fcntl.LOCK_EX)
+            try:
+                self.__load_json()
+            finally:
+                self.__unlock_files()
+            self.__publish()
 
-        with open('src/data_store.json', 'r', encoding="utf8") as file:
-            file_contents = json.load(file)
+        if mode == 'journal':
+            self.__wal = WriteAheadLog(self.__wal_path, config.wal_fsync,
+                                       config.wal_fsync_interval)
 
-        if file_contents != self.__store:
-            raise AccessError(description="DATA STORE NOT SYNCED")
+    def get(self):
+        '''call data_store object to get database'''
+        view = getattr(self.__local, 'view', None)
+        if view is not None:
+            return view
+        # a transaction caught up with other processes when it began
+        if not self.in_transaction():
+            with self.__lock:
+                try:
+                    self.__enter(shared=True)
+                finally:
+                    self.__leave()
 
         return self.__store
 
@@ -213,16 +1210,1462 @@ class Datastore:
         '''set data store to a given state'''
         if not isinstance(store, dict):
             raise TypeError('store must be of type dictionary')
+        if getattr(self.__local, 'view', None) is not None:
+            raise TypeError('a shared transaction cannot change the store')
+
+        with self.transaction():
+            local = self.__local
+            if store is not self.__store:
+                if local.scoped:
+                    raise RuntimeError(
+                        'a scoped transaction cannot replace the store')
+                local.undo.append((None, 'store', None, self.__store))
+                self.__store = self.__track(store)
+                self.__check_blocks()
+                local.changes = {(): None}
+                local.unpublished = {(): None}
+                if self.__wal is not None or self.__service is not None:
+                    local.pending.append(
+                        json.dumps(['reset', self.__store],
+                                   default=self.__unloaded))
+            local.changed = True
+
+        return True
+
+    def begin(self, shared=False, scoped=False, read_only=False):
+        '''
+        Start a transaction, or a nested one inside the current one.
+
+        A shared transaction only reads: get() returns the snapshot
+        published by the last commit (see snapshots.py) and set() raises
+        TypeError. It never holds the store's lock, so it neither waits for
+        writers nor holds them up. A shared transaction nested inside it is
+        part of it, while one which is not shared runs as a transaction of
+        its own, after which the shared one reads the snapshot it published.
+        A read_only transaction is a shared one inside which beginning a
+        transaction which is not shared raises TypeError as well, so nothing
+        run inside it can write to the store.
+
+        Any other transaction holds the whole workspace (see locks.py) and
+        the store's lock until it ends. A scoped transaction instead shares
+        the workspace with other scoped ones and only changes the locations
+        it lock()s, so requests changing different channels' messages run
+        at the same time. Whatever else it changes (notifications, stats)
+        it defer()s to its commit, and it takes ids with next_id(). With
+        the 'service' backend every transaction holds the whole workspace.
+        '''
+        local = self.__local
+        if getattr(local, 'view', None) is not None:
+            if shared or read_only:
+                local.marks.append(None)
+                return
+            if local.read_only:
+                raise TypeError('a read-only transaction cannot change the '
+                                'store')
+            local.suspended = local.marks
+            local.view = None
+            local.marks = []
+        if (shared or read_only) and not self.in_transaction():
+            local.view = self.__snapshot()
+            local.marks = [None]
+            local.read_only = read_only
+            return
+        if self.in_transaction():
+            local.marks.append((len(local.undo), len(local.pending)))
+            return
+        scoped = scoped and self.__service is None
+        self.__workspace.acquire(exclusive=not scoped)
+        self.__lock.acquire()
+        try:
+            self.__enter(shared=False)
+        except BaseException:
+            self.__leave()
+            self.__lock.release()
+            self.__workspace.release(exclusive=not scoped)
+            self.__resume()
+            raise
+        if scoped:
+            self.__lock.release()
+        local.scoped = scoped
+        local.committing = False
+        local.changed = False
+        local.allocated = False
+        local.undo = []
+        local.changes = {}
+        local.unpublished = {}
+        local.pending = []
+        local.deferred = []
+        local.locked = []
+        local.marks = [(0, 0)]
+
+    def commit(self):
+        '''
+        Commit the current transaction. A nested transaction is merged into
+        the one enclosing it, the outermost one is persisted.
+        '''
+        local = self.__local
+        if local.marks[-1] is None:
+            self.__end_shared()
+            return
+        if len(local.marks) > 1:
+            local.marks.pop()
+            return
+        if local.scoped:
+            self.__lock.acquire()
+        try:
+            # what was deferred runs one commit at a time
+            local.committing = True
+            while local.deferred:
+                function, args = local.deferred.pop(0)
+                function(*args)
+        except BaseException:
+            if local.scoped:
+                self.__lock.release()
+            self.rollback()
+            raise
+        local.marks.pop()
+        lsn = None
+        try:
+            self.__merge(self.__changes, local.changes)
+            self.__merge(self.__unpublished, local.unpublished)
+            self.__pending.extend(local.pending)
+            if local.changed or local.allocated:
+                lsn = self.__persist()
+            self.__publish()
+            self.__evict()
+        finally:
+            self.__end()
+        if lsn is not None:
+            # outside the lock, so other threads can commit behind us and
+            # share the fsync
+            self.__wal.commit(lsn)
+
+    def rollback(self):
+        '''undo every change made since the current transaction began'''
+        local = self.__local
+        if local.marks[-1] is None:
+            self.__end_shared()
+            return
+        undo_mark, pending_mark = local.marks.pop()
+        if local.scoped:
+            self.__lock.acquire()
+        lsn = None
+        try:
+            entries = local.undo[undo_mark:]
+            if entries:
+                for container, op, key, old in reversed(entries):
+                    if op == 'store':
+                        self.__store = old
+                    else:
+                        undo(container, op, key, old)
+                del local.undo[undo_mark:]
+                # values moved around the store have to be re-tagged
+                self.__store = self.__track(self.__store, force=True)
+                self.__check_blocks()
+            del local.pending[pending_mark:]
+            if not local.marks and local.allocated:
+                # the ids it took stay taken
+                lsn = self.__persist()
+        finally:
+            if local.marks:
+                if local.scoped:
+                    self.__lock.release()
+            else:
+                self.__end()
+        if lsn is not None:
+            self.__wal.commit(lsn)
+
+    def lock(self, *keys):
+        '''
+        Lock the locations a scoped transaction is about to change, which
+        stay locked until it ends. Does nothing in any other transaction.
+
+        Arguments:
+            keys (tuple) - The segment keys of the locations, e.g.
+                           ('messages', channel_id). With none, the
+                           transaction takes the whole workspace instead
+                           and stops being scoped.
+
+        Exceptions:
+            RuntimeError - Occurs when the locations are not locked in
+                           ascending order, or the whole workspace is taken
+                           after something was locked or changed
+
+        Return Value:
+            Returns None
+        '''
+        local = self.__local
+        if not getattr(local, 'scoped', False):
+            return
+        if not keys:
+            if local.locked or local.undo or local.deferred:
+                raise RuntimeError(
+                    'the workspace must be taken before anything else')
+            self.__workspace.release(exclusive=False)
+            self.__workspace.acquire(exclusive=True)
+            self.__lock.acquire()
+            local.scoped = False
+            return
+        keys = sorted(set(keys) - set(local.locked))
+        if keys and local.locked and keys[0] < local.locked[-1]:
+            raise RuntimeError('locations must be locked in ascending order')
+        self.__locations.acquire(keys)
+        local.locked.extend(keys)
+
+    def defer(self, function, *args):
+        '''
+        Call function(*args) when a scoped transaction commits, as part of
+        its commit, so changes to what every transaction shares are made
+        one at a time. Any other transaction calls it straight away.
+        '''
+        local = self.__local
+        if getattr(local, 'scoped', False) and not local.committing:
+            local.deferred.append((function, args))
+        else:
+            function(*args)
+
+    def next_id(self, key):
+        '''
+        Takes a new id from the counter store[key], e.g. 'message_counter'
+
+        Arguments:
+            key (str) - The top level key of the counter
+
+        Return Value:
+            Returns an id which no other thread, or process sharing the
+            store, has taken. Each process reserves id_block_size() ids at a
+            time by moving the counter on straight away, outside any
+            transaction, then hands them out without touching the store.
+            With one process the ids come in order, with several they only
+            come in order within each process. Ids reserved but never handed
+            out, by a process which exits, are skipped, as is one taken by
+            a transaction which rolls back.
+        '''
+        value = self.__take_id(key)
+        if value is not None:
+            return value
+        with self.__lock:
+            value = self.__take_id(key)
+            if value is not None:
+                return value
+            value = self.__store[key] + 1
+            end = self.__store[key] + id_block_size()
+            dict.__setitem__(self.__store, key, end)
+            self.__changes[(key,)] = None
+            self.__unpublished[(key,)] = None
+            if self.__wal is not None or self.__service is not None:
+                self.__pending.append(json.dumps(['set', key, end]))
+            self.__blocks[key] = (itertools.count(value + 1), end,
+                                  os.getpid())
+            if getattr(self.__local, 'undo', None) is not None:
+                self.__local.allocated = True
+        return value
+
+    def in_transaction(self):
+        '''whether the calling thread is inside a transaction'''
+        return bool(getattr(self.__local, 'marks', None))
+
+    @contextmanager
+    def transaction(self, shared=False, scoped=False, read_only=False):
+        '''
+        Context manager running its body as a transaction, which commits
+        when the body finishes and rolls back if it raises
+        '''
+        self.begin(shared, scoped, read_only)
+        try:
+            yield
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def segment(self, key):
+        '''the Segment object for a segment key, see tracking.py'''
+        seg = self.__segments.get(key)
+        if seg is None:
+            seg = self.__segments[key] = Segment(key, self, self.__lock)
+        return seg
+
+    def on_change(self, container, op, key, value, old):
+        '''called by tracked containers after they are mutated'''
+        if self.__replaying:
+            return
+        local = self.__local
+        if getattr(local, 'undo', None) is not None:
+            local.undo.append((container, op, key, old))
+            if local.scoped and not local.committing \
+                    and container._seg.key not in local.locked:
+                raise RuntimeError(f'{container._seg.key} changed by a '
+                                   'scoped transaction without lock()')
+            changes, unpublished, pending = \
+                local.changes, local.unpublished, local.pending
+        else:
+            changes, unpublished, pending = \
+                self.__changes, self.__unpublished, self.__pending
+        self.__mark(changes, container, op, key)
+        self.__mark(unpublished, container, op, key)
+        if self.__wal is None and self.__service is None:
+            return
+        record = self.__record(container, op, key, value)
+        if record is not None:
+            record = json.dumps(record, default=self.__unloaded)
+            pending.append(record)
+            seg = container._seg
+            if len(seg.key) == 2 and seg in self.__resident:
+                # roughly how much the segment has grown
+                self.__resize(seg, self.__resident[seg] + len(record))
+
+    def recent_messages(self, key, location_id, start, count):
+        '''
+        Returns a page of the messages at store[key][location_id]
+
+        Arguments:
+            key (str) - 'messages' or 'dm_messages'
+            location_id (int) - The channel_id or dm_id
+            start (int) - How many of the most recent messages to skip
+            count (int) - The most messages to return
+
+        Return Value:
+            Returns (total, messages) where total is how many messages the
+            location holds and messages are the page, newest first. If the
+            location has not been read in from disk, only the messages on
+            the page are read and they are copies, not part of the store.
+            Inside a shared transaction they come from its snapshot.
+            Tombstones are neither counted nor returned, and are skipped
+            without reading the messages before the page.
+        '''
+        # a negative start only shortens the page
+        count = max(count + min(start, 0), 0)
+        start = max(start, 0)
+        view = getattr(self.__local, 'view', None)
+        if view is not None:
+            removed = view['message_tombstones'][key].get(str(location_id), [])
+            messages = list.__getitem__(view[key], location_id)
+            if isinstance(messages, Unloaded):
+                return self.__page_files(key, location_id, removed, start,
+                                         count, repair=False)
+            return _page(messages, removed, start, count)
+        with self.__lock:
+            removed = self.__store['message_tombstones'][key].get(
+                str(location_id), [])
+            locations = self.__store[key]
+            if self.__backend is not None or not isinstance(
+                    list.__getitem__(locations, location_id), Unloaded):
+                return _page(locations[location_id], removed, start, count)
+            self.__lock_files(fcntl.LOCK_SH)
+            try:
+                return self.__page_files(key, location_id, removed, start,
+                                         count)
+            finally:
+                self.__unlock_files()
 
-        with open('src/data_store.json', 'w', encoding="utf8") as file:
-            json.dump(store, file)
+    def __page_files(self, key, location_id, removed, start, count,
+                     repair=True):
+        '''read a page of a location which is still on disk, see _page()'''
+        total = self.__files.page(key, location_id, 0, 0, repair)[0]
+        live, skip, span = live_span(total, removed, start, count)
+        messages = self.__files.page(key, location_id, skip, span, repair)[1]
+        return live, [message for message in messages
+                      if not is_removed(message)]
 
-        self.__store = store
+    def load_segment(self, key):
+        '''read a segment which is still on disk in, see tracking.py'''
+        with self.__lock:
+            self.__lock_files(fcntl.LOCK_SH)
+            try:
+                messages, size = self.__files.read(*key)
+            finally:
+                self.__unlock_files()
+            self.__resize(self.segment(key), size)
+            self.__fill_view(key, messages)
+        return messages
 
+    def segment_used(self, segment):
+        '''called by SegmentedLists each time one of their segments is read'''
+        if segment in self.__resident:
+            self.__resident.move_to_end(segment)
+        else:
+            self.__resident[segment] = 0
+
+    def dump(self):
+        '''
+        Returns the whole store as json, reading in any segments which are
+        still on disk
+        '''
+        with self.__lock:
+            return json.dumps(self.__store, default=self.__unloaded)
+
+    def flush(self):
+        '''write the store to disk if it has changed since the last flush'''
+        with self.__lock:
+            if not self.__dirty:
+                return False
+            self.__dirty = False
+            # request threads hold the lock while mutating the store, so the
+            # snapshot cannot be torn
+            if self.__backend is not None:
+                self.__save_changes()
+            else:
+                self.__save_json()
+            self.__evict()
         return True
 
+    def compact(self):
+        '''fold the write ahead log into the data file'''
+        with self.__fold_lock:
+            with self.__lock:
+                if self.__wal is None:
+                    return False
+                self.__persist_pending()
+                self.__rotate()
+            self.__fold_old_wal()
+        return True
+
+    def close(self):
+        '''stop the background threads and persist anything outstanding'''
+        self.__closing.set()
+        for thread in (self.__flusher, self.__compactor):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        self.flush()
+        if self.__backend is not None:
+            with self.__lock:
+                self.__save_changes()
+                self.__backend.close()
+            return
+        if self.__service is not None:
+            with self.__lock:
+                self.__service.close()
+            return
+        with self.__fold_lock:
+            with self.__lock:
+                if self.__wal is None:
+                    return
+                self.__persist_pending()
+                self.__wal.close()
+                self.__wal = None
+                if not exists(self.__wal_path):
+                    return
+                os.replace(self.__wal_path, self.__old_wal_path())
+            self.__fold_old_wal()
+
+    def __track(self, store, force=False):
+        '''convert a plain store into tracked containers'''
+        self.__positions = {}
+        return track(store, self.segment(()), force=force)
+
+    def __persist(self):
+        '''
+        Persist the store at the end of a transaction, the lock must be held.
+        Returns the lsn to commit in 'journal' mode, else None.
+        '''
+        if self.__service is not None:
+            try:
+                self.__version = self.__service.commit(self.__pending)
+            except BaseException:
+                # the replica no longer matches the service, so it is
+                # replaced by the whole store at the next catch up
+                self.__version = 0
+                raise
+            finally:
+                self.__pending = []
+                self.__changes = {}
+        elif self.__mode == 'write_behind':
+            self.__dirty = True
+            self.__start_flusher()
+        elif self.__backend is not None:
+            self.__save_changes()
+        elif self.__wal is not None:
+            lsn = self.__persist_pending()
+            if self.__wal.size() >= config.wal_compact_size:
+                self.__start_compactor()
+            return lsn
+        else:
+            self.__save_json()
+        return None
+
+    def __load_backend(self):
+        '''
+        load the store from the database, migrating the json data file into
+        it the first time
+        '''
+        store = self.__backend.load()
+        if store is None:
+            store = read_store(self.__path)
+            if store is None:
+                store = copy.deepcopy(initial_object)
+            self.__backend.save(store, {(): None})
+        changes = self.__upgrade(store)
+        if changes:
+            self.__backend.save(store, changes)
+        self.__store = self.__track(store)
+
+    def __mark(self, changes, container, op, key):
+        '''remember in changes which part of the store a mutation changed'''
+        seg = container._seg.key
+        if seg == ():
+            if op in ('put', 'del'):
+                changes[(key,)] = None
+            else:
+                changes[()] = None
+            return
+        if seg in changes and changes[seg] is None:
+            return
+
+        if container._item is not None:
+            dirty = changes.setdefault(seg, ({}, set(), {}))
+            dirty[0][id(container._item)] = container._item
+            self.__mark_container(dirty[2], container, op, key)
+            return
+        if op == 'append':
+            key = len(container) - 1
+        elif op != 'put':
+            changes[seg] = None
+            return
+        if len(seg) == 1 and seg[0] in SEGMENTED_KEYS:
+            # a whole channel's (or dm's) messages
+            changes[(seg[0], key)] = None
+        else:
+            changes.setdefault(seg, ({}, set(), {}))[1].add(key)
+
+    @staticmethod
+    def __mark_container(containers, container, op, key):
+        '''
+        remember in containers ({id(container): [container, keys]}) which
+        keys of a container inside an item a mutation changed, or None if
+        it moved them around
+        '''
+        if op == 'append':
+            key = len(container) - 1
+        elif op != 'put' and (op != 'del' or not isinstance(container, dict)):
+            key = None
+        marked = containers.get(id(container))
+        if marked is None:
+            containers[id(container)] = [container,
+                                         None if key is None else {key}]
+        elif marked[1] is not None:
+            if key is None:
+                marked[1] = None
+            else:
+                marked[1].add(key)
+
+    def __save_changes(self):
+        '''write the changed segments to the backend, lock must be held'''
+        if not self.__changes:
+            return
+        changes = {}
+        for seg, dirty in self.__changes.items():
+            if dirty is None:
+                changes[seg] = None
+                continue
+            items, positions, _ = dirty
+            segment = self.segment(seg)
+            for item in items.values():
+                position = self.__position(segment, item)
+                if position is not None:
+                    positions.add(position)
+            changes[seg] = positions
+        self.__backend.save(self.__store, changes)
+        self.__changes = {}
+
+    def __save_json(self):
+        '''
+        write the files of the top level keys and message segments which
+        changed, then the data file if the keys or locations did, lock must
+        be held
+        '''
+        changes, self.__changes = self.__changes, {}
+        if not changes:
+            return
+        rewrite = () in changes
+        keys = self.__store.keys() if rewrite else \
+            {seg[0] for seg in changes if seg[0] not in SEGMENTED_KEYS}
+        for key in keys:
+            if key in self.__store and key not in SEGMENTED_KEYS \
+                    and key not in DERIVED_KEYS:
+                self.__files.write_key(key, json.dumps(self.__store[key]))
+                self.__key_stamps[key] = self.__files.stat_key(key)
+        for key in SEGMENTED_KEYS:
+            locations = self.__store.get(key)
+            if not isinstance(locations, list):
+                continue
+            if rewrite or (key,) in changes:
+                dirty = dict.fromkeys(range(len(locations)))
+                self.__files.prune(key, len(locations))
+                for segment in [segment for segment in self.__resident
+                                if segment.key[0] == key
+                                and segment.key[1] >= len(locations)]:
+                    self.__resize(segment, None)
+            else:
+                dirty = {seg[1]: positions for seg, positions in changes.items()
+                         if len(seg) == 2 and seg[0] == key
+                         and seg[1] < len(locations)}
+            for location_id, positions in sorted(dirty.items()):
+                if isinstance(list.__getitem__(locations, location_id),
+                              Unloaded):
+                    # still on disk, so its log is already up to date
+                    continue
+                self.__save_location(key, location_id, positions)
+
+        contents = manifest(self.__store)
+        if rewrite or contents != self.__manifest:
+            self.__write(json.dumps(contents))
+            if self.__manifest is not None:
+                for key in set(self.__manifest['keys']) - set(contents['keys']):
+                    self.__files.remove_key(key)
+            if rewrite:
+                # older versions saved them as well
+                for key in DERIVED_KEYS:
+                    self.__files.remove_key(key)
+            self.__manifest = contents
+        self.__bump_generation()
+
+    def __save_location(self, key, location_id, dirty):
+        '''
+        append the changed messages of one location to its log, or rewrite
+        the log if dirty is None
+        '''
+        messages = self.__store[key][location_id]
+        segment = self.segment((key, location_id))
+        if dirty is None:
+            size = self.__files.write(key, location_id, messages)
+        else:
+            items, positions, _ = dirty
+            for item in items.values():
+                position = self.__position(segment, item)
+                if position is not None:
+                    positions.add(position)
+            size = self.__files.put(key, location_id,
+                                    [(position, messages[position])
+                                     for position in sorted(positions)
+                                     if position < len(messages)])
+        self.__resize(segment, size)
+
+    def __unload(self, store, split, current=None):
+        '''
+        finish reading a store returned by read_main(): the top level keys
+        are read from their files, unless current already holds what is in
+        them, and each location count is swapped for Unloaded placeholders,
+        which are read when first used. A data file from before the store
+        was split up, or which still lists the keys now built from the
+        locations (DERIVED_KEYS), marks the store to be written again.
+        '''
+        saved = [key for key in DERIVED_KEYS if key in store]
+        for key in saved:
+            del store[key]
+        for key, value in store.items():
+            if isinstance(value, Unloaded):
+                stamp = self.__files.stat_key(key)
+                if current is not None and key in current \
+                        and stamp == self.__key_stamps.get(key):
+                    store[key] = current[key]
+                    continue
+                store[key] = self.__files.read_key(key)
+                self.__key_stamps[key] = stamp
+            elif key in SEGMENTED_KEYS and isinstance(value, int):
+                store[key] = [Unloaded((key, location_id))
+                              for location_id in range(value)]
+        if split and not saved:
+            self.__manifest = manifest(store)
+        else:
+            self.__changes = {(): None}
+        return store
+
+    def __load_json(self):
+        '''read the store in from the json files, the file lock must be held'''
+        # finish off anything a previous run left in the log
+        self.__recover()
+        store, split = read_main(self.__path)
+        if store is not None:
+            # load from file if not empty and exists
+            store = self.__unload(store, split)
+            self.__changes.update(self.__upgrade(store))
+            self.__store = self.__track(store)
+        else:  # else initialise it
+            self.__store = self.__track(copy.deepcopy(initial_object))
+            self.__changes = {(): None}
+        self.__generation = self.__read_generation()
+        self.__stamp = self.__stat_files()
+        if self.__changes:
+            # new, or written before messages were split into segments
+            self.__save_json()
+
+    def __upgrade(self, store):
+        '''
+        build the indexes a store written by an older version is missing,
+        returning the changes to save
+        '''
+        changes = {}
+        if not all(key in store for key in USER_INDEXES):
+            for key, index in index_users(store['users']).items():
+                if key not in store:
+                    store[key] = index
+                    changes[(key,)] = None
+        self.__index_messages(store)
+        if 'user_channels' not in store or 'user_dms' not in store:
+            for key, index in index_memberships(store['channels'],
+                                                store['dms']).items():
+                if key not in store:
+                    store[key] = index
+                    changes[(key,)] = None
+        queue = store.get('messages_later', [])
+        if any(_time_sent(queue[idx]) > _time_sent(queue[idx + 1])
+               for idx in range(len(queue) - 1)):
+            queue.sort(key=_time_sent)
+            changes[('messages_later',)] = None
+        if not isinstance(store.get('standups', {}), dict):
+            for key, index in index_standups(store['standups'],
+                                             queue).items():
+                store[key] = index
+                changes[(key,)] = None
+        if not all(key in store for key in SESSION_INDEXES):
+            indexes = index_sessions(store['sessions'], int(time.time()))
+            for key, index in indexes.items():
+                if key not in store:
+                    store[key] = index
+                    changes[(key,)] = None
+        return changes
+
+    def __index_messages(self, store):
+        '''
+        build the keys which are not saved (DERIVED_KEYS) from the
+        locations of a store just read in. Only the index of each location
+        still on disk is read, not its messages.
+        '''
+        locations = {key: [self.__files.places(*messages.key)
+                           if isinstance(messages, Unloaded)
+                           else [message_place(message)
+                                 for message in messages]
+                           for messages in store[key]]
+                     for key in SEGMENTED_KEYS}
+        store['message_index'] = index_messages(locations)
+        store['message_tombstones'] = index_tombstones(locations)
+
+    def __take_id(self, key):
+        '''the next id of this process' block for key, None once it is used'''
+        block = self.__blocks.get(key)
+        if block is None or block[2] != os.getpid():
+            # a forked child must not share its parent's ids
+            return None
+        # next() on a count is atomic, so threads need no lock here
+        value = next(block[0])
+        return value if value <= block[1] else None
+
+    def __check_blocks(self):
+        '''
+        forget the blocks of ids whose counters have gone back, as they do
+        when the whole store is replaced (clear_v1), lock must be held
+        '''
+        for key, (_, end, _) in list(self.__blocks.items()):
+            counter = self.__store.get(key)
+            if not isinstance(counter, int) or counter < end:
+                del self.__blocks[key]
+
+    def __end(self):
+        '''
+        finish the outermost transaction, releasing whatever begin() and
+        lock() took. The store's lock must be held, and is released.
+        '''
+        local = self.__local
+        local.undo = local.changes = local.unpublished = None
+        local.pending = local.deferred = None
+        try:
+            self.__leave()
+        finally:
+            self.__lock.release()
+            self.__locations.release(local.locked)
+            local.locked = []
+            self.__workspace.release(exclusive=not local.scoped)
+            local.scoped = False
+            self.__resume()
+
+    def __merge(self, changes, merged):
+        '''add the marks __mark() made in merged to those in changes'''
+        for seg, dirty in merged.items():
+            if dirty is None or changes.get(seg, ()) is None:
+                changes[seg] = None
+            elif seg in changes:
+                changes[seg][0].update(dirty[0])
+                changes[seg][1].update(dirty[1])
+                containers = changes[seg][2]
+                for container, keys in dirty[2].values():
+                    if keys is None:
+                        containers[id(container)] = [container, None]
+                        continue
+                    for key in keys:
+                        self.__mark_container(containers, container, 'put',
+                                              key)
+            else:
+                changes[seg] = dirty
+
+    def __end_shared(self):
+        '''leave a shared transaction, or one nested inside it'''
+        local = self.__local
+        local.marks.pop()
+        if not local.marks:
+            local.view = None
+
+    def __resume(self):
+        '''
+        go back to the shared transaction a transaction of its own was
+        started inside of, if any, now reading the latest snapshot
+        '''
+        local = self.__local
+        suspended = getattr(local, 'suspended', None)
+        if suspended is not None:
+            local.suspended = None
+            local.view = self.__view
+            local.marks = suspended
+
+    def __enter(self, shared):
+        '''
+        catch up with other processes at the start of an outermost
+        transaction, holding the files (or the service's write lease) until
+        it ends unless it is shared, lock must be held
+        '''
+        if self.__service is not None:
+            self.__catch_up(*self.__service.begin(self.__version,
+                                                  lease=not shared))
+            return
+        self.__lock_files(fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        self.__refresh()
+
+    def __leave(self):
+        '''release whatever __enter() took'''
+        if self.__service is not None:
+            self.__service.abort()
+        else:
+            self.__unlock_files()
+
+    def __snapshot(self):
+        '''
+        the snapshot for a shared transaction to read. It is caught up with
+        other processes first unless a writer holds the lock, in which case
+        the one its last commit published is used rather than waiting.
+        '''
+        if self.__lock.acquire(blocking=False):
+            try:
+                try:
+                    self.__enter(shared=True)
+                finally:
+                    self.__leave()
+                self.__publish()
+            finally:
+                self.__lock.release()
+        return self.__view
+
+    def __catch_up(self, version, updates):
+        '''
+        apply what other workers committed to the replica, as sent by the
+        store service: updates is a list of ops, or the whole store when the
+        replica was too far behind. lock must be held
+        '''
+        if version == self.__version:
+            return
+        if self.__changes:
+            raise AccessError(description="DATA STORE NOT SYNCED")
+        if isinstance(updates, dict):
+            self.__store = self.__track(updates)
+            self.__unpublished = {(): None}
+        else:
+            self.__replaying = True
+            try:
+                for op in updates:
+                    apply(self.__store, op)
+                    self.__mark_op(op)
+            except BaseException:
+                self.__version = 0
+                raise
+            finally:
+                self.__replaying = False
+        self.__version = version
+        self.__check_blocks()
+        self.__publish()
+
+    def __refresh(self):
+        '''
+        Catch up with whatever other processes have written to the files
+        since we last wrote or looked at them, the lock and file lock must
+        be held. Costs two stat() calls when nothing has been written.
+
+        Exceptions:
+            AccessError - Occurs when the files were changed by something
+                          other than a Datastore, or by another process
+                          while this one has changes it has not written
+        '''
+        if self.__lock_path is None:
+            return
+        stamp = self.__stat_files()
+        if stamp == self.__stamp:
+            return
+        generation = self.__read_generation()
+        if generation != self.__generation and not self.__changes:
+            self.__reload()
+        else:
+            with open(self.__path, 'r', encoding="utf8") as file:
+                file_contents = json.load(file)
+            if generation != self.__generation \
+                    or file_contents != manifest(self.__store):
+                raise AccessError(description="DATA STORE NOT SYNCED")
+        self.__generation = generation
+        self.__stamp = stamp
+
+    def __reload(self):
+        '''
+        re-read the store after another process wrote to it. Top level keys
+        whose files have not changed are kept, and every location goes back
+        to being read in when next used.
+        '''
+        previous = self.__store
+        store, split = read_main(self.__path)
+        for segment in list(self.__resident):
+            self.__resize(segment, None)
+        store = self.__unload(store, split, previous)
+        self.__index_messages(store)
+        self.__store = self.__track(store)
+        for key in set(previous) | set(self.__store):
+            if key in SEGMENTED_KEYS \
+                    or previous.get(key) is not self.__store.get(key):
+                self.__unpublished[(key,)] = None
+        self.__check_blocks()
+        self.__publish()
+
+    def __publish(self):
+        '''
+        make the store as it now is the snapshot shared transactions read,
+        copying only what changed since the last one, lock must be held
+        '''
+        changes, self.__unpublished = self.__unpublished, {}
+        store = self.__store
+        if self.__view is None or () in changes:
+            self.__view = FrozenDict({key: self.__freeze_key(key)
+                                      for key in store})
+            return
+        if not changes:
+            return
+        view = dict(self.__view)
+        copied = set()
+        # whole top level keys first, so their locations can be skipped
+        for seg, dirty in sorted(changes.items(), key=lambda c: len(c[0])):
+            key = seg[0]
+            if key not in store:
+                view.pop(key, None)
+            elif key in copied:
+                continue
+            elif key not in view or (len(seg) == 1 and dirty is None):
+                view[key] = self.__freeze_key(key)
+                copied.add(key)
+            elif len(seg) == 1:
+                view[key] = self.__patch(view[key], store[key], dirty, seg)
+            else:
+                view[key] = self.__patch_location(view[key], seg, dirty)
+        self.__view = FrozenDict(view)
+
+    def __freeze_key(self, key):
+        '''a frozen copy of store[key], leaving locations on disk there'''
+        value = self.__store[key]
+        if key in SEGMENTED_KEYS and isinstance(value, list):
+            return FrozenLocations(map(freeze, list.__iter__(value)),
+                                   self.__read_location)
+        return freeze(value)
+
+    def __patch_location(self, locations, seg, dirty):
+        '''
+        a copy of a snapshot's locations, with the location seg brought up
+        to date
+        '''
+        key, location_id = seg
+        current = self.__store[key]
+        if location_id >= len(current):
+            # removed again, which changed the whole key as well
+            return locations
+        new = FrozenLocations(list.__iter__(locations), self.__read_location)
+        value = list.__getitem__(current, location_id)
+        if location_id < len(new):
+            value = self.__patch(list.__getitem__(new, location_id), value,
+                                 dirty, seg)
+            list.__setitem__(new, location_id, value)
+        elif location_id == len(new):
+            list.append(new, self.__patch(None, value, None, seg))
+        else:
+            return self.__freeze_key(key)
+        return new
+
+    def __patch(self, old, current, dirty, seg):
+        '''
+        a frozen copy of current, the segment seg, made by changing only
+        the positions dirty says changed in old, its previous frozen copy.
+        An item which changed in place only has the containers inside it
+        which changed copied again, along with the ones holding them.
+        '''
+        if isinstance(current, Unloaded):
+            return current
+        if dirty is None or not isinstance(old, (dict, list)) \
+                or isinstance(old, dict) != isinstance(current, dict):
+            return freeze(current)
+        items, replaced, containers = dirty
+        positions = set(replaced)
+        segment = self.segment(seg)
+        for item in items.values():
+            position = self.__position(segment, item)
+            if position is not None:
+                positions.add(position)
+        changed = self.__changed(containers)
+        if isinstance(current, dict):
+            new = dict(old)
+            for position in positions:
+                if position in current:
+                    new[position] = freeze(
+                        current[position],
+                        None if position in replaced else old.get(position),
+                        changed)
+                else:
+                    new.pop(position, None)
+            return FrozenDict(new)
+        new = list(old)
+        for position in sorted(positions):
+            if position < min(len(new), len(current)):
+                new[position] = freeze(
+                    current[position],
+                    None if position in replaced else new[position], changed)
+            elif position == len(new) < len(current):
+                new.append(freeze(current[position]))
+        del new[len(current):]
+        if len(new) != len(current):
+            return freeze(current)
+        return FrozenList(new)
+
+    @staticmethod
+    def __changed(containers):
+        '''
+        the changed argument of freeze() for the containers inside items
+        which __mark_container() saw change, adding the keys leading to each
+        of them from its item
+        '''
+        changed = {}
+        for container, keys in containers.values():
+            path = find_path(container._item, container)
+            if path is None:
+                # no longer in its item, so whatever took it out changed
+                continue
+            parent = container._item
+            for key in path:
+                held = changed.setdefault(id(parent), set())
+                if held is not None:
+                    held.add(key)
+                parent = parent[key]
+            if keys is None:
+                changed[id(container)] = None
+            elif changed.setdefault(id(container), set()) is not None:
+                changed[id(container)].update(keys)
+        return changed
+
+    def __fill_view(self, seg_key, messages):
+        '''
+        put a location read in from disk into the latest snapshot, where it
+        was a placeholder, or with messages None put the placeholder back.
+        Either way the location has not changed since any snapshot sharing
+        that list was published, lock must be held.
+        '''
+        locations = self.__view.get(seg_key[0]) if self.__view else None
+        if not isinstance(locations, FrozenLocations) \
+                or seg_key[1] >= len(locations):
+            return
+        if messages is None:
+            list.__setitem__(locations, seg_key[1], Unloaded(seg_key))
+        elif isinstance(list.__getitem__(locations, seg_key[1]), Unloaded):
+            list.__setitem__(locations, seg_key[1], freeze(messages))
+
+    def __read_location(self, seg_key):
+        '''
+        read a location a snapshot still has on disk, without the lock. A
+        location is read in (and put into the snapshot) before it is
+        changed, so this only misses changes another process made.
+        '''
+        return self.__files.read(*seg_key, repair=False)[0]
+
+    def __mark_op(self, op):
+        '''remember which part of the store another worker's op changed'''
+        positions = None
+        if op[0] in ('set', 'unset'):
+            seg = (op[1],)
+        elif op[0] == 'reset':
+            seg = ()
+        else:
+            seg = tuple(op[1])
+            if op[0] in ('put', 'append_in', 'append'):
+                root = self.__store
+                for part in seg:
+                    root = root[part]
+                position = len(root) - 1 if op[0] == 'append' else op[2]
+                if len(seg) == 1 and seg[0] in SEGMENTED_KEYS:
+                    seg = (seg[0], position)
+                else:
+                    positions = {position}
+        if positions is None or self.__unpublished.get(seg, ()) is None:
+            self.__unpublished[seg] = None
+        else:
+            self.__unpublished.setdefault(seg, ({}, set(), {}))[1].update(
+                positions)
+
+    def __lock_files(self, operation):
+        '''
+        take the lock shared between processes (fcntl.LOCK_SH or LOCK_EX),
+        the lock must be held. Nested calls only count, so the outermost
+        one decides which kind of lock it is.
+        '''
+        if self.__lock_path is None:
+            return
+        if self.__file_locks == 0:
+            if self.__lock_pid != os.getpid():
+                # a forked child must not share its parent's lock
+                if self.__lock_fd is not None:
+                    os.close(self.__lock_fd)
+                self.__lock_fd = os.open(self.__lock_path,
+                                         os.O_RDWR | os.O_CREAT)
+                self.__lock_pid = os.getpid()
+            fcntl.flock(self.__lock_fd, operation)
+        self.__file_locks += 1
+
+    def __unlock_files(self):
+        '''release the lock taken by the matching __lock_files()'''
+        if self.__lock_path is None or self.__file_locks == 0:
+            return
+        self.__file_locks -= 1
+        if self.__file_locks == 0:
+            fcntl.flock(self.__lock_fd, fcntl.LOCK_UN)
+
+    def __unloaded(self, value):
+        '''json encoder hook reading in segments which are still on disk'''
+        if isinstance(value, Unloaded):
+            return self.__files.read(*value.key)[0]
+        raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+    def __resize(self, segment, size):
+        '''
+        record how big a message segment in memory is, or with a size of
+        None that it is no longer in memory
+        '''
+        self.__resident_size -= self.__resident.pop(segment, 0)
+        if size is not None:
+            self.__resident[segment] = size
+            self.__resident_size += size
+
+    def __evict(self):
+        '''
+        drop the least recently used message segments from memory until they
+        fit in the cache again, lock must be held outside any transaction
+        '''
+        if self.__backend is not None or self.__service is not None \
+                or self.__resident_size <= self.__cache_size:
+            return
+        for segment in list(self.__resident):
+            if self.__resident_size <= self.__cache_size:
+                break
+            if not self.__is_clean(segment.key):
+                continue
+            key, location_id = segment.key
+            locations = self.__store.get(key)
+            if isinstance(locations, list) and location_id < len(locations):
+                list.__setitem__(locations, location_id,
+                                 Unloaded(segment.key))
+            self.__fill_view(segment.key, None)
+            self.__resize(segment, None)
+
+    def __is_clean(self, seg_key):
+        '''whether a segment's file on disk is up to date'''
+        for pending in (self.__changes, self.__unfolded, self.__folding):
+            if seg_key in pending or seg_key[:1] in pending or () in pending:
+                return False
+        # a scoped transaction may be changing it
+        return not self.__locations.held(seg_key)
+
+    def __start_flusher(self):
+        '''start the write behind thread the first time the store is dirtied'''
+        if self.__flusher is None and not self.__closing.is_set():
+            self.__flusher = threading.Thread(target=self.__run_flusher,
+                                              name='data_store-flusher',
+                                              daemon=True)
+            self.__flusher.start()
+
+    def __run_flusher(self):
+        '''flush every flush_interval seconds until close() is called'''
+        while not self.__closing.wait(self.__flush_interval):
+            self.flush()
+
+    def __start_compactor(self):
+        '''rotate the log and fold it into the data file in the background'''
+        if self.__closing.is_set():
+            return
+        if not self.__fold_lock.acquire(blocking=False):
+            # already being compacted
+            return
+        self.__rotate()
+        self.__compactor = threading.Thread(target=self.__run_compactor,
+                                            name='data_store-compactor',
+                                            daemon=True)
+        self.__compactor.start()
+
+    def __run_compactor(self):
+        '''fold the rotated log, then let the next compaction start'''
+        try:
+            self.__fold_old_wal()
+        finally:
+            self.__fold_lock.release()
+
+    def __persist_pending(self):
+        '''write the changes made since the last commit to the log'''
+        # the segments changed are out of date on disk until the log is
+        # folded in
+        self.__unfolded.update(self.__changes)
+        self.__changes = {}
+        if not self.__pending:
+            return None
+        lsn = self.__wal.append(self.__pending)
+        self.__pending = []
+        return lsn
+
+    def __rotate(self):
+        '''move the log to <log>.old, ready to be folded, lock must be held'''
+        self.__wal.rotate(self.__old_wal_path())
+        self.__folding.update(self.__unfolded)
+        self.__unfolded = set()
+
+    def __record(self, container, op, key, value):
+        '''translate a container mutation into a log op, see wal.py'''
+        seg = container._seg
+        item = container._item
+        if seg.key == ():
+            if op == 'put':
+                return ['set', key, value]
+            if op == 'del':
+                return ['unset', key]
+            return ['reset', container]
+
+        if item is None:
+            if op in ('put', 'insert'):
+                return [op, seg.key, key, value]
+            if op == 'append':
+                return ['append', seg.key, value]
+            if op == 'del':
+                return ['del', seg.key, key]
+            if op == 'clear':
+                return ['clear', seg.key]
+            return ['replace', seg.key, container]
+
+        position = self.__position(seg, item)
+        if position is None:
+            # the item has already been removed from the store
+            return None
+        if op == 'append':
+            path = find_path(item, container)
+            if path is not None:
+                return ['append_in', seg.key, position, path, value]
+        return ['put', seg.key, position, item]
+
+    def __position(self, seg, item):
+        '''find where an item currently is within its segment'''
+        root = self.__store
+        for part in seg.key:
+            root = root[part]
+
+        # keyed by segment too, as a gone item's id can be reused by an item
+        # of another segment, which may be a dict where this was a list
+        position = self.__positions.get((seg.key, id(item)))
+        if position is not None:
+            try:
+                if root[position] is item:
+                    return position
+            except (IndexError, KeyError, TypeError):
+                pass
+
+        if isinstance(root, dict):
+            candidates = list(root.keys())
+        else:
+            candidates = range(len(root) - 1, -1, -1)
+        for position in candidates:
+            if root[position] is item:
+                if len(self.__positions) > POSITION_CACHE_SIZE:
+                    self.__positions = {}
+                self.__positions[(seg.key, id(item))] = position
+                return position
+        return None
+
+    def __old_wal_path(self):
+        '''the log being folded into the data file'''
+        return self.__wal_path + '.old'
+
+    def __recover(self):
+        '''
+        Bring the data file up to date with any log left by a previous run.
+
+        Folding the log is done in three steps, each of which is atomic:
+            1. the log is renamed to <log>.old
+            2. the segment files and data file with <log>.old applied are
+               written to <file>.new
+            3. <log>.old is deleted, then each <file>.new renamed over its
+               file, the data file last
+        so <log>.old existing means step 3 never started and no file
+        includes it, while <data>.new existing on its own means only the
+        final renames are missing.
+        '''
+        if exists(self.__old_wal_path()):
+            self.__files.discard_staged()
+            self.__fold_old_wal()
+        elif exists(self.__path + '.new'):
+            self.__files.commit_staged()
+            os.replace(self.__path + '.new', self.__path)
+
+        if exists(self.__wal_path) and os.stat(self.__wal_path).st_size != 0:
+            os.replace(self.__wal_path, self.__old_wal_path())
+            self.__fold_old_wal()
+
+    def __fold_old_wal(self):
+        '''
+        apply <log>.old to the files on disk, reading and writing only the
+        top level keys and locations it changes
+        '''
+        old_path = self.__old_wal_path()
+        new_path = self.__path + '.new'
+        records = read_records(old_path)
+        store, _ = read_main(self.__path)
+        if store is None:
+            store = copy.deepcopy(initial_object)
+        previous = set(store)
+        for key in DERIVED_KEYS:
+            store.pop(key, None)
+        touched = set()
+        for ops in records:
+            for op in ops:
+                if op[0] in ('set', 'unset'):
+                    touched.add(op[1])
+                elif op[0] != 'reset':
+                    touched.add(op[1][0])
+        # the ops made on the keys which are not saved are only replayed by
+        # the store service's workers
+        records = [[op for op in ops if op[0] == 'reset'
+                    or (op[1] if op[0] in ('set', 'unset') else op[1][0])
+                    not in DERIVED_KEYS]
+                   for ops in records]
+        stored = {}
+        for key, value in store.items():
+            if isinstance(value, Unloaded) and key in touched:
+                store[key] = self.__files.read_key(key)
+            elif key in SEGMENTED_KEYS and isinstance(value, int):
+                stored[key] = value
+                store[key] = LazyLocations(self.__files, key, value)
+
+        for ops in records:
+            for op in ops:
+                apply(store, op)
+        for key in DERIVED_KEYS:
+            store.pop(key, None)
+
+        staged = []
+        for key, value in store.items():
+            if key not in SEGMENTED_KEYS:
+                if not isinstance(value, Unloaded):
+                    staged.append(self.__files.stage_key(key,
+                                                         json.dumps(value)))
+                continue
+            if isinstance(value, LazyLocations):
+                dirty = value.touched
+                value = value.locations
+            else:
+                dirty = range(len(value))
+                stored[key] = None
+            for location_id in sorted(dirty):
+                staged.extend(self.__files.stage(key, location_id,
+                                                 value[location_id]))
+
+        with open(new_path, 'w', encoding="utf8") as file:
+            file.write(json.dumps(manifest(store)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.remove(old_path)
+        self.__files.commit_staged(staged)
+        os.replace(new_path, self.__path)
+        for key in previous - set(store):
+            if key not in SEGMENTED_KEYS:
+                self.__files.remove_key(key)
+        for key, count in stored.items():
+            if key in store and (count is None or len(store[key]) < count):
+                self.__files.prune(key, len(store[key]))
+        with self.__lock:
+            self.__folding = set()
+            self.__bump_generation()
+
+    def __read_generation(self):
+        '''the generation of the files on disk, 0 if never written'''
+        try:
+            with open(self.__generation_path, 'r', encoding="utf8") as file:
+                return int(file.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def __bump_generation(self):
+        '''
+        stamp the files just written with the next generation, lock must be
+        held
+        '''
+        self.__generation = max(self.__generation,
+                                self.__read_generation()) + 1
+        tmp_path = f'{self.__generation_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding="utf8") as file:
+            file.write(str(self.__generation))
+        os.replace(tmp_path, self.__generation_path)
+        self.__stamp = self.__stat_files()
+
+    def __stat_files(self):
+        '''
+        what stat() says about the data file and generation file, which
+        both get a new inode whenever they are written
+        '''
+        stamp = []
+        for path in (self.__path, self.__generation_path):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stamp.append(None)
+            else:
+                stamp.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        return stamp
+
+    def __write(self, contents):
+        '''atomically replace the data file with contents'''
+        tmp_path = f'{self.__path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding="utf8") as file:
+            file.write(contents)
+        os.replace(tmp_path, self.__path)
+
+
+def id_block_size():
+    '''
+    How many ids each process reserves at a time, see Datastore.next_id()
+
+    Return Value:
+        Returns config.id_block_size (int), or when that is None 1 if there
+        is more than one worker, so ids stay in order, else 100
+    '''
+    if config.id_block_size is None:
+        return 1 if config.workers > 1 else 100
+    return max(config.id_block_size, 1)
+
+
+def transactional(function):
+    '''
+    Decorator which runs function inside a data_store transaction, so all of
+    the set() calls it makes are committed together
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with data_store.transaction():
+            return function(*args, **kwargs)
+    return wrapper
+
 
 print('Loading Datastore...')
 
 global data_store
 data_store = Datastore()
+atexit.register(data_store.close)
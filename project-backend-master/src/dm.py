@@ -17,7 +17,10 @@ import jwt
 
 from src.data_store import data_store
 from src.notifications import generate_notifcation
-from src.data_store import U_PFP_IDX, data_store
+from src.data_store import U_PFP_IDX, clear_messages, data_store, \
+    transactional, user_by_id
+from src.data_store import add_membership, dm_by_id, is_dm_member, memberships, \
+    remove_membership
 from src.verify_session import verify_session
 from src.data_store import U_ID_IDX, U_EMAIL_IDX, U_NAME_FIRST_IDX, U_NAME_LAST_IDX, U_HANDLE_IDX
 from src.data_store import DM_ID_IDX, DM_OWN_IDX, DM_MEMBERS_IDX, DM_NAME_IDX
@@ -25,6 +28,7 @@ from src.error import InputError
 from src.error import AccessError
 from src.verify_session import verify_session
 from src.other import check_dm_id
+from src.render import render_messages
 from datetime import datetime
 from src.stats import update_dm_stats, update_workplace_dm_stats, update_workplace_msg_stats
 
@@ -52,22 +56,21 @@ def find_user(u_id):
     '''
 
     store = data_store.get()
-    users = store['users']
+    entry = user_by_id(store, u_id)
     user_info = []
 
-    for entry in users:
-        if entry[U_ID_IDX] == u_id and u_id not in store['removed_users']:
-            user_info.append(entry[U_ID_IDX])
-            user_info.append(entry[U_EMAIL_IDX])
-            user_info.append(entry[U_NAME_FIRST_IDX])
-            user_info.append(entry[U_NAME_LAST_IDX])
-            user_info.append(entry[U_HANDLE_IDX])
-            user_info.append(entry[U_PFP_IDX])
-            break
+    if entry is not None and u_id not in store['removed_users']:
+        user_info.append(entry[U_ID_IDX])
+        user_info.append(entry[U_EMAIL_IDX])
+        user_info.append(entry[U_NAME_FIRST_IDX])
+        user_info.append(entry[U_NAME_LAST_IDX])
+        user_info.append(entry[U_HANDLE_IDX])
+        user_info.append(entry[U_PFP_IDX])
 
     return user_info
 
 
+@transactional
 def dm_create_v1(token, u_ids):
     '''
     Creates a new direct message instance between users
@@ -100,11 +103,6 @@ def dm_create_v1(token, u_ids):
     new_dm_id = len(store['dms']) + 1
 
     # Add the creator of the channel to the list of owners and members
-
-    owner = jwt.decode(token, SECRET, algorithms='HS256')
-    owner_info = find_user(owner['auth_user_id'])
-    owner_dict = {'owner_info': owner_info, 'status': 'present', }
-
     whole_user_list = u_ids
     whole_user_list.append(owner_dict['owner_info'][0])
 
@@ -126,6 +124,8 @@ def dm_create_v1(token, u_ids):
 
     store['dms'].append(
         [new_dm_id, owner_dict, member_list, dm_handle, dm_msg])
+    for member_info in member_list:
+        add_membership(store, 'user_dms', member_info[U_ID_IDX], new_dm_id)
 
     store['dm_messages'].append([])
     store['wordle_dm'].append({})
@@ -166,12 +166,10 @@ def dm_list_v1(token):
 
     all_dms = []
 
-    for dm in store['dms']:
-        for member in dm[DM_MEMBERS_IDX]:
-            if user['auth_user_id'] == member[0]:
-                dm_info = {'dm_id': dm[DM_ID_IDX], 'name': dm[DM_NAME_IDX]}
-                all_dms.append(dm_info)
-                break
+    for dm_id in memberships(store, 'user_dms', user['auth_user_id']):
+        dm = dm_by_id(store, dm_id)
+        dm_info = {'dm_id': dm[DM_ID_IDX], 'name': dm[DM_NAME_IDX]}
+        all_dms.append(dm_info)
 
     return {
         'dms': all_dms,
@@ -224,6 +222,8 @@ def dm_remove_v1(token, dm_id):
 
             # patch applied to dm_id to prevent it from being loaded
             store = data_store.get()
+            for member in dm[DM_MEMBERS_IDX]:
+                remove_membership(store, 'user_dms', member[U_ID_IDX], dm_id)
             dm[DM_MEMBERS_IDX].clear()
             break
 
@@ -231,9 +231,7 @@ def dm_remove_v1(token, dm_id):
         raise InputError(description='Invalid dm_id inserted')
 
     # clear all the messages associated with the dm
-    num_msgs = len(store['dm_messages'][dm_id])
-    # clear the messages associated with the dm
-    store['dm_messages'][dm_id].clear()
+    num_msgs = clear_messages(store, 'dm_messages', dm_id)
     data_store.set(store)
     # change stats about message and dm
     update_workplace_dm_stats(False)
@@ -272,11 +270,7 @@ def dm_details_v1(token, dm_id):
     for dm in store['dms']:
         if dm[DM_ID_IDX] == dm_id:
             dm_id_valid = True
-            member_valid = False
-            for member in dm[DM_MEMBERS_IDX]:
-                if member[0] == user['auth_user_id']:
-                    member_valid = True
-                    break
+            member_valid = is_dm_member(store, user['auth_user_id'], dm_id)
             if member_valid == False:
                 raise AccessError(
                     description='This user is either not a member or has left the DM')
@@ -357,6 +351,7 @@ def dm_leave_v1(token, dm_id):
                 dm[DM_MEMBERS_IDX].remove(dm_member)
             else:
                 dm[DM_MEMBERS_IDX].remove(dm_member)
+            remove_membership(store, 'user_dms', auth_user_id, dm_id)
 
             break
 
@@ -387,21 +382,17 @@ def dm_messages_v1(auth_user_id, dm_id, start):
     Return Value:
         Returns dm messages (list of dictionaries), start(int), end(int)
     '''
-    store = data_store.get()
-    DM_MEM_ID_IDX = 0
-
    # Helper function to check if ID is valid
     dm = check_dm_id(dm_id)
 
-    is_member = False
-    for member in dm[DM_MEMBERS_IDX]:
-        if member[DM_MEM_ID_IDX] == auth_user_id:
-            is_member = True
+    is_member = is_dm_member(data_store.get(), auth_user_id, dm[DM_ID_IDX])
 
     if is_member == False and auth_user_id:
         raise AccessError(description="You are not a member of this dm")
 
-    total_messages = len(store['dm_messages'][dm_id])
+    # only the page is read if the messages are not in memory
+    total_messages, recent_messages = data_store.recent_messages(
+        'dm_messages', dm_id, start, 50)
 
     if total_messages == 0 and start > total_messages:
         raise InputError(
@@ -411,26 +402,16 @@ def dm_messages_v1(auth_user_id, dm_id, start):
         raise InputError(
             description="You have set a start larger than the total number of messages")
 
-    page_of_messages = []
     time_now = int(datetime.timestamp(datetime.now()))
-    for idx, message in enumerate(reversed(store['dm_messages'][dm_id])):
-        if start <= idx < start + 50:
-            if message['time_sent'] <= time_now:
-                page_of_messages.append(message)
+    page_of_messages = render_messages(
+        [message for message in recent_messages
+         if message['time_sent'] <= time_now], auth_user_id)
 
     if total_messages - start < 50:
         end = -1
     else:
         end = start + 50
 
-    for msg_idx, message in enumerate(page_of_messages):
-        for r_idx, react in enumerate(message['reacts']):
-            for u_id in react['u_ids']:
-                if u_id == auth_user_id:
-                    page_of_messages[msg_idx]['reacts'][r_idx]['is_this_user_reacted'] = True
-                else:
-                    page_of_messages[msg_idx]['reacts'][r_idx]['is_this_user_reacted'] = False
-
     return {
         'messages': page_of_messages,
         'start': start,
@@ -284,6 +284,8 @@ def check_wordle(token, channel_id, message, ID, share):
     call for a wordle process to be called'''
     message_split = message.split()
     if len(message_split) > 0 and message_split[0] == "/wordle":
+        # a game keeps its state outside the channel's or dm's messages
+        data_store.lock()
         wordle_guess(token, channel_id, message, ID, share)
         return True
     else:
@@ -0,0 +1,100 @@
+'''
+locks.py:
+
+The locks which let transactions that change different parts of the store
+run at the same time (see Datastore.begin()). They form a hierarchy:
+
+    WorkspaceLock       held exclusively by a transaction which may change
+                        anything (creating users and channels, joining,
+                        leaving, ...), and shared by scoped transactions
+    LocationLocks       one lock per channel or dm, taken by a scoped
+                        transaction before it changes that location's
+                        messages
+
+A scoped transaction takes the workspace lock first and its locations
+after, in ascending order of their keys, so no two transactions can ever
+wait for each other.
+
+Classes:
+    WorkspaceLock
+    LocationLocks
+'''
+import threading
+
+
+class WorkspaceLock:
+    '''
+    A readers-writer lock
+    member function:
+        acquire(exclusive)
+        release(exclusive)
+
+    A thread waiting to take it exclusively holds up new shared holders,
+    so a stream of scoped transactions cannot starve the others.
+    '''
+
+    def __init__(self):
+        self.__condition = threading.Condition(threading.Lock())
+        self.__shared = 0
+        self.__exclusive = False
+        self.__waiting = 0
+
+    def acquire(self, exclusive):
+        '''take the lock, exclusively or shared'''
+        with self.__condition:
+            if exclusive:
+                self.__waiting += 1
+                try:
+                    self.__condition.wait_for(
+                        lambda: not self.__exclusive and not self.__shared)
+                finally:
+                    self.__waiting -= 1
+                self.__exclusive = True
+            else:
+                self.__condition.wait_for(
+                    lambda: not self.__exclusive and not self.__waiting)
+                self.__shared += 1
+
+    def release(self, exclusive):
+        '''release the lock taken by the matching acquire()'''
+        with self.__condition:
+            if exclusive:
+                self.__exclusive = False
+            else:
+                self.__shared -= 1
+            self.__condition.notify_all()
+
+
+class LocationLocks:
+    '''
+    A lock for each location, named by its segment key, e.g.
+    ('messages', channel_id)
+    member function:
+        acquire(keys)
+        release(keys)
+        held(key)
+    '''
+
+    def __init__(self):
+        self.__condition = threading.Condition(threading.Lock())
+        self.__held = set()
+
+    def acquire(self, keys):
+        '''take the locks of keys, one at a time in the order given'''
+        for key in keys:
+            with self.__condition:
+                self.__condition.wait_for(
+                    lambda key=key: key not in self.__held)
+                self.__held.add(key)
+
+    def release(self, keys):
+        '''release the locks of keys'''
+        if not keys:
+            return
+        with self.__condition:
+            self.__held.difference_update(keys)
+            self.__condition.notify_all()
+
+    def held(self, key):
+        '''whether some transaction holds the lock of key'''
+        return key in self.__held
@@ -11,19 +11,26 @@ Functions:
     message_sendlater_v1(token, channel_id, message, time_sent)
     message_sendlaterdm_v1(token, dm_id, message, time_sent)
     check_message_send_later(token)
+    send_messages_later(now)
+    later_jobs()
+    later_metrics(token)
     message_edit_v1(token, message_id, message)
     message_react_unreact_v1(token, message_id, react_id, unreact)
+    lock_message(store, message_id)
     message_share_v1(token, og_message_id, message, channel_id, dm_id)
 '''
 
 from email import message
 from os import access
 from src.notifications import generate_notifcation
-from src.data_store import CH_ID_IDX, CH_MEMBER_IDX, CH_NAME_IDX, CH_OWN_IDX, \
-    DM_ID_IDX, DM_MEMBERS_IDX, DM_NAME_IDX, DM_OWN_IDX, M_U_ID_IDX, U_ID_IDX, data_store, U_HANDLE_IDX
+from src.data_store import CH_ID_IDX, CH_NAME_IDX, CH_OWN_IDX, \
+    DM_ID_IDX, DM_MEMBERS_IDX, DM_NAME_IDX, DM_OWN_IDX, M_U_ID_IDX, U_ID_IDX, data_store, transactional, \
+    channel_by_id, count_due, dm_by_id, find_message, finish_standup, index_message, is_channel_member, is_dm_member, \
+    memberships, queue_message, record_removal, tombstone_message, user_by_handle
 from src.error import InputError, AccessError
 from datetime import datetime
 from src.verify_session import verify_session
+from src.scheduler import Scheduler
 from src.stats import update_msgs_stats, update_workplace_msg_stats
 
 
@@ -63,44 +70,29 @@ def message_pin_unpin(token, message_id, is_pinned):
     # is_pinned = False = unpin
     store = data_store.get()
     auth_id = verify_session(token)
+    lock_message(store, message_id)
 
-    message_lists = (store['messages'], store['dm_messages'])
-    message_found = False
     raise_error = False
     inputerror = "Invalid message id"
     accesserror = ""
-    found_entry = None
-    message_loc = 0
-    # Checking both ch and dm messages
-    for message_list in message_lists:
-        # Checking within a list for ch or dm
-        for idx, channel in enumerate(message_list):
-            for message in channel:
-                if message['message_id'] == message_id and message['is_pinned'] != is_pinned:
-                    message_found = True
-                    found_entry = message
-                    loc_id = idx
-                    message_loc = message_list
-                elif message['message_id'] == message_id and message['is_pinned'] == is_pinned:
-                    inputerror = "Message already pinned!"
-                    message_found = True
-                    raise_error = True
-                    loc_id = idx
-                    message_loc = message_list
-
-    if message_found == False:
+    # Finding the message in its channel or dm
+    found = find_message(store, message_id)
+    if found is None:
+        raise InputError(description=inputerror)
+    message_loc, loc_id, found_entry = found
+    if found_entry['is_pinned'] == is_pinned:
+        inputerror = "Message already pinned!"
         raise_error = True
+
     # do acces error check
-    if message_loc == store['messages']:
-        for channel in store['channels']:
-            if channel[CH_ID_IDX] == loc_id and auth_id not in channel[CH_OWN_IDX]:
-                raise_error = True
-                accesserror = "You are not authorised to pin this dm"
-    elif message_loc == store['dm_messages']:
-        for dm in store['dms']:
-            if dm[DM_ID_IDX] == loc_id and auth_id != dm[DM_OWN_IDX]['owner_info'][0]:
-                raise_error = True
-                accesserror = "You are not authorised to pin this dm"
+    if message_loc == 'messages':
+        if auth_id not in channel_by_id(store, loc_id)[CH_OWN_IDX]:
+            raise_error = True
+            accesserror = "You are not authorised to pin this dm"
+    else:
+        if auth_id != dm_by_id(store, loc_id)[DM_OWN_IDX]['owner_info'][0]:
+            raise_error = True
+            accesserror = "You are not authorised to pin this dm"
     #raise erros
     if raise_error == True and accesserror != "":
         raise AccessError(description=accesserror)
@@ -114,6 +106,7 @@ def message_pin_unpin(token, message_id, is_pinned):
     return {}
 
 
+@transactional
 def message_send_v1(token, channel_id, message, share):
     '''
     Take in an authenticated token, channel id and message, send the message to the channel, then
@@ -136,19 +129,10 @@ def message_send_v1(token, channel_id, message, share):
     auth_id = verify_session(token)
     store = data_store.get()
 
-    ch_id_idx = 0
-    ch_member_idx = 4
-    valid_ch_id = False
-    in_channel = False
     # Validating channel
-    for channel in store['channels']:
-        if channel[ch_id_idx] == channel_id:
-            valid_ch_id = True
-            for user_id in channel[ch_member_idx]:
-                if user_id == auth_id:
-                    in_channel = True
-                    break
-            break
+    channel = channel_by_id(store, channel_id)
+    valid_ch_id = channel is not None
+    in_channel = valid_ch_id and is_channel_member(store, auth_id, channel_id)
 
     if valid_ch_id is False:
         raise InputError(
@@ -164,8 +148,8 @@ def message_send_v1(token, channel_id, message, share):
                 than 1000 characters")
 
     # Generate message id and store message data in the data store:
-    message_id = store['message_counter'] + 1
-    store['message_counter'] = message_id
+    data_store.lock(('messages', channel_id))
+    message_id = data_store.next_id('message_counter')
     time_sent = int(datetime.timestamp(datetime.now()))
 
     reacts_data = []
@@ -184,21 +168,24 @@ def message_send_v1(token, channel_id, message, share):
     # generates notifications for everone tagged in the message
     for handle in tags:
         # find user in data store and then generate notifcation
-        for user in store['users']:
-            if user[U_HANDLE_IDX] == handle:
-                generate_notifcation(channel[CH_ID_IDX], -1,
-                                     1, auth_id, user[U_ID_IDX], channel[CH_NAME_IDX], message)
+        user = user_by_handle(store, handle)
+        if user is not None:
+            data_store.defer(generate_notifcation, channel[CH_ID_IDX], -1,
+                             1, auth_id, user[U_ID_IDX], channel[CH_NAME_IDX], message)
 
     store['messages'][channel_id].append(message_data)
     data_store.set(store)
 
-    update_msgs_stats(auth_id, time_sent)
-    update_workplace_msg_stats(True, 1)
+    data_store.defer(index_message, store, message_id, 'messages', channel_id,
+                     len(store['messages'][channel_id]) - 1)
+    data_store.defer(update_msgs_stats, auth_id, time_sent)
+    data_store.defer(update_workplace_msg_stats, True, 1)
     return {
         'message_id': message_id,
     }
 
 
+@transactional
 def message_senddm_v1(token, dm_id, message, share):
     '''
     Take in an authenticated token, dm id and message, send the message to the dm, then
@@ -220,18 +207,10 @@ def message_senddm_v1(token, dm_id, message, share):
     '''
     auth_id = verify_session(token)
     store = data_store.get()
-    DM_M_ID_IDX = 0
-    valid_dm_id = False
-    in_dm = False
     # Check if the provided dm_id is valid, and if the user is in it
-    for dm in store['dms']:
-        if dm[DM_ID_IDX] == dm_id:
-            valid_dm_id = True
-            for user_id in dm[DM_MEMBERS_IDX]:
-                if user_id[DM_M_ID_IDX] == auth_id:
-                    in_dm = True
-                    break
-            break
+    dm = dm_by_id(store, dm_id)
+    valid_dm_id = dm is not None
+    in_dm = valid_dm_id and is_dm_member(store, auth_id, dm_id)
 
     if valid_dm_id is False:
         raise InputError(
@@ -246,8 +225,8 @@ def message_senddm_v1(token, dm_id, message, share):
                 than 1000 characters")
 
     # Generate message id and store message data in the data store:
-    message_id = store['message_counter'] + 1
-    store['message_counter'] = message_id
+    data_store.lock(('dm_messages', dm_id))
+    message_id = data_store.next_id('message_counter')
     time_sent = int(datetime.timestamp(datetime.now()))
 
     reacts_data = []
@@ -265,15 +244,17 @@ def message_senddm_v1(token, dm_id, message, share):
     # generates notifications for everone tagged in the message
     for handle in tags:
         # find user in data store and then generate notifcation
-        for user in store['users']:
-            if user[U_HANDLE_IDX] == handle:
-                generate_notifcation(-1, dm[DM_ID_IDX],
-                                     1, auth_id, user[U_ID_IDX], dm[DM_NAME_IDX], message)
+        user = user_by_handle(store, handle)
+        if user is not None:
+            data_store.defer(generate_notifcation, -1, dm[DM_ID_IDX],
+                             1, auth_id, user[U_ID_IDX], dm[DM_NAME_IDX], message)
 
     store['dm_messages'][dm_id].append(message_data)
     data_store.set(store)
-    update_msgs_stats(auth_id, time_sent)
-    update_workplace_msg_stats(True, 1)
+    data_store.defer(index_message, store, message_id, 'dm_messages', dm_id,
+                     len(store['dm_messages'][dm_id]) - 1)
+    data_store.defer(update_msgs_stats, auth_id, time_sent)
+    data_store.defer(update_workplace_msg_stats, True, 1)
     return {
         'message_id': message_id,
     }
@@ -302,19 +283,10 @@ def message_sendlater_v1(token, channel_id, message, time_sent):
     '''
     auth_id = verify_session(token)
     store = data_store.get()
-    ch_id_idx = 0
-    ch_member_idx = 4
-    valid_ch_id = False
-    in_channel = False
     # Validating channel
-    for channel in store['channels']:
-        if channel[ch_id_idx] == channel_id:
-            valid_ch_id = True
-            for user_id in channel[ch_member_idx]:
-                if user_id == auth_id:
-                    in_channel = True
-                    break
-            break
+    channel = channel_by_id(store, channel_id)
+    valid_ch_id = channel is not None
+    in_channel = valid_ch_id and is_channel_member(store, auth_id, channel_id)
 
     if valid_ch_id is False:
         raise InputError(
@@ -334,8 +306,7 @@ def message_sendlater_v1(token, channel_id, message, time_sent):
         raise InputError(
             description="Invalid time_sent. It cannot be in the past")
     # Generate message id and store message data in the data store:
-    message_id = store['message_counter'] + 1
-    store['message_counter'] = message_id
+    message_id = data_store.next_id('message_counter')
 
     reacts_data = []
 
@@ -359,13 +330,14 @@ def message_sendlater_v1(token, channel_id, message, time_sent):
 
     for handle in tags:
         # find user in data store and then generate notifcation
-        for user in store['users']:
-            if user[U_HANDLE_IDX] == handle:
-                generate_notifcation(channel[CH_ID_IDX], -1,
-                                     1, auth_id, user[U_ID_IDX], channel[CH_NAME_IDX], message)
+        user = user_by_handle(store, handle)
+        if user is not None:
+            generate_notifcation(channel[CH_ID_IDX], -1,
+                                 1, auth_id, user[U_ID_IDX], channel[CH_NAME_IDX], message)
 
-    store['messages_later'].append(msg_info)
+    queue_message(store, msg_info)
     data_store.set(store)
+    scheduler.schedule(time_sent, message_id)
 
     return {
         'message_id': message_id,
@@ -395,18 +367,10 @@ def message_sendlaterdm_v1(token, dm_id, message, time_sent):
     '''
     auth_id = verify_session(token)
     store = data_store.get()
-    DM_M_ID_IDX = 0
-    valid_dm_id = False
-    in_dm = False
     # Check if the provided dm_id is valid, and if the user is in it
-    for dm in store['dms']:
-        if dm[DM_ID_IDX] == dm_id:
-            valid_dm_id = True
-            for user_id in dm[DM_MEMBERS_IDX]:
-                if user_id[DM_M_ID_IDX] == auth_id:
-                    in_dm = True
-                    break
-            break
+    dm = dm_by_id(store, dm_id)
+    valid_dm_id = dm is not None
+    in_dm = valid_dm_id and is_dm_member(store, auth_id, dm_id)
 
     if valid_dm_id is False:
         raise InputError(
@@ -425,8 +389,7 @@ def message_sendlaterdm_v1(token, dm_id, message, time_sent):
             description="Invalid time_sent. It cannot be in the past")
 
     # Generate message id and store message data in the data store:
-    message_id = store['message_counter'] + 1
-    store['message_counter'] = message_id
+    message_id = data_store.next_id('message_counter')
 
     reacts_data = []
 
@@ -448,13 +411,14 @@ def message_sendlaterdm_v1(token, dm_id, message, time_sent):
 
     for handle in tags:
         # find user in data store and then generate notifcation
-        for user in store['users']:
-            if user[U_HANDLE_IDX] == handle:
-                generate_notifcation(-1, dm[DM_ID_IDX],
-                                     1, auth_id, user[U_ID_IDX], dm[DM_NAME_IDX], message)
+        user = user_by_handle(store, handle)
+        if user is not None:
+            generate_notifcation(-1, dm[DM_ID_IDX],
+                                 1, auth_id, user[U_ID_IDX], dm[DM_NAME_IDX], message)
 
-    store['messages_later'].append(msg_info)
+    queue_message(store, msg_info)
     data_store.set(store)
+    scheduler.schedule(time_sent, message_id)
 
     return {
         'message_id': message_id,
@@ -463,9 +427,9 @@ def message_sendlaterdm_v1(token, dm_id, message, time_sent):
 
 def check_message_send_later(token):
     '''
-    Helper function that checks whether any messages are ready to be sent to a channel yet.
-    This should be called before any function that adds things to messages to see if there
-    should be any messages in a queue that need to be sent beforehand.
+    Helper function that sends any messages which are due without waiting for the
+    scheduler's thread to wake up. Requests no longer need to call it, as the scheduler
+    sends each message at its time_sent.
 
     Arguments:
         token (str) - A unique token which identifies an authenticated user
@@ -477,39 +441,118 @@ def check_message_send_later(token):
         Null  
     '''
     verify_session(token)
+    scheduler.run_due(datetime.timestamp(datetime.now()))
+    return {}
+
+
+@transactional
+def send_messages_later(now):
+    '''
+    Helper function that sends every message in the queue whose time to be
+    sent is at or before now, as a transaction of its own.
+
+    Arguments:
+        now (float) - The current unix timestamp
+
+    Return value:
+        Null
+    '''
+    # delivering can touch any channel or dm
+    data_store.lock()
     store = data_store.get()
     msgs = store['messages_later']
-    # sort based on the time sent
-    now = int(datetime.timestamp(datetime.now()))
-    sorted_msgs = sorted(msgs, key=lambda x: x['message_data']['time_sent'])
-
-    for message in sorted_msgs:
-        # send the message if the time has passed.
-        if message['message_data']['time_sent'] <= now:
-            time_sent = message['message_data']['time_sent']
-            location_id = message['location_id']
-            sender_id = message['message_data']['u_id']
-            if message['channel'] is True and len(message['message_data']['message']) > 0:
-                store['messages'][location_id].append(message['message_data'])
+    # the queue is in order of time_sent, so those due are at the front
+    num_due = count_due(store, now)
+    if num_due == 0:
+        return {}
+
+    for message in msgs[:num_due]:
+        time_sent = message['message_data']['time_sent']
+        location_id = message['location_id']
+        sender_id = message['message_data']['u_id']
+        if message['channel'] is True:
+            # a standup's message is everything sent to it while it ran
+            standup = finish_standup(store, location_id,
+                                     message['message_data']['message_id'])
+            if standup is not None:
+                message['message_data']['message'] = standup
+        if message['channel'] is True and len(message['message_data']['message']) > 0:
+            store['messages'][location_id].append(message['message_data'])
+            index_message(store, message['message_data']['message_id'],
+                          'messages', location_id,
+                          len(store['messages'][location_id]) - 1)
+            data_store.set(store)
+            update_msgs_stats(sender_id, time_sent)
+            update_workplace_msg_stats(True, 1)
+        if message['channel'] is False:
+            dm_id = message['location_id']
+            # check if dm has been removed. If it hasn't send the message
+            if len(store['dms'][dm_id - 1][DM_MEMBERS_IDX]) != 0:
+                store['dm_messages'][location_id].append(
+                    message['message_data'])
+                index_message(store, message['message_data']['message_id'],
+                              'dm_messages', location_id,
+                              len(store['dm_messages'][location_id]) - 1)
                 data_store.set(store)
                 update_msgs_stats(sender_id, time_sent)
                 update_workplace_msg_stats(True, 1)
-            if message['channel'] is False:
-                dm_id = message['location_id']
-                # check if dm has been removed. If it hasn't send the message
-                if len(store['dms'][dm_id - 1][DM_MEMBERS_IDX]) != 0:
-                    store['dm_messages'][location_id].append(
-                        message['message_data'])
-                    data_store.set(store)
-                    update_msgs_stats(sender_id, time_sent)
-                    update_workplace_msg_stats(True, 1)
-            store['messages_later'].remove(message)
 
+    # take every message which was sent off the queue at once
+    del msgs[:num_due]
     data_store.set(store)
 
     return {}
 
 
+def later_jobs():
+    '''
+    Helper function that lists the messages waiting to be sent, for the scheduler
+
+    Return value:
+        Returns [(time_sent, message_id)] (list)
+    '''
+    with data_store.transaction(shared=True):
+        return [(message['message_data']['time_sent'],
+                 message['message_data']['message_id'])
+                for message in data_store.get()['messages_later']]
+
+
+def later_metrics(token):
+    '''
+    Helper function that reports how far behind sending messages later is running
+
+    Arguments:
+        token (str) - A unique token which identifies an authenticated user
+
+    Exceptions:
+        AccessError - Occurs when session is invalid (verify_session fails)
+
+    Return value:
+        Returns {
+            'depth': messages waiting to be sent (int),
+            'overdue': how many of them are due (int),
+            'lag': seconds the longest overdue message has waited (float),
+            'delivered': messages this process has sent (int),
+            'last_lag': how late this process sent its latest batch (float),
+            'max_lag': the latest this process has sent a batch (float),
+        }
+    '''
+    verify_session(token)
+    now = datetime.timestamp(datetime.now())
+    with data_store.transaction(shared=True):
+        store = data_store.get()
+        queue = store['messages_later']
+        overdue = count_due(store, now)
+        lag = now - queue[0]['message_data']['time_sent'] if overdue else 0
+        metrics = {'depth': len(queue), 'overdue': overdue, 'lag': lag}
+    metrics.update(scheduler.metrics())
+    return metrics
+
+
+# sends each message in messages_later at its time_sent
+scheduler = Scheduler(send_messages_later, later_jobs)
+
+
 def message_edit_v1(token, message_id, message):
     '''
     Take in an authenticated token, message id and a new message, and edit the old message
@@ -533,42 +576,20 @@ def message_edit_v1(token, message_id, message):
     '''
     store = data_store.get()
     auth_id = verify_session(token)
+    lock_message(store, message_id)
     # check if the message is of a valid length
     if len(message) > 1000:
         raise InputError(
             description="Invalid message length: Exceeds character limit of 1000")
 
-    # Check if the message id is valid in channel messages
-    valid_message_id_ch = False
-
-    channel_counter = 0
-    for channel in store['messages']:
-        for message_dict in channel:
-            # print(message_dict['message_id'])
-            # print(message_id)
-            if message_dict['message_id'] == message_id:
-                valid_message_id_ch = True
-                u_id = message_dict['u_id']
-                #time_msg = message_dict['time_sent']
-                channel_id = channel_counter
-                break
-        channel_counter += 1
-
-    # Check if the message id is valid in dm messages
-    valid_message_id_dm = False
-    dm_counter = 0
-    for dm in store['dm_messages']:
-        for message_dict in dm:
-            if message_dict['message_id'] == message_id:
-                valid_message_id_dm = True
-                u_id = message_dict['u_id']
-                #time_msg = message_dict['time_sent']
-                dm_id = dm_counter
-                break
-        dm_counter += 1
-
-    if (valid_message_id_ch == False) and (valid_message_id_dm == False):
+    # Check if the message id is valid in channel or dm messages
+    found = find_message(store, message_id)
+    if found is None:
         raise InputError(description="Invalid message id")
+    key, location_id, message_dict = found
+    u_id = message_dict['u_id']
+    valid_message_id_ch = key == 'messages'
+    valid_message_id_dm = key == 'dm_messages'
 
     is_creator_of_msg = False
     is_owner = False
@@ -576,21 +597,14 @@ def message_edit_v1(token, message_id, message):
         is_owner = True
     # Check if the person making the request is an owner of the channel or dm
     if valid_message_id_ch == True:
-        ch_id_idx = 0
-        ch_own_idx = 3
-        for channels in store['channels']:
-            if channels[ch_id_idx] == channel_id:
-                for owner in channels[ch_own_idx]:
-                    if owner == auth_id:
-                        is_owner = True
+        channel = channel_by_id(store, location_id)
+        if auth_id in channel[CH_OWN_IDX]:
+            is_owner = True
 
     if valid_message_id_dm == True:
-        dm_id_idx = 0
-        dm_own_idx = 1
-        for dm in store['dms']:
-            if dm[dm_id_idx] == dm_id:
-                if dm[dm_own_idx]['owner_info'][0] == auth_id:
-                    is_owner = True
+        dm = dm_by_id(store, location_id)
+        if dm[DM_OWN_IDX]['owner_info'][0] == auth_id:
+            is_owner = True
 
     if auth_id == u_id:
         is_creator_of_msg = True
@@ -603,38 +617,21 @@ def message_edit_v1(token, message_id, message):
         message_remove_v1(token, message_id)
         return {}
 
-    if valid_message_id_ch == True:
-        for channel in store['messages']:
-            for message_dict in channel:
-                if message_dict['message_id'] == message_id:
-                    message_dict['message'] = message
-
-                    tags = generate_tag(message)
-                    # generates notifications for everone tagged in the message
-                    data_store.set(store)
-                    for handle in tags:
-                        # find user in data store and then generate notifcation
-                        for user in store['users']:
-                            if user[U_HANDLE_IDX] == handle:
-                                generate_notifcation(
-                                    channel_id, -1, 1, auth_id, user[U_ID_IDX], channels[CH_NAME_IDX], message)
-
-    if valid_message_id_dm == True:
-        for dm in store['dm_messages']:
-            for message_dict in dm:
-                if message_dict['message_id'] == message_id:
-                    message_dict['message'] = message
-                    tags = generate_tag(message)
-                    # generates notifications for everone tagged in the message
-                    data_store.set(store)
-                    for handle in tags:
-                        # find user in data store and then generate notifcation
-                        for user in store['users']:
-                            if user[U_HANDLE_IDX] == handle:
-                                generate_notifcation(
-                                    -1, dm[DM_ID_IDX], 1, auth_id, user[U_ID_IDX], dm[DM_NAME_IDX], message)
-
-                    break
+    message_dict['message'] = message
+    tags = generate_tag(message)
+    # generates notifications for everone tagged in the message
+    data_store.set(store)
+    for handle in tags:
+        # find user in data store and then generate notifcation
+        user = user_by_handle(store, handle)
+        if user is None:
+            continue
+        if valid_message_id_ch == True:
+            data_store.defer(
+                generate_notifcation, location_id, -1, 1, auth_id, user[U_ID_IDX], channel[CH_NAME_IDX], message)
+        else:
+            data_store.defer(
+                generate_notifcation, -1, location_id, 1, auth_id, user[U_ID_IDX], dm[DM_NAME_IDX], message)
 
     data_store.set(store)
     return {}
@@ -661,39 +658,15 @@ def message_remove_v1(token, message_id):
     auth_id = verify_session(token)
     store = data_store.get()
 
-    # Check if the message id is valid in channel messages
-    valid_message_id_ch = False
-
-    channel_counter = 0
-    for channel in store['messages']:
-        for message_dict in channel:
-            if message_dict['message_id'] == message_id:
-                valid_message_id_ch = True
-                u_id = message_dict['u_id']
-                channel_id = channel_counter
-                message = message_dict['message']
-                time_sent = message_dict['time_sent']
-                is_pinned = message_dict['is_pinned']
-                break
-        channel_counter += 1
-
-    # Check if the message id is valid in dm messages
-    valid_message_id_dm = False
-    dm_counter = 0
-    for dm in store['dm_messages']:
-        for message_dict in dm:
-            if message_dict['message_id'] == message_id:
-                valid_message_id_dm = True
-                u_id = message_dict['u_id']
-                dm_id = dm_counter
-                message = message_dict['message']
-                time_sent = message_dict['time_sent']
-                is_pinned = message_dict['is_pinned']
-                break
-        dm_counter += 1
-
-    if valid_message_id_ch == False and valid_message_id_dm == False:
+    # Check if the message id is valid in channel or dm messages
+    found = find_message(store, message_id)
+    if found is None:
         raise InputError(description="Invalid message id")
+    key, location_id, message_dict = found
+    u_id = message_dict['u_id']
+    valid_message_id_ch = key == 'messages'
+    valid_message_id_dm = key == 'dm_messages'
+    channel_id = dm_id = location_id
 
     is_creator_of_msg = False
     is_owner = False
@@ -701,21 +674,12 @@ def message_remove_v1(token, message_id):
         is_owner = True
     # Check if the person making the request is an owner of the channel or dm
     if valid_message_id_ch == True:
-        ch_id_idx = 0
-        ch_own_idx = 3
-        for channels in store['channels']:
-            if channels[ch_id_idx] == channel_id:
-                for owner in channels[ch_own_idx]:
-                    if owner == auth_id:
-                        is_owner = True
+        if auth_id in channel_by_id(store, channel_id)[CH_OWN_IDX]:
+            is_owner = True
 
     if valid_message_id_dm == True:
-        dm_id_idx = 0
-        dm_own_idx = 1
-        for dm in store['dms']:
-            if dm[dm_id_idx] == dm_id:
-                if dm[dm_own_idx]['owner_info'][0] == auth_id:
-                    is_owner = True
+        if dm_by_id(store, dm_id)[DM_OWN_IDX]['owner_info'][0] == auth_id:
+            is_owner = True
 
     if auth_id == u_id:
         is_creator_of_msg = True
@@ -724,23 +688,11 @@ def message_remove_v1(token, message_id):
         raise AccessError(
             description="Unauthorised user attempting to make change to a message")
 
-    reacts_data = []
-
-    message_remove = {
-        'message_id': message_id,
-        'u_id': u_id,
-        'message': message,
-        'time_sent': time_sent,
-        'reacts': reacts_data,
-        'is_pinned': is_pinned,
-    }
-    if valid_message_id_ch == True:
-        store['messages'][channel_id].remove(message_remove)
-    if valid_message_id_dm == True:
-        store['dm_messages'][dm_id].remove(message_remove)
+    tombstone_message(store, message_id)
 
     data_store.set(store)
-    update_workplace_msg_stats(False, 1)
+    data_store.defer(record_removal, store, message_id)
+    data_store.defer(update_workplace_msg_stats, False, 1)
     return {}
 
 
@@ -767,44 +719,27 @@ def message_react_unreact_v1(token, message_id, react_id, unreact):
     Return value:
         {}
     '''
-    DM_MEM_ID_IDX = 0
     store = data_store.get()
     auth_id = verify_session(token)
+    lock_message(store, message_id)
 
-    message_lists = (store['messages'], store['dm_messages'])
-    msg_found = False
-
-    for message_list in message_lists:
-        for idx, ch_dm in enumerate(message_list):
-            for idx2, message in enumerate(ch_dm):
-                if message['message_id'] == message_id:
-                    msg_found = True
-                    msg_loc = message_list
-                    loc_idx = idx
-                    msg_idx = idx2
-                    reacts = message['reacts']
-                    author = message['u_id']
-
-    if msg_found == False:
+    found = find_message(store, message_id)
+    if found is None:
         raise InputError(description="This is an invalid message_id")
+    msg_loc, loc_idx, message = found
+    reacts = message['reacts']
+    author = message['u_id']
 
-    for channel in store['channels']:
-        if channel[CH_ID_IDX] == loc_idx:
-            channel_found = channel
-            if auth_id not in channel[CH_MEMBER_IDX] and auth_id is not store['global_owner']:
-                raise InputError(
-                    description="This message is in a channel which you are not a member of")
-
-    is_member = False
-    for dm in store['dms']:
-        if dm[DM_ID_IDX] == loc_idx:
-            dm_found = dm
-            for member in dm[DM_MEMBERS_IDX]:
-                if member[DM_MEM_ID_IDX] == auth_id:
-                    is_member = True
-            if is_member == False and auth_id is not store['global_owner']:
-                raise InputError(
-                    description="This message is in a dm which you are not a member of")
+    if msg_loc == 'messages':
+        channel_found = channel_by_id(store, loc_idx)
+        if not is_channel_member(store, auth_id, loc_idx) and auth_id is not store['global_owner']:
+            raise InputError(
+                description="This message is in a channel which you are not a member of")
+    else:
+        dm_found = dm_by_id(store, loc_idx)
+        if not is_dm_member(store, auth_id, loc_idx) and auth_id is not store['global_owner']:
+            raise InputError(
+                description="This message is in a dm which you are not a member of")
 
     if reacts == []:
         users = []
@@ -829,30 +764,48 @@ def message_react_unreact_v1(token, message_id, react_id, unreact):
     if react_id not in store['valid_reacts']:
         raise InputError(description="We haven't implemented this react yet!")
 
+    # is_this_user_reacted depends on who is looking, see render.py
     react_data = {
         'react_id': react_id,
         'u_ids': users,
-        'is_this_user_reacted': True
     }
 
-    if msg_loc == store['messages']:
-        store['messages'][loc_idx][msg_idx]['reacts'].append(react_data)
+    if msg_loc == 'messages':
+        message['reacts'].append(react_data)
         channel_id = loc_idx
         data_store.set(store)
-        generate_notifcation(channel_id, -1, 2, auth_id,
-                             author, channel_found[CH_NAME_IDX], -1)
+        data_store.defer(generate_notifcation, channel_id, -1, 2, auth_id,
+                         author, channel_found[CH_NAME_IDX], -1)
 
     else:
-        store['dm_messages'][loc_idx][msg_idx]['reacts'].append(react_data)
+        message['reacts'].append(react_data)
         dm_id = loc_idx
         data_store.set(store)
-        generate_notifcation(-1, dm_id, 2, auth_id,
-                             author, dm_found[DM_NAME_IDX], -1)
+        data_store.defer(generate_notifcation, -1, dm_id, 2, auth_id,
+                         author, dm_found[DM_NAME_IDX], -1)
 
     data_store.set(store)
     return {}
 
 
+def lock_message(store, message_id):
+    '''
+    Helper function that locks the channel or dm holding a message, so a
+    scoped transaction can change it (see Datastore.lock()). Does nothing if
+    there is no such message.
+
+    Arguments:
+        store (dict) - The data store
+        message_id (int) - The id of the message
+
+    Return value:
+        Null
+    '''
+    place = store['message_index'].get(str(message_id))
+    if place is not None:
+        data_store.lock(tuple(place[:2]))
+
+
 def generate_tag(message_words):
     # This is the process of deconstructing the message and creating a list of all members who are tagged
     message_words = message_words.split()
@@ -901,32 +854,17 @@ def message_share_v1(token, og_message_id, message, channel_id, dm_id):
     Return value:
         {shared_message_id}
     '''
-    DM_MEM_ID_IDX = 0
     store = data_store.get()
     auth_id = verify_session(token)
 
-    ch_found = False
-    for ch in store['channels']:
-        if ch[CH_ID_IDX] == channel_id:
-            ch_found = True
-            ch_share = ch
-
-    dm_found = False
-    for dm in store['dms']:
-        if dm[DM_ID_IDX] == dm_id:
-            dm_found = True
-            dm_share = dm
-
-    channels_joined = []
-    for ch in store['channels']:
-        if auth_id in ch[CH_MEMBER_IDX]:
-            channels_joined.append(ch[CH_ID_IDX])
-
-    dms_joined = []
-    for dm in store['dms']:
-        for member in dm[DM_MEMBERS_IDX]:
-            if member[DM_MEM_ID_IDX] == auth_id:
-                dms_joined.append(dm[DM_ID_IDX])
+    ch_share = channel_by_id(store, channel_id)
+    ch_found = ch_share is not None
+
+    dm_share = dm_by_id(store, dm_id)
+    dm_found = dm_share is not None
+
+    channels_joined = memberships(store, 'user_channels', auth_id)
+    dms_joined = memberships(store, 'user_dms', auth_id)
 
     if ch_found == True and dm_id == -1 and channel_id not in channels_joined:
         raise AccessError(
@@ -939,19 +877,13 @@ def message_share_v1(token, og_message_id, message, channel_id, dm_id):
                              to share a message to")
 
     msg_found = False
-    for idx, ch in enumerate(store['messages']):
-        if idx in channels_joined:
-            for msg in ch:
-                if msg['message_id'] == og_message_id:
-                    msg_found = True
-                    og_message = msg['message']
-
-    for idx, dm in enumerate(store['dm_messages']):
-        if idx in dms_joined:
-            for msg in dm:
-                if msg['message_id'] == og_message_id:
-                    msg_found = True
-                    og_message = msg['message']
+    found = find_message(store, og_message_id)
+    if found is not None:
+        key, idx, msg = found
+        joined = channels_joined if key == 'messages' else dms_joined
+        if idx in joined:
+            msg_found = True
+            og_message = msg['message']
 
     if msg_found == False:
         raise InputError(
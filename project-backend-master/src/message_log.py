@@ -0,0 +1,336 @@
+'''
+message_log.py:
+
+Append-only binary log holding one channel's (or dm's) messages, which is
+how the json backend stores each message segment (see segments.py). The log
+is a sequence of records, each a header followed by the json of a message:
+
+    <length: u32> <position: u32> <length bytes of json>
+
+A record puts its message at `position`, replacing the message there, or
+adding it to the end when position is the number of messages so far. So
+sending, editing, pinning, reacting to or removing a message (which leaves
+a tombstone in its place) appends a single record instead of rewriting the
+channel. Anything else (dropping a channel's tombstones, clearing the
+workspace) writes a fresh log, as does compact() once most of the log is
+made up of records which have since been replaced.
+
+Next to <base>.log sits the offset index <base>.idx:
+
+    <inode: u64> <indexed bytes: u64> <live bytes: u64> <count: u64>
+    <offset of the current record of each position: u64,
+     place of the message in it: i64> * count
+
+A message's place is its message_id, or ~message_id (which is negative)
+for a tombstone, so where every message and tombstone in the channel is can
+be read from the index alone (see places()).
+
+The index covers the first `indexed bytes` of the log file with that inode.
+Records appended after it (by a process which died before updating it) are
+scanned and indexed the next time the log is opened, and an index which
+does not match the log at all is rebuilt from scratch.
+
+The log is read through mmap, so reading a page of messages only decodes
+the records on that page.
+
+Classes:
+    MessageLog(base)
+
+Functions:
+    message_place(message)
+'''
+import json
+import mmap
+import os
+import struct
+from array import array
+
+RECORD = struct.Struct('<II')
+HEADER = struct.Struct('<QQQQ')
+ENTRY = struct.Struct('<Qq')
+
+
+def message_place(message):
+    '''the place the index records for a message, see MessageLog.places()'''
+    if message.get('is_removed', False):
+        return ~message['message_id']
+    return message['message_id']
+
+
+class MessageLog:
+    '''
+    The log and offset index stored at <base>.log and <base>.idx
+    member function:
+        __init__(base)
+        read(repair)
+        page(start, count, repair)
+        places(repair)
+        put(updates)
+        rewrite(messages)
+        stage(messages, suffix)
+        compact()
+
+    Nothing is kept open between calls, so there is no limit to how many
+    MessageLog objects can exist at once.
+    '''
+
+    def __init__(self, base):
+        self.log_path = base + '.log'
+        self.index_path = base + '.idx'
+
+    def read(self, repair=True):
+        '''
+        Reads every message in the log. With repair False nothing is written
+        back, which is what a reader not holding the store's lock needs:
+        records past the index are read without being indexed, and any torn
+        record at the end is ignored rather than cut off.
+
+        Return Value:
+            Returns (messages, size) where size is the number of bytes of
+            json the messages take up, or ([], 0) if there is no log
+        '''
+        offsets, _, live = self.__index(repair)
+        records = self.__records(offsets)
+        return json.loads(b'[' + b','.join(records) + b']'), live
+
+    def page(self, start, count, repair=True):
+        '''
+        Reads up to count messages, newest first, skipping the start newest,
+        repairing the index as read() does
+
+        Return Value:
+            Returns (total, messages) where total is how many messages the
+            log holds
+        '''
+        offsets = self.__index(repair)[0]
+        total = len(offsets)
+        positions = range(total - 1 - start,
+                          max(total - 1 - start - count, -1), -1)
+        if not positions:
+            return total, []
+        messages = []
+        with self.__map() as log:
+            for position in positions:
+                offset = offsets[position] + RECORD.size
+                length = RECORD.unpack_from(log, offsets[position])[0]
+                messages.append(json.loads(log[offset:offset + length]))
+        return total, messages
+
+    def places(self, repair=True):
+        '''
+        Reads the place of every message from the index, without reading
+        the messages, repairing the index as read() does
+
+        Return Value:
+            Returns an array holding each position's message_id, or
+            ~message_id for a tombstone (see message_place())
+        '''
+        return self.__index(repair)[1]
+
+    def put(self, updates):
+        '''
+        Appends a record for each message which changed
+
+        Arguments:
+            updates (list of (position, message)) - In ascending position,
+                where a position one past the last appends the message
+
+        Return Value:
+            Returns how many bytes of json the messages now take up
+        '''
+        offsets, _, live = self.__index()
+        count = len(offsets)
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+        with open(self.log_path, 'a+b') as file:
+            end = file.tell()
+            chunks = []
+            changed = {}
+            for position, message in updates:
+                data = json.dumps(message).encode('utf8')
+                if position < len(offsets):
+                    live -= self.__length(file.fileno(), offsets[position])
+                elif position == count:
+                    count += 1
+                else:
+                    raise IndexError(f'position {position} is past the end')
+                changed[position] = (end, message_place(message))
+                live += len(data)
+                chunks.append(RECORD.pack(len(data), position))
+                chunks.append(data)
+                end += RECORD.size + len(data)
+            file.write(b''.join(chunks))
+            inode = os.fstat(file.fileno()).st_ino
+
+        # offsets first, so a header which is not updated still describes
+        # a prefix of the log
+        with open(self.index_path,
+                  'r+b' if os.path.exists(self.index_path) else 'w+b') \
+                as index:
+            for position, entry in changed.items():
+                index.seek(HEADER.size + position * ENTRY.size)
+                index.write(ENTRY.pack(*entry))
+            index.seek(0)
+            index.write(HEADER.pack(inode, end, live, count))
+        if end > max(2 * live, 64 * 1024):
+            self.compact()
+        return live
+
+    def rewrite(self, messages):
+        '''
+        Replaces the log (and index) with a fresh one holding messages
+
+        Return Value:
+            Returns how many bytes of json the messages take up
+        '''
+        return self.__write([json.dumps(message).encode('utf8')
+                             for message in messages],
+                            array('q', map(message_place, messages)))
+
+    def stage(self, messages, suffix):
+        '''
+        Durably writes a fresh log holding messages to <file><suffix>, to be
+        renamed into place later
+
+        Return Value:
+            Returns the paths written
+        '''
+        self.__write([json.dumps(message).encode('utf8')
+                      for message in messages],
+                     array('q', map(message_place, messages)), suffix)
+        return [self.log_path + suffix, self.index_path + suffix]
+
+    def compact(self):
+        '''rewrite the log with only the current record of each position'''
+        offsets, places, _ = self.__index()
+        self.__write(self.__records(offsets), places)
+
+    def __write(self, records, places, suffix=''):
+        '''
+        write a log holding records (json bytes), whose messages have the
+        given places, and its index, returns the bytes of json
+        '''
+        log_path = self.log_path + (suffix or f'.{os.getpid()}.tmp')
+        index_path = self.index_path + (suffix or f'.{os.getpid()}.tmp')
+        offsets = array('q')
+        chunks = []
+        end = 0
+        for position, data in enumerate(records):
+            offsets.append(end)
+            chunks.append(RECORD.pack(len(data), position))
+            chunks.append(data)
+            end += RECORD.size + len(data)
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        with open(log_path, 'wb') as file:
+            file.write(b''.join(chunks))
+            if suffix:
+                file.flush()
+                os.fsync(file.fileno())
+            inode = os.fstat(file.fileno()).st_ino
+        live = sum(map(len, records))
+        with open(index_path, 'wb') as file:
+            file.write(HEADER.pack(inode, end, live, len(offsets)))
+            file.write(_entries(offsets, places))
+            if suffix:
+                file.flush()
+                os.fsync(file.fileno())
+        if not suffix:
+            # an index whose inode does not match is rebuilt, so a crash
+            # between the two leaves nothing inconsistent
+            os.replace(log_path, self.log_path)
+            os.replace(index_path, self.index_path)
+        return live
+
+    def __index(self, repair=True):
+        '''
+        Returns (offsets, places, live bytes) for the log, bringing the
+        index up to date with the log first if needed. An index written
+        before it held places is rebuilt.
+        '''
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return array('q'), array('q'), 0
+        offsets, places, indexed, live = array('q'), array('q'), 0, 0
+        try:
+            with open(self.index_path, 'rb') as file:
+                inode, covered, covered_live, count = HEADER.unpack(
+                    file.read(HEADER.size))
+                data = file.read(count * ENTRY.size)
+        except (FileNotFoundError, struct.error):
+            pass
+        else:
+            if inode == stat.st_ino and covered <= stat.st_size \
+                    and len(data) == count * ENTRY.size:
+                entries = array('q')
+                entries.frombytes(data)
+                offsets, places = entries[0::2], entries[1::2]
+                indexed, live = covered, covered_live
+        if indexed < stat.st_size:
+            live = self.__scan(offsets, places, indexed, live, repair)
+        return offsets, places, live
+
+    def __scan(self, offsets, places, start, live, repair=True):
+        '''
+        index the records from byte start onwards, then unless repair is
+        False save the index. Returns the live bytes.
+        '''
+        with open(self.log_path, 'r+b' if repair else 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            end = start
+            if size:
+                with mmap.mmap(file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as log:
+                    while end + RECORD.size <= size:
+                        length, position = RECORD.unpack_from(log, end)
+                        if end + RECORD.size + length > size \
+                                or position > len(offsets):
+                            break
+                        place = message_place(json.loads(
+                            log[end + RECORD.size:end + RECORD.size + length]))
+                        if position < len(offsets):
+                            live -= RECORD.unpack_from(
+                                log, offsets[position])[0]
+                            offsets[position] = end
+                            places[position] = place
+                        else:
+                            offsets.append(end)
+                            places.append(place)
+                        live += length
+                        end += RECORD.size + length
+            if not repair:
+                return live
+            if end != size:
+                # a torn record left at the end by a crash
+                file.truncate(end)
+            inode = os.fstat(file.fileno()).st_ino
+        with open(self.index_path, 'wb') as file:
+            file.write(HEADER.pack(inode, end, live, len(offsets)))
+            file.write(_entries(offsets, places))
+        return live
+
+    def __records(self, offsets):
+        '''the json bytes of the records at offsets'''
+        if not offsets:
+            return []
+        with self.__map() as log:
+            return [log[offset + RECORD.size:offset + RECORD.size
+                        + RECORD.unpack_from(log, offset)[0]]
+                    for offset in offsets]
+
+    def __map(self):
+        '''map the log into memory for reading'''
+        with open(self.log_path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def __length(fd, offset):
+        '''the length of the json of the record at offset'''
+        return RECORD.unpack(os.pread(fd, RECORD.size, offset))[0]
+
+
+def _entries(offsets, places):
+    '''the index entries of records at offsets holding messages at places'''
+    entries = array('q', bytes(len(offsets) * ENTRY.size))
+    entries[0::2] = offsets
+    entries[1::2] = places
+    return entries.tobytes()
@@ -7,7 +7,7 @@ notifications. A notification is generated in any of the three following cases;
 '''
 
 
-from src.data_store import U_HANDLE_IDX, U_ID_IDX, U_NOTIF_IDX, data_store
+from src.data_store import U_HANDLE_IDX, U_NOTIF_IDX, data_store, user_by_id
 from src.verify_session import verify_session
 
 # case is an indicator for one of the 3 types of notifications
@@ -28,11 +28,7 @@ def find_user(auth_user_id):
         Returns 'user' (A list in datastore containing all the user information) if the u_id is found in data store.
     '''
     store = data_store.get()
-    user_found = None
-    for user in store['users']:
-        if user[U_ID_IDX] == auth_user_id:
-            user_found = user
-    return user_found
+    return user_by_id(store, auth_user_id)
 
 
 def channeldm_invite_notif(invitor_id, invitee_id, ch_or_dm_name, notification):
@@ -104,10 +100,10 @@ def get_notifications(token):
     store = data_store.get()
 
     notif = None
-    for user in store['users']:
-        if user[U_ID_IDX] == auth_user_id:
-            if len(user[U_NOTIF_IDX]) > 20:
-                notif = {'notifications': user[U_NOTIF_IDX][-20:]}
-            else:
-                notif = {'notifications': user[U_NOTIF_IDX]}
+    user = user_by_id(store, auth_user_id)
+    if user is not None:
+        if len(user[U_NOTIF_IDX]) > 20:
+            notif = {'notifications': user[U_NOTIF_IDX][-20:]}
+        else:
+            notif = {'notifications': user[U_NOTIF_IDX]}
     return notif
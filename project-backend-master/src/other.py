@@ -15,7 +15,7 @@ Functions:
 from flask import Flask, request, Response
 from json import dumps
 import jwt
-from src.data_store import U_ID_IDX, DM_ID_IDX, data_store
+from src.data_store import channel_by_id, data_store, dm_by_id, user_by_id
 from src.error import AccessError, InputError
 import jwt
 SECRET = "BADGER"
@@ -33,7 +33,8 @@ def clear_v1():
     store = {}
     store['users'] = []
     store['channels'] = []
-    store['standups'] = []
+    store['standups'] = {}
+    store['standup_archive'] = []
     store['messages'] = [[]]
     store['dm_messages'] = [[]]
     store['dms'] = []
@@ -54,6 +55,17 @@ def clear_v1():
     store['valid_reacts'] = [1]
     store['wordle_ch'] = [[]]
     store['wordle_dm'] = [[]]
+    store['user_index'] = {}
+    store['email_index'] = {}
+    store['handle_index'] = {}
+    store['handle_suffixes'] = {}
+    store['message_index'] = {}
+    store['message_tombstones'] = {'messages': {}, 'dm_messages': {}}
+    store['user_channels'] = {}
+    store['user_dms'] = {}
+    store['session_index'] = {}
+    store['user_sessions'] = {}
+    store['session_times'] = {}
 
     data_store.set(store)
     return {}
@@ -71,14 +83,8 @@ def check_auth_user(auth_user_id):
                                          a user id is valid or not
     '''
     # Checking if auth_user is valid id
-    id_idx = 0
     store = data_store.get()
-    authid_exists = False
-    for user in store['users']:
-        if user[id_idx] == auth_user_id:
-            authid_exists = True
-            break
-    return authid_exists
+    return user_by_id(store, auth_user_id) is not None
 
 
 def check_channel_id(channel_id):
@@ -96,20 +102,11 @@ def check_channel_id(channel_id):
 
     store = data_store.get()
     # Channel id not existing (assuming it is given as an int)
-    print(store['channels'])
-
-    channel_id = int(channel_id)
-    ch_exists = False
-    find_channel = False
-    for idx, ch_get in enumerate(store['channels']):
-        if ch_get[U_ID_IDX] == channel_id:
-            ch_exists = True
-            find_channel = idx
-            break
-    if ch_exists is False:
+    channel = channel_by_id(store, int(channel_id))
+    if channel is None:
         raise InputError(description="Incorrect channel_id")
 
-    return store['channels'][find_channel]
+    return channel
 
 
 def check_dm_id(dm_id):
@@ -126,17 +123,11 @@ def check_dm_id(dm_id):
     '''
     store = data_store.get()
     # Dm id not existing (assuming it is given as an int)
-    dm_exists = False
-    find_dm = False
-    for idx, dm_get in enumerate(store['dms']):
-        if dm_get[DM_ID_IDX] == dm_id:
-            dm_exists = True
-            find_dm = idx
-            break
-    if dm_exists is False:
+    dm = dm_by_id(store, dm_id)
+    if dm is None:
         raise InputError(description="Incorrect dm_id")
 
-    return store['dms'][find_dm]
+    return dm
 
 
 def encode_token(auth_id):
@@ -0,0 +1,44 @@
+'''
+render.py:
+
+Turns messages in the store into what a user is shown. Some fields, like
+whether the user has reacted, depend on who is looking, so they are worked
+out on a copy of each message and never written into the store: reading
+messages leaves the store exactly as it was.
+
+Functions:
+    render_message(message, u_id)
+    render_messages(messages, u_id)
+'''
+
+
+def render_message(message, u_id):
+    '''
+    A copy of a message as a user is shown it
+
+    Arguments:
+        message (dict) - A message, as in store['messages']
+        u_id (int) - The id of the user looking at it
+
+    Return Value:
+        Returns the message (dict), with is_this_user_reacted set for u_id
+        in each of its reacts
+    '''
+    return dict(message, reacts=[
+        dict(react, u_ids=list(react['u_ids']),
+             is_this_user_reacted=u_id in react['u_ids'])
+        for react in message['reacts']])
+
+
+def render_messages(messages, u_id):
+    '''
+    Copies of messages as a user is shown them, see render_message()
+
+    Arguments:
+        messages (list) - Messages, as in store['messages']
+        u_id (int) - The id of the user looking at them
+
+    Return Value:
+        Returns the messages (list)
+    '''
+    return [render_message(message, u_id) for message in messages]
@@ -0,0 +1,155 @@
+'''
+scheduler.py:
+
+Runs work at the time it is due from a thread of its own, so it happens on
+time whether or not anyone is making requests, and requests never have to
+check for it.
+
+Jobs are kept in a min-heap of (due, job_id), and the thread sleeps until
+the earliest of them is due. It then calls deliver(now) once for everything
+due by now, which finds the due work in the store and does it all in one
+transaction. The heap is only a timetable kept in memory: the work itself
+stays in the store until it is done, so a job scheduled twice, or by two
+processes, is still only done once. When the thread starts it loads
+every job still waiting, so after a restart whatever fell due while the
+server was down is delivered straight away in one batch. If load() fails
+it is tried again, waiting longer each time, while jobs scheduled in the
+meantime are still delivered.
+
+Classes:
+    Scheduler(deliver, load)
+'''
+import heapq
+import os
+import threading
+import time
+
+# seconds to wait before trying again after deliver() or load() fails, and
+# the longest load() is left before trying again
+RETRY_INTERVAL = 1
+MAX_RETRY_INTERVAL = 60
+
+
+class Scheduler:
+    '''
+    Calls deliver(now) as soon as a job is due
+    member function:
+        __init__(deliver, load)
+        schedule(due, job_id)
+        start()
+        run_due(now)
+        pending()
+        metrics()
+
+    load() returns the (due, job_id) of every job waiting in the store, and
+    is called when the thread starts, until it succeeds.
+    '''
+
+    def __init__(self, deliver, load):
+        self.__deliver = deliver
+        self.__load = load
+        self.__heap = []
+        self.__condition = threading.Condition(threading.Lock())
+        self.__delivering = threading.Lock()
+        self.__pid = None
+        self.__metrics = {'delivered': 0, 'last_lag': 0, 'max_lag': 0}
+
+    def schedule(self, due, job_id):
+        '''add a job to the timetable, starting the thread if need be'''
+        self.start()
+        with self.__condition:
+            heapq.heappush(self.__heap, (due, job_id))
+            if self.__heap[0] == (due, job_id):
+                # it is due before whatever the thread is waiting for
+                self.__condition.notify()
+
+    def start(self):
+        '''start this process' thread if it is not running'''
+        if self.__pid == os.getpid():
+            return
+        with self.__condition:
+            # a forked worker does not inherit its parent's thread
+            if self.__pid == os.getpid():
+                return
+            self.__pid = os.getpid()
+            threading.Thread(target=self.__run, name='scheduler',
+                             daemon=True).start()
+
+    def run_due(self, now):
+        '''deliver whatever is due by now without waiting for the thread'''
+        with self.__condition:
+            if not self.__heap or self.__heap[0][0] > now:
+                return
+        self.__deliver_due(now)
+
+    def pending(self):
+        '''the number of jobs in the timetable'''
+        with self.__condition:
+            return len(self.__heap)
+
+    def metrics(self):
+        '''
+        {'delivered', 'last_lag', 'max_lag'}: how many jobs this process has
+        delivered, and how many seconds after the earliest job in it was due
+        the latest batch, and the latest of all, was delivered
+        '''
+        with self.__condition:
+            return dict(self.__metrics)
+
+    def __run(self):
+        '''wait for the earliest job and deliver, for the life of the process'''
+        jobs = self.__load_jobs()
+        with self.__condition:
+            for job in jobs:
+                heapq.heappush(self.__heap, job)
+        while True:
+            with self.__condition:
+                while not self.__heap or self.__heap[0][0] > time.time():
+                    timeout = self.__heap[0][0] - time.time() \
+                        if self.__heap else None
+                    self.__condition.wait(timeout)
+            try:
+                self.__deliver_due(time.time())
+            except Exception as err:
+                # __deliver_due() put the jobs back in the heap to try again
+                print('scheduled delivery failed', err)
+                time.sleep(RETRY_INTERVAL)
+
+    def __load_jobs(self):
+        '''load() every job waiting in the store, backing off while it fails'''
+        interval = RETRY_INTERVAL
+        while True:
+            try:
+                return self.__load()
+            except Exception as err:
+                print('loading scheduled jobs failed', err)
+                time.sleep(interval)
+                interval = min(interval * 2, MAX_RETRY_INTERVAL)
+
+    def __deliver_due(self, now):
+        '''
+        take everything due by now off the timetable, then deliver it. A job
+        scheduled while deliver() runs stays on the timetable even if it is
+        due by now, as deliver() may have missed it
+        '''
+        with self.__delivering:
+            due = []
+            with self.__condition:
+                while self.__heap and self.__heap[0][0] <= now:
+                    due.append(heapq.heappop(self.__heap))
+            if not due:
+                return
+            try:
+                self.__deliver(now)
+            except BaseException:
+                # back on the timetable to try again
+                with self.__condition:
+                    for job in due:
+                        heapq.heappush(self.__heap, job)
+                raise
+            lag = time.time() - due[0][0]
+            with self.__condition:
+                self.__metrics['delivered'] += len(due)
+                self.__metrics['last_lag'] = lag
+                self.__metrics['max_lag'] = max(self.__metrics['max_lag'],
+                                                lag)
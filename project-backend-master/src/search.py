@@ -7,8 +7,9 @@ Data_Store is accessed and search is applied on all messages
 Functions:
     search_v1(token, query_str)
 '''
-from src.data_store import data_store
+from src.data_store import data_store, is_removed
 from src.error import InputError
+from src.render import render_message
 from src.verify_session import verify_session
 
 
@@ -29,7 +30,7 @@ def search_v1(token, query_str):
     Return Value:
         Returns {messages}
     '''
-    verify_session(token)
+    auth_user_id = verify_session(token)
     ret_msgs = []
     data = data_store.get()
 
@@ -39,12 +40,14 @@ def search_v1(token, query_str):
 
     for message_ch in data['messages']:
         for message in message_ch:
-            if query_str.casefold() in message['message'].casefold():
-                ret_msgs.append(message)
+            if not is_removed(message) and \
+               query_str.casefold() in message['message'].casefold():
+                ret_msgs.append(render_message(message, auth_user_id))
 
     for message_dm in data['dm_messages']:
         for message in message_dm:
-            if query_str.casefold() in message['message'].casefold():
-                ret_msgs.append(message)
+            if not is_removed(message) and \
+               query_str.casefold() in message['message'].casefold():
+                ret_msgs.append(render_message(message, auth_user_id))
 
     return {'messages': ret_msgs}
@@ -0,0 +1,315 @@
+'''
+segments.py:
+
+Segmented storage for the json backend, where every part of the store is
+kept in a file of its own so that only the parts which change are written:
+    <data>.segments/<key>.json        - each top level key, e.g. users
+    <data>.segments/<key>/<n>.log     - the messages of location n of
+                                        store['messages'] and
+                                        store['dm_messages'], as append-only
+                                        logs (see message_log.py)
+A location's messages are only read when that channel (or dm) is first
+used, and only the messages that changed are appended to its log.
+
+The data file itself is a small manifest listing the top level keys, in
+order, and how many locations each segmented key has. The keys built from
+the locations when the store is read in (DERIVED_KEYS) are not saved:
+    {"format": "segments", "keys": ["users", ...],
+     "locations": {"messages": 3, "dm_messages": 2}}
+A data file without "format" is from before the store was split up and
+holds the store itself.
+
+Classes:
+    SegmentFiles(data_path)
+    LazyLocations(files, key, count)
+
+Functions:
+    manifest(store)
+    read_main(data_path)
+    read_store(data_path)
+'''
+import json
+import os
+from os.path import exists, isdir
+
+from src.message_log import MessageLog
+from src.tracking import DERIVED_KEYS, SEGMENTED_KEYS, Unloaded
+
+STAGED_SUFFIX = '.new'
+MANIFEST_FORMAT = 'segments'
+
+
+class SegmentFiles:
+    '''
+    The message segment files kept alongside a data file
+    member function:
+        __init__(data_path)
+        read_key(key)
+        write_key(key, contents)
+        stage_key(key, contents)
+        remove_key(key)
+        stat_key(key)
+        log(key, location_id)
+        read(key, location_id, repair)
+        page(key, location_id, start, count, repair)
+        places(key, location_id, repair)
+        put(key, location_id, updates)
+        write(key, location_id, messages)
+        stage(key, location_id, messages)
+        commit_staged(paths)
+        discard_staged()
+        prune(key, count)
+
+    write_key() and write() replace a file straight away. stage_key() and
+    stage() write it to <file>.new instead, to be renamed into place later
+    by commit_staged(), so several files can be replaced as one step.
+    '''
+
+    def __init__(self, data_path):
+        self.__dir = os.path.splitext(data_path)[0] + '.segments'
+
+    def read_key(self, key):
+        '''the value of top level key store[key]'''
+        with open(self.__key_path(key), 'r', encoding="utf8") as file:
+            return json.load(file)
+
+    def write_key(self, key, contents):
+        '''atomically replace the file of store[key] with contents (json)'''
+        path = self.__key_path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(self.__dir, exist_ok=True)
+        with open(tmp_path, 'w', encoding="utf8") as file:
+            file.write(contents)
+        os.replace(tmp_path, path)
+
+    def stage_key(self, key, contents):
+        '''durably write the next contents of store[key], returns the path'''
+        path = self.__key_path(key) + STAGED_SUFFIX
+        os.makedirs(self.__dir, exist_ok=True)
+        with open(path, 'w', encoding="utf8") as file:
+            file.write(contents)
+            file.flush()
+            os.fsync(file.fileno())
+        return path
+
+    def remove_key(self, key):
+        '''delete the file of a top level key which no longer exists'''
+        if exists(self.__key_path(key)):
+            os.remove(self.__key_path(key))
+
+    def stat_key(self, key):
+        '''
+        (inode, mtime, size) of the file of store[key], which change
+        whenever it is written, or None if it does not exist
+        '''
+        try:
+            stat = os.stat(self.__key_path(key))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def log(self, key, location_id):
+        '''the MessageLog holding store[key][location_id]'''
+        return MessageLog(os.path.join(self.__dir, key, str(location_id)))
+
+    def read(self, key, location_id, repair=True):
+        '''
+        Reads one location's messages, see MessageLog.read() for repair
+
+        Return Value:
+            Returns (messages, size) where size is roughly how many bytes
+            of json they take up, or ([], 0) if the location has no log
+        '''
+        return self.log(key, location_id).read(repair)
+
+    def page(self, key, location_id, start, count, repair=True):
+        '''
+        Reads up to count of a location's messages, newest first, skipping
+        the start newest, without reading the rest
+
+        Return Value:
+            Returns (total, messages)
+        '''
+        return self.log(key, location_id).page(start, count, repair)
+
+    def places(self, key, location_id, repair=True):
+        '''
+        Reads where a location's messages and tombstones are, without
+        reading the messages, see MessageLog.places()
+        '''
+        return self.log(key, location_id).places(repair)
+
+    def put(self, key, location_id, updates):
+        '''
+        append the messages at the given positions to a location's log,
+        returns roughly how many bytes of json the location now holds
+        '''
+        return self.log(key, location_id).put(updates)
+
+    def write(self, key, location_id, messages):
+        '''
+        atomically replace a location's log with one holding messages,
+        returns how many bytes of json they take up
+        '''
+        return self.log(key, location_id).rewrite(messages)
+
+    def stage(self, key, location_id, messages):
+        '''durably write a location's next log, returns the staged paths'''
+        return self.log(key, location_id).stage(messages, STAGED_SUFFIX)
+
+    def commit_staged(self, paths=None):
+        '''rename staged files into place, by default every one on disk'''
+        if paths is None:
+            paths = self.__staged()
+        for path in paths:
+            os.replace(path, path[:-len(STAGED_SUFFIX)])
+
+    def discard_staged(self):
+        '''delete every staged file left on disk'''
+        for path in self.__staged():
+            os.remove(path)
+
+    def prune(self, key, count):
+        '''delete the files of locations count and above'''
+        directory = os.path.join(self.__dir, key)
+        if not isdir(directory):
+            return
+        for name in os.listdir(directory):
+            location_id = name.split('.')[0]
+            if location_id.isdigit() and int(location_id) >= count:
+                os.remove(os.path.join(directory, name))
+
+    def __staged(self):
+        '''every staged file on disk'''
+        paths = []
+        for directory in [self.__dir] + [os.path.join(self.__dir, key)
+                                         for key in SEGMENTED_KEYS]:
+            if isdir(directory):
+                paths.extend(os.path.join(directory, name)
+                             for name in os.listdir(directory)
+                             if name.endswith(STAGED_SUFFIX))
+        return paths
+
+    def __key_path(self, key):
+        '''the file holding top level key store[key]'''
+        return os.path.join(self.__dir, f'{key}.json')
+
+
+class LazyLocations:
+    '''
+    Stands in for store[key] while the write ahead log is folded into the
+    files on disk (see wal.apply), reading a location's file only when an
+    op touches it
+    member function:
+        __init__(files, key, count)
+        __len__()
+        __getitem__(location_id)
+        __setitem__(location_id, messages)
+        append(messages)
+        insert(location_id, messages)
+        __delitem__(location_id)
+        clear()
+
+    `locations` holds each location's messages, or None if they have not
+    been read, and `touched` the location ids which ops have changed.
+    '''
+
+    def __init__(self, files, key, count):
+        self.files = files
+        self.key = key
+        self.locations = [None] * count
+        self.touched = set()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __getitem__(self, location_id):
+        messages = self.locations[location_id]
+        if messages is None:
+            messages = self.locations[location_id] = \
+                self.files.read(self.key, location_id)[0]
+        # whoever asks is about to change it
+        self.touched.add(location_id)
+        return messages
+
+    def __setitem__(self, location_id, messages):
+        self.locations[location_id] = messages
+        self.touched.add(location_id)
+
+    def append(self, messages):
+        self.locations.append(messages)
+        self.touched.add(len(self.locations) - 1)
+
+    def insert(self, location_id, messages):
+        self.__read_all()
+        self.locations.insert(location_id, messages)
+        self.touched = set(range(len(self.locations)))
+
+    def __delitem__(self, location_id):
+        self.__read_all()
+        del self.locations[location_id]
+        self.touched = set(range(len(self.locations)))
+
+    def clear(self):
+        self.locations = []
+        self.touched = set()
+
+    def __read_all(self):
+        '''read every location, before they move to other positions'''
+        for location_id in range(len(self.locations)):
+            self.__getitem__(location_id)
+
+
+def manifest(store):
+    '''
+    The data file describing store, whose segmented keys may be lists (or
+    list-like) or already the number of locations
+    '''
+    return {'format': MANIFEST_FORMAT,
+            'keys': [key for key in store if key not in DERIVED_KEYS],
+            'locations': {key: value if isinstance(value, int)
+                          else len(value)
+                          for key, value in store.items()
+                          if key in SEGMENTED_KEYS}}
+
+
+def read_main(data_path):
+    '''
+    Reads a json data file, but none of the files it refers to
+
+    Return Value:
+        Returns (store, split) or (None, False) if there is no data file.
+        In store each top level key kept in a file of its own is an
+        Unloaded((key,)) placeholder and each segmented key is how many
+        locations it has. split is False for a data file from before the
+        store was split up, which is returned as it is.
+    '''
+    if not exists(data_path) or os.stat(data_path).st_size == 0:
+        return None, False
+    with open(data_path, 'r', encoding="utf8") as file:
+        main = json.load(file)
+    if main.get('format') != MANIFEST_FORMAT:
+        return main, False
+    locations = main['locations']
+    return {key: locations[key] if key in locations else Unloaded((key,))
+            for key in main['keys']}, True
+
+
+def read_store(data_path):
+    '''
+    Reads a json data file along with every file it refers to
+
+    Return Value:
+        Returns the whole store (dict), or None if there is no data file
+    '''
+    store, _ = read_main(data_path)
+    if store is None:
+        return None
+    files = SegmentFiles(data_path)
+    for key, value in store.items():
+        if isinstance(value, Unloaded):
+            store[key] = files.read_key(key)
+        elif key in SEGMENTED_KEYS and isinstance(value, int):
+            store[key] = [files.read(key, location_id)[0]
+                          for location_id in range(value)]
+    return store
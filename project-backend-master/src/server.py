@@ -1,16 +1,19 @@
 from email.mime import image
 import sys
+import os
 import os.path
 import signal
+import socket
 from json import dumps
 from flask import Flask, request, send_file, send_from_directory
 from flask_cors import CORS
+from werkzeug.serving import make_server
 from src.channels import channels_create_v1, channels_list_v1, channels_listall_v1
 
 # from src.message import message_send_v1, message_edit_v1, message_remove_v1, message_senddm_v1, message_pin_unpin, message_sendlater_v1, message_sendlaterdm_v1, check_message_send_later
 from src.message import message_send_v1, message_edit_v1, message_remove_v1, \
     message_senddm_v1, message_pin_unpin, message_sendlater_v1, \
-    message_sendlaterdm_v1, message_react_unreact_v1, message_share_v1, check_message_send_later
+    message_sendlaterdm_v1, message_react_unreact_v1, message_share_v1, later_metrics, scheduler
 from src.error import InputError
 from src import config
 from src.channel import channel_invite_v1, channel_join_v1, channel_details_v1, \
@@ -30,14 +33,19 @@ from flask import jsonify
 from src.verify_session import verify_session
 from src.users import users_all_v1, users_stats_v1
 from src.extra import check_wordle
+from src.data_store import data_store
 
 
 def quit_gracefully(*args):
-    '''For coverage'''
+    '''For coverage, and to flush any write behind data before exiting'''
+    data_store.close()
     exit(0)
 
 
 def defaultHandler(err):
+    # undo whatever the failed request had changed
+    if data_store.in_transaction():
+        data_store.rollback()
     response = err.get_response()
     print('response', err, err.get_response())
     response.data = dumps({
@@ -56,6 +64,47 @@ APP.config['TRAP_HTTP_EXCEPTIONS'] = True
 APP.register_error_handler(Exception, defaultHandler)
 # NO NEED TO MODIFY ABOVE THIS POINT, EXCEPT IMPORTS
 
+
+# requests which only change the messages of one channel or dm, and so can
+# run at the same time as each other
+SCOPED_PATHS = {
+    '/message/send/v1',
+    '/message/senddm/v1',
+    '/message/edit/v1',
+    '/message/react/v1',
+    '/message/unreact/v1',
+    '/message/pin/v1',
+    '/message/unpin/v1',
+}
+
+
+@APP.before_request
+def begin_transaction():
+    '''
+    Each request runs as one data store transaction. Those which only read
+    run as read-only transactions, reading the latest snapshot of the store
+    without waiting for requests which write, and never writing to it. Those
+    in SCOPED_PATHS run as scoped transactions, which only lock the channel
+    or dm they change.
+    '''
+    data_store.begin(read_only=request.method == 'GET',
+                     scoped=request.path in SCOPED_PATHS)
+
+
+@APP.after_request
+def commit_transaction(response):
+    '''Persist everything the request changed in a single commit'''
+    if data_store.in_transaction():
+        data_store.commit()
+    return response
+
+
+@APP.teardown_request
+def end_transaction(exc):
+    '''Never leave a transaction (and the store's lock) behind'''
+    while data_store.in_transaction():
+        data_store.rollback()
+
 # Example
 
 
@@ -99,7 +148,7 @@ def pfp():
 def pin():
     '''
     Converts http data to parameters which are then
-    passed into check_message_send_later().
+    passed into message_pin_unpin().
 
     Return Value:
         Returns {}
@@ -107,7 +156,6 @@ def pin():
     data = request.get_json()
     token = data['token']
     mid = data['message_id']
-    check_message_send_later(token)
     message_pin_unpin(token, mid, True)
     return dumps({})
 
@@ -116,7 +164,7 @@ def pin():
 def unpin():
     '''
     Converts http data to parameters which are then
-    passed into check_message_send_later().
+    passed into message_pin_unpin().
 
     Return Value:
         Returns {}
@@ -124,7 +172,6 @@ def unpin():
     data = request.get_json()
     token = data['token']
     mid = data['message_id']
-    check_message_send_later(token)
     message_pin_unpin(token, mid, False)
     return dumps({})
 
@@ -194,7 +241,6 @@ def message_send_v1_front():
     channel_id = data['channel_id']
     message = data['message']
     share = False
-    check_message_send_later(token)
     ret = check_wordle(token, channel_id, message, 0, share)
     if ret == True:
         return dumps({})
@@ -216,7 +262,6 @@ def message_edit_v1_front():
     token = data['token']
     message_id = data['message_id']
     message = data['message']
-    check_message_send_later(token)
     return dumps(message_edit_v1(token, message_id, message))
 
 
@@ -232,7 +277,6 @@ def message_remove_v1_front():
     data = request.get_json()
     token = data['token']
     message_id = data['message_id']
-    check_message_send_later(token)
     return dumps(message_remove_v1(token, message_id))
 
 
@@ -250,7 +294,6 @@ def message_senddm_v1_front():
     dm_id = data['dm_id']
     message = data['message']
     share = False
-    check_message_send_later(token)
     ret = check_wordle(token, dm_id, message, 1, share)
     if ret == True:
         return dumps({})
@@ -310,7 +353,6 @@ def channel_messages_v2():
     token = request.args.get('token')
     channel_id = int(request.args.get('channel_id'))
     start = int(request.args.get('start'))
-    check_message_send_later(token)
     auth_user_id = verify_session(token)
     return dumps(channel_messages_v1(auth_user_id, channel_id, start))
 
@@ -484,7 +526,6 @@ def http_dm_messages_v1():
     token = request.args.get('token')
     dm_id = int(request.args.get('dm_id'))
     start = int(request.args.get('start'))
-    check_message_send_later(token)
     auth_user_id = verify_session(token)
     return dumps(dm_messages_v1(auth_user_id, dm_id, start))
 
@@ -499,7 +540,6 @@ def http_search_v1():
     '''
     token = request.args.get('token')
     query_str = request.args.get('query_str')
-    check_message_send_later(token)
     return dumps(search_v1(token, query_str))
 
 
@@ -742,6 +782,20 @@ def server_message_sendlaterdm_v1():
     return dumps(message_sendlaterdm_v1(token, dm_id, message, time_sent))
 
 
+@APP.route('/message/sendlater/metrics/v1', methods=['GET'])
+def server_message_sendlater_metrics_v1():
+    '''
+    Converts http data to parameters which are then passed into
+    later_metrics(), which reports the depth of the queue of messages
+    waiting to be sent later and how far behind sending them is running.
+
+    Return Value:
+        Returns {depth, overdue, lag, delivered, last_lag, max_lag}
+    '''
+    token = request.args.get('token')
+    return dumps(later_metrics(token))
+
+
 @APP.route('/user/stats/v1', methods=['GET'])
 def server_user_stats_v1():
     '''
@@ -832,9 +886,59 @@ def server_message_share_v1():
     return dumps(message_share_v1(token, og_message_id, message, channel_id, dm_id))
 
 
+def serve_workers(count):
+    '''
+    Serves APP from count forked processes accepting connections on the same
+    socket, until the parent is interrupted
+
+    Arguments:
+        count (int) - How many worker processes to fork
+
+    Exceptions:
+        ValueError - Occurs when the data store is neither the 'service'
+                     backend nor in 'sync' mode with the 'json' backend,
+                     the setups which processes can share
+    '''
+    if config.store_backend != 'service' and (
+            config.store_mode != 'sync' or config.store_backend != 'json'):
+        raise ValueError("workers need the 'service' backend, or "
+                         "store_mode 'sync' with the 'json' backend")
+    listener = socket.create_server(('localhost', config.port), backlog=128)
+    workers = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                scheduler.start()
+                make_server('localhost', config.port, APP, threaded=True,
+                            fd=listener.fileno()).serve_forever()
+            finally:
+                os._exit(0)
+        workers.append(pid)
+
+    def stop_workers(*args):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            os.waitpid(pid, 0)
+        quit_gracefully()
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    for pid in workers:
+        os.waitpid(pid, 0)
+
+
 # NO NEED TO MODIFY BELOW THIS POINT
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, quit_gracefully)  # For coverage
+    signal.signal(signal.SIGTERM, quit_gracefully)
     # Do not edit this port  #############added debug
     # APP.run(port=config.port, debug=True)
-    APP.run(port=config.port)
+    if config.workers > 1:
+        serve_workers(config.workers)
+    else:
+        scheduler.start()
+        APP.run(port=config.port)
@@ -0,0 +1,175 @@
+'''
+snapshots.py:
+
+Read-only versions of the store. Each time a transaction commits, the
+Datastore publishes a snapshot of the store as it now is, which shared
+transactions read instead of the store itself (see Datastore.begin()). A
+snapshot never changes once it is published, so any number of threads can
+read one without the store's lock while writers go on building the next
+version. Consecutive snapshots share every part of the store that did not
+change between them: publishing one only copies the lists and dicts which
+changed, and the ones which hold them. Each frozen container remembers the
+container it is a copy of (its `source`), which is how freeze() tells
+which parts of an earlier snapshot it can share.
+
+Snapshots are made of FrozenDict and FrozenList, which behave like dict and
+list but raise TypeError on any mutation. Copies of them (list(...),
+dict(...), slices) are ordinary containers again. The outer lists of the
+segmented keys are FrozenLocations, where a location which was still on
+disk when the snapshot was published is read from its file when used.
+
+Classes:
+    FrozenList
+    FrozenDict
+    FrozenLocations(values, reader)
+
+Functions:
+    freeze(value)
+'''
+from src.tracking import Unloaded
+
+
+def _read_only(self, *args, **kwargs):
+    '''stands in for every method which would change a snapshot'''
+    raise TypeError(f'{type(self).__name__} is part of a read-only snapshot')
+
+
+class FrozenList(list):
+    '''A list which cannot be changed'''
+    __slots__ = ('source',)
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = _read_only
+    sort = reverse = _read_only
+
+    def __reduce_ex__(self, protocol):
+        # copies and pickles of a snapshot are ordinary lists
+        return (list, (list(self),))
+
+
+class FrozenDict(dict):
+    '''A dict which cannot be changed'''
+    __slots__ = ('source',)
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    pop = popitem = setdefault = update = clear = _read_only
+
+    def __reduce_ex__(self, protocol):
+        return (dict, (dict(self),))
+
+
+class FrozenLocations(FrozenList):
+    '''
+    The outer list of a segmented key in a snapshot, e.g. store['messages'].
+    Elements may be Unloaded placeholders, which are read through
+    reader(key) each time they are accessed.
+    '''
+    __slots__ = ('reader',)
+
+    def __init__(self, values=(), reader=None):
+        list.__init__(self, values)
+        self.reader = reader
+
+    def __reduce_ex__(self, protocol):
+        return (list, (list(self),))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[idx] for idx in range(*index.indices(len(self)))]
+        value = list.__getitem__(self, index)
+        if isinstance(value, Unloaded):
+            return freeze(self.reader(value.key))
+        return value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __reversed__(self):
+        for index in range(len(self) - 1, -1, -1):
+            yield self[index]
+
+    def __contains__(self, value):
+        return any(item is value or item == value for item in self)
+
+    def __eq__(self, other):
+        return list(self) == other
+
+    def __ne__(self, other):
+        return list(self) != other
+
+    def copy(self):
+        return list(self)
+
+
+def freeze(value, old=None, changed=None):
+    '''
+    A read-only deep copy of value, sharing anything which is already frozen
+    and keeping Unloaded placeholders as they are
+
+    Arguments:
+        value - Any json compatible value
+        old - An earlier frozen copy of value, or None
+        changed (dict) - {id(container): keys} for every container in value
+                         which changed since old was made, along with every
+                         container holding one, where keys are the keys (or
+                         list positions) of the container which changed or
+                         hold one which did, or None if any of them might
+                         have. Without changed nothing in old is shared.
+
+    Return Value:
+        The frozen copy, where only the containers in changed are copied
+        again and the rest of old is shared
+    '''
+    if isinstance(value, (FrozenList, FrozenDict)):
+        return value
+    if not isinstance(value, (dict, list)):
+        return value
+    if changed is None or getattr(old, 'source', None) is not value:
+        old = None
+    elif id(value) not in changed:
+        return old
+    if isinstance(value, dict):
+        keys = changed.get(id(value)) if old is not None else None
+        if keys is None:
+            new = {key: freeze(item, _child(old, key), changed)
+                   for key, item in value.items()}
+        else:
+            new = dict(old)
+            for key in keys:
+                if key in value:
+                    new[key] = freeze(value[key], old.get(key), changed)
+                else:
+                    new.pop(key, None)
+        return _frozen(FrozenDict(new), value)
+    keys = changed.get(id(value)) if old is not None else None
+    if keys is not None and all(position <= len(value) for position in keys):
+        new = list(old)
+        del new[len(value):]
+        for position in sorted(keys):
+            if position < len(value):
+                item = freeze(value[position], _child(old, position), changed)
+                if position < len(new):
+                    new[position] = item
+                elif position == len(new):
+                    new.append(item)
+        if len(new) == len(value):
+            return _frozen(FrozenList(new), value)
+    return _frozen(FrozenList([freeze(item, _child(old, position), changed)
+                               for position, item
+                               in enumerate(list.__iter__(value))]), value)
+
+
+def _child(old, key):
+    '''what old held at key, or None'''
+    if isinstance(old, dict):
+        return old.get(key)
+    if isinstance(old, list) and 0 <= key < len(old):
+        return list.__getitem__(old, key)
+    return None
+
+
+def _frozen(container, source):
+    '''container, remembering it is a frozen copy of source'''
+    container.source = source
+    return container
@@ -0,0 +1,445 @@
+'''
+sqlite_store.py:
+
+SQLite storage backend for the Datastore, used when config.store_backend is
+'sqlite'. Users, channels, dms, messages, reacts, sessions and the stats
+time series are kept in their own tables, one row per item, with the ids
+used for lookups copied out into indexed columns. Lists which grow inside an
+item (channel members, notifications, reacts, ...) get a child table with
+one row per element, so appending to them never rewrites the whole item.
+Every row keeps the exact json of its item in a `data` column, which is what
+the store is rebuilt from. Top level keys without a table of their own
+(counters, removed users, standups, ...) are stored as json in `kv`, apart
+from the message indexes, which the Datastore builds from the messages
+whenever the store is loaded (DERIVED_KEYS).
+
+The database runs in WAL journal mode. Connections are kept in a pool: a
+thread checks one out for each load or save, so no two threads ever share a
+connection, and hands it back afterwards for the next thread to reuse.
+
+Classes:
+    Table(name, scope, columns, children)
+    SqliteBackend(path)
+
+Functions:
+    migrate(json_path, db_path)
+'''
+import json
+import queue
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+from src import config
+from src.segments import read_store
+from src.tracking import DERIVED_KEYS, SEGMENTED_KEYS
+
+
+class Table:
+    '''
+    How the items of one kind of segment are laid out in the database
+        name - The table the items are stored in
+        scope - Columns identifying which segment a row belongs to
+        columns - {column: (sql type, path)} values copied out of each item
+        children - {table: (path, {column: (sql type, path)})} lists inside
+                   each item which are stored one row per element
+        indexes - Columns of the table to index
+    A path is the list of keys leading from the item to a value.
+    '''
+
+    def __init__(self, name, scope=(), columns=None, children=None,
+                 indexes=()):
+        self.name = name
+        self.scope = scope
+        self.columns = columns or {}
+        self.children = children or {}
+        self.indexes = indexes
+
+
+def _stats_table(series, child_key, num_key):
+    '''a user's stats series, one row per user with a child row per point'''
+    return Table('user_stats', ('series',),
+                 {'auth_user_id': ('INTEGER', ['auth_user_id'])},
+                 {'user_stat_points': ([child_key], {
+                     'num': ('INTEGER', [num_key]),
+                     'time_stamp': ('INTEGER', ['time_stamp'])})},
+                 indexes=('auth_user_id',))
+
+
+def _workspace_table(num_key):
+    '''a workspace stats series, one row per point'''
+    return Table('workspace_stats', ('series',),
+                 {'num': ('INTEGER', [num_key]),
+                  'time_stamp': ('INTEGER', ['time_stamp'])})
+
+
+MESSAGES = Table('messages', ('location', 'location_id'),
+                 {'message_id': ('INTEGER', ['message_id']),
+                  'u_id': ('INTEGER', ['u_id']),
+                  'time_sent': ('INTEGER', ['time_sent']),
+                  'is_pinned': ('INTEGER', ['is_pinned'])},
+                 {'reacts': (['reacts'], {
+                     'react_id': ('INTEGER', ['react_id']),
+                     'u_ids': ('TEXT', ['u_ids'])})},
+                 indexes=('message_id', 'u_id'))
+
+TABLES = {
+    'users': Table('users', (),
+                   {'u_id': ('INTEGER', [0]),
+                    'email': ('TEXT', [1]),
+                    'handle_str': ('TEXT', [5])},
+                   {'user_notifications': ([8], {
+                       'channel_id': ('INTEGER', ['channel_id']),
+                       'dm_id': ('INTEGER', ['dm_id'])})},
+                   indexes=('u_id', 'email', 'handle_str')),
+    'channels': Table('channels', (),
+                      {'channel_id': ('INTEGER', [0]),
+                       'name': ('TEXT', [1]),
+                       'is_public': ('INTEGER', [2])},
+                      {'channel_owners': ([3], {'u_id': ('INTEGER', [])}),
+                       'channel_members': ([4], {'u_id': ('INTEGER', [])})},
+                      indexes=('channel_id',)),
+    'dms': Table('dms', (),
+                 {'dm_id': ('INTEGER', [0]),
+                  'name': ('TEXT', [3])},
+                 {'dm_members': ([2], {'u_id': ('INTEGER', [0])})},
+                 indexes=('dm_id',)),
+    'sessions': Table('sessions', (), {'token': ('TEXT', [])},
+                      indexes=('token',)),
+    'channel_track': _stats_table('channel_track', 'channels_joined',
+                                  'num_channels_joined'),
+    'dm_track': _stats_table('dm_track', 'dms_joined', 'num_dms_joined'),
+    'message_track': _stats_table('message_track', 'messages_sent',
+                                  'num_messages_sent'),
+    'channels_exist': _workspace_table('num_channels_exist'),
+    'dms_exist': _workspace_table('num_dms_exist'),
+    'messages_exist': _workspace_table('num_messages_exist'),
+}
+
+# child tables whose rows are indexed by their u_id
+CHILD_INDEXES = {'channel_owners': 'u_id', 'channel_members': 'u_id',
+                 'dm_members': 'u_id'}
+
+
+class SqliteBackend:
+    '''
+    Stores the Datastore in a SQLite database
+    member function:
+        __init__(path)
+        load()
+        save(store, changes)
+        close()
+    '''
+
+    def __init__(self, path):
+        self.__path = path
+        self.__pool = queue.LifoQueue()
+        self.__connections = []
+        self.__lock = threading.Lock()
+        self.__create_schema()
+
+    def load(self):
+        '''
+        Rebuilds the store from the database
+
+        Return Value:
+            Returns the store (dict), or None if the database is empty
+        '''
+        with self.__connection() as conn:
+            return self.__load(conn)
+
+    def __load(self, conn):
+        '''load() using the given connection'''
+        rows = conn.execute('SELECT key, value FROM kv').fetchall()
+        if not rows:
+            return None
+        store = {key: json.loads(value) for key, value in rows
+                 if key not in DERIVED_KEYS}
+        for key in SEGMENTED_KEYS:
+            # kv holds how many locations there are, the messages are rows
+            locations = [[] for _ in range(store.get(key, 1))]
+            for location_id, pos, data in conn.execute(
+                    'SELECT location_id, pos, data FROM messages '
+                    'WHERE location = ? ORDER BY location_id, pos', (key,)):
+                locations[location_id].append(json.loads(data))
+            store[key] = locations
+            self.__load_children(conn, MESSAGES, (key,), store[key],
+                                 by_location=True)
+        for key, table in TABLES.items():
+            scope = (key,) if table.scope else ()
+            items = [json.loads(data) for (data,) in conn.execute(
+                f'SELECT data FROM {table.name} {_where(table.scope)} '
+                'ORDER BY pos', scope)]
+            self.__load_children(conn, table, scope, items)
+            store[key] = items
+        return store
+
+    def save(self, store, changes):
+        '''
+        Writes the changed parts of the store to the database in a single
+        transaction
+
+        Arguments:
+            store (dict) - The whole store
+            changes (dict) - {segment key: positions} where positions is the
+                             set of item positions which changed, or None if
+                             the whole segment has to be rewritten. A key of
+                             () means the whole store changed.
+        '''
+        with self.__connection() as conn, conn:
+            if () in changes:
+                self.__clear(conn)
+                changes = {(key,): None for key in store}
+            for seg_key, positions in changes.items():
+                self.__save_segment(conn, store, seg_key, positions)
+
+    def close(self):
+        '''close every connection in the pool'''
+        with self.__lock:
+            for conn in self.__connections:
+                conn.close()
+            self.__connections = []
+            self.__pool = queue.LifoQueue()
+
+    @contextmanager
+    def __connection(self):
+        '''check a connection out of the pool, opening one if it is empty'''
+        try:
+            conn = self.__pool.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.__path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={config.sqlite_synchronous}')
+            with self.__lock:
+                self.__connections.append(conn)
+        try:
+            yield conn
+        finally:
+            self.__pool.put(conn)
+
+    def __create_schema(self):
+        '''create any tables and indexes which do not exist yet'''
+        statements = ['CREATE TABLE IF NOT EXISTS kv '
+                      '(key TEXT PRIMARY KEY, value TEXT NOT NULL)']
+        created = set()
+        for table in list(TABLES.values()) + [MESSAGES]:
+            if table.name in created:
+                continue
+            created.add(table.name)
+            scope = [f'{col} TEXT' if col == 'location' or col == 'series'
+                     else f'{col} INTEGER' for col in table.scope]
+            columns = [f'{col} {sql_type}'
+                       for col, (sql_type, _) in table.columns.items()]
+            key = ', '.join(list(table.scope) + ['pos'])
+            statements.append(
+                f'CREATE TABLE IF NOT EXISTS {table.name} ('
+                + ', '.join(scope + ['pos INTEGER'] + columns
+                            + ['data TEXT NOT NULL', f'PRIMARY KEY ({key})'])
+                + ')')
+            for col in table.indexes:
+                statements.append(
+                    f'CREATE INDEX IF NOT EXISTS {table.name}_{col} '
+                    f'ON {table.name} ({col})')
+            for child, (_, child_columns) in table.children.items():
+                columns = [f'{col} {sql_type}'
+                           for col, (sql_type, _) in child_columns.items()]
+                key = ', '.join(list(table.scope) + ['parent_pos', 'seq'])
+                statements.append(
+                    f'CREATE TABLE IF NOT EXISTS {child} ('
+                    + ', '.join(scope + ['parent_pos INTEGER', 'seq INTEGER']
+                                + columns + ['data TEXT NOT NULL',
+                                             f'PRIMARY KEY ({key})'])
+                    + ')')
+                if child in CHILD_INDEXES:
+                    col = CHILD_INDEXES[child]
+                    statements.append(
+                        f'CREATE INDEX IF NOT EXISTS {child}_{col} '
+                        f'ON {child} ({col})')
+        with self.__connection() as conn, conn:
+            for statement in statements:
+                conn.execute(statement)
+
+    def __clear(self, conn):
+        '''delete everything, before the whole store is written again'''
+        tables = ['kv']
+        for table in list(TABLES.values()) + [MESSAGES]:
+            tables.append(table.name)
+            tables.extend(table.children)
+        for name in set(tables):
+            conn.execute(f'DELETE FROM {name}')
+
+    def __save_segment(self, conn, store, seg_key, positions):
+        '''write one segment's changed items'''
+        key = seg_key[0]
+        if key not in store or key in DERIVED_KEYS:
+            # older versions saved the keys now built when the store is
+            # loaded
+            conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+            return
+
+        if key in SEGMENTED_KEYS:
+            conn.execute('INSERT OR REPLACE INTO kv VALUES (?, ?)',
+                         (key, json.dumps(len(store[key]))))
+            if len(seg_key) == 1:
+                if positions is None:
+                    # every location was replaced
+                    self.__delete(conn, MESSAGES, (key,))
+                    for location_id, items in enumerate(store[key]):
+                        self.__save_items(conn, MESSAGES, (key, location_id),
+                                          items, None)
+                return
+            location_id = seg_key[1]
+            items = store[key][location_id] \
+                if location_id < len(store[key]) else []
+            self.__save_items(conn, MESSAGES, (key, location_id),
+                              items, positions)
+            return
+
+        table = TABLES.get(key)
+        if table is None:
+            conn.execute('INSERT OR REPLACE INTO kv VALUES (?, ?)',
+                         (key, json.dumps(store[key])))
+            return
+        scope = (key,) if table.scope else ()
+        self.__save_items(conn, table, scope, store[key], positions)
+
+    def __save_items(self, conn, table, scope, items, positions):
+        '''rewrite the rows of the given item positions, or all of them'''
+        if positions is None:
+            self.__delete(conn, table, scope)
+            positions = range(len(items))
+        else:
+            for pos in positions:
+                self.__delete(conn, table, scope, pos)
+        for pos in positions:
+            if pos < len(items):
+                self.__insert(conn, table, scope, pos, items[pos])
+
+    def __delete(self, conn, table, scope, pos=None):
+        '''delete a segment's rows, or just the rows of one item'''
+        params = tuple(scope)
+        # a partial scope deletes every segment it covers
+        where = _where(table.scope[:len(params)])
+        if pos is not None:
+            conn.execute(f'DELETE FROM {table.name} {where}'
+                         f'{" AND" if where else "WHERE"} pos = ?',
+                         params + (pos,))
+            for child in table.children:
+                conn.execute(f'DELETE FROM {child} {where}'
+                             f'{" AND" if where else "WHERE"} parent_pos = ?',
+                             params + (pos,))
+            return
+        conn.execute(f'DELETE FROM {table.name} {where}', params)
+        for child in table.children:
+            conn.execute(f'DELETE FROM {child} {where}', params)
+
+    def __insert(self, conn, table, scope, pos, item):
+        '''insert the rows for a single item'''
+        data = item
+        for child, (path, child_columns) in table.children.items():
+            elements = _get(item, path)
+            if not isinstance(elements, list):
+                continue
+            data = _replace(data, path, [])
+            cols = list(table.scope) + ['parent_pos', 'seq'] \
+                + list(child_columns) + ['data']
+            conn.executemany(
+                f'INSERT INTO {child} ({", ".join(cols)}) '
+                f'VALUES ({", ".join("?" * len(cols))})',
+                [tuple(scope) + (pos, seq)
+                 + tuple(_column(element, col_path)
+                         for _, col_path in child_columns.values())
+                 + (json.dumps(element),)
+                 for seq, element in enumerate(elements)])
+
+        cols = list(table.scope) + ['pos'] + list(table.columns) + ['data']
+        conn.execute(
+            f'INSERT INTO {table.name} ({", ".join(cols)}) '
+            f'VALUES ({", ".join("?" * len(cols))})',
+            tuple(scope) + (pos,)
+            + tuple(_column(item, path) for _, path in table.columns.values())
+            + (json.dumps(data),))
+
+    def __load_children(self, conn, table, scope, items, by_location=False):
+        '''put the child table rows back into their items'''
+        for child, (path, _) in table.children.items():
+            cols = 'location_id, parent_pos, data' if by_location \
+                else 'parent_pos, data'
+            order = 'location_id, parent_pos, seq' if by_location \
+                else 'parent_pos, seq'
+            where = 'WHERE location = ?' if by_location else _where(table.scope)
+            for row in conn.execute(
+                    f'SELECT {cols} FROM {child} {where} ORDER BY {order}',
+                    scope):
+                if by_location:
+                    location_id, parent_pos, data = row
+                    item = items[location_id][parent_pos]
+                else:
+                    parent_pos, data = row
+                    item = items[parent_pos]
+                _get(item, path).append(json.loads(data))
+
+
+def _where(scope):
+    '''WHERE clause matching a segment's scope columns'''
+    if not scope:
+        return ''
+    return 'WHERE ' + ' AND '.join(f'{col} = ?' for col in scope)
+
+
+def _get(item, path):
+    '''the value at path inside item, or None if there is not one'''
+    for part in path:
+        try:
+            item = item[part]
+        except (IndexError, KeyError, TypeError):
+            return None
+    return item
+
+
+def _column(item, path):
+    '''a value for an indexed column, containers are stored as json'''
+    value = _get(item, path)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+def _replace(item, path, value):
+    '''a copy of item with the value at path replaced'''
+    copy = dict(item) if isinstance(item, dict) else list(item)
+    if len(path) == 1:
+        copy[path[0]] = value
+    else:
+        copy[path[0]] = _replace(item[path[0]], path[1:], value)
+    return copy
+
+
+def migrate(json_path, db_path):
+    '''
+    One shot conversion of a json data file into a SQLite database
+
+    Arguments:
+        json_path (str) - The json data file to read, along with its
+                          message segments
+        db_path (str) - The database to create (or overwrite)
+
+    Return Value:
+        Returns True if there was a json data file to migrate
+    '''
+    store = read_store(json_path)
+    if store is None:
+        return False
+    backend = SqliteBackend(db_path)
+    backend.save(store, {(): None})
+    backend.close()
+    return True
+
+
+if __name__ == '__main__':
+    # python -m src.sqlite_store [data_store.json] [data_store.db]
+    ARGS = sys.argv[1:] + ['src/data_store.json', 'src/data_store.db'][len(sys.argv[1:]):]
+    if not migrate(ARGS[0], ARGS[1]):
+        sys.exit(f'{ARGS[0]} does not exist')
+    print(f'Migrated {ARGS[0]} to {ARGS[1]}')
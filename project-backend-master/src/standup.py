@@ -10,11 +10,13 @@ Functions:
     standup_active_v1(token, channel_id)
     standup_send_v1(token, channel_id, message)
 '''
-from src.data_store import data_store, SDUP_INIUSER_ID, SDUP_CH_ID, SDUP_T_END_ID, SDUP_MSGS_ID, CH_MEMBER_IDX
+from src.data_store import data_store, SDUP_T_END_ID, SDUP_BUFFER_ID, CH_ID_IDX, \
+    U_HANDLE_IDX, active_standup, is_channel_member, start_standup
 from src.error import InputError, AccessError
 from src.verify_session import verify_session
 from src.other import check_channel_id
 from src.message import message_sendlater_v1
+from src.notifications import find_user
 from datetime import datetime
 
 
@@ -32,15 +34,10 @@ def standup_running(channel_id, data):
     Return Value:
         Return {running_status} (dict | bool)
     '''
-    running_status = False
-
-    for ch_sdup in data['standups']:
-        curr_time = int(datetime.timestamp(datetime.now()))
-        if ch_sdup[SDUP_CH_ID] == channel_id and curr_time < ch_sdup[SDUP_T_END_ID]:
-            running_status = True
+    curr_time = int(datetime.timestamp(datetime.now()))
 
     return {
-        'running_status': running_status,
+        'running_status': active_standup(data, channel_id, curr_time) is not None,
     }
 
 
@@ -76,25 +73,21 @@ def standup_start_v1(token, channel_id, length):
     if length < 0:
         raise InputError('Standup duration cannot be negative')
 
-    if initiator_id not in curr_channel[CH_MEMBER_IDX]:
+    if not is_channel_member(data, initiator_id, curr_channel[CH_ID_IDX]):
         raise AccessError('User is not a member of this channel')
 
     # standup status checker
     if standup_running(channel_id, data)['running_status'] == True:
         raise InputError('A standup is currently running in this channel')
 
+    # the standup's message is sent when it finishes, and its placeholder
+    # text is replaced with the buffer then (see send_messages_later()), or
+    # when the next standup starts if that is sooner (see start_standup())
+    time_finish += length
     new_msg_id = message_sendlater_v1(token, channel_id,
-                                      f'placeholder_{initiator_id}', time_finish)
+                                      f'placeholder_{initiator_id}', time_finish)['message_id']
 
-    for later_msg in data['messages_later']:
-        if later_msg['channel'] == True and \
-           later_msg['location_id'] == channel_id:
-            later_msg['message_data']['message'] = ''
-            data_store.set(data)
-
-    time_finish += length
-    data['standups'].insert(0,
-                            [initiator_id, channel_id, time_finish, new_msg_id])
+    start_standup(data, initiator_id, channel_id, time_finish, new_msg_id)
 
     data_store.set(data)
 
@@ -128,20 +121,17 @@ def standup_active_v1(token, channel_id):
 
     curr_channel = check_channel_id(channel_id)
     initiator_id = verify_session(token)
-    time_finish = None
+    curr_time = int(datetime.timestamp(datetime.now()))
+    standup = active_standup(data, channel_id, curr_time)
 
-    if standup_running(channel_id, data)['running_status'] == False:
-        return {'time_finish': time_finish, }
+    if standup is None:
+        return {'time_finish': None, }
 
-    if initiator_id not in curr_channel[CH_MEMBER_IDX]:
+    if not is_channel_member(data, initiator_id, curr_channel[CH_ID_IDX]):
         raise AccessError('User is not a member of this channel')
 
-    for standup in data['standups']:
-        if standup[SDUP_CH_ID] == channel_id:
-            time_finish = standup[SDUP_T_END_ID]
-
     return {
-        'time_finish': time_finish,
+        'time_finish': standup[SDUP_T_END_ID],
     }
 
 
@@ -179,22 +169,17 @@ def standup_send_v1(token, channel_id, message):
     if len(message) > 1000:
         raise InputError('Message cannot be over 1000 characters in length')
 
-    if standup_running(channel_id, data)['running_status'] == False:
+    curr_time = int(datetime.timestamp(datetime.now()))
+    standup = active_standup(data, channel_id, curr_time)
+    if standup is None:
         raise InputError('No active standup is running in this channel')
 
-    if initiator_id not in curr_channel[CH_MEMBER_IDX]:
+    if not is_channel_member(data, initiator_id, curr_channel[CH_ID_IDX]):
         raise AccessError('User is not a member of this channel')
 
-    new_msg = ''
-    for standup in data['standups']:
-        if standup[SDUP_CH_ID] == channel_id:
-            new_msg += (data['users'][initiator_id - 1]
-                        [5] + ': ' + message + '\n')
-
-    for later_msg in data['messages_later']:
-        if later_msg['channel'] == True and \
-           later_msg['location_id'] == channel_id:
-            later_msg['message_data']['message'] += new_msg
+    # joined into one message when the standup finishes
+    standup[SDUP_BUFFER_ID].append(
+        find_user(initiator_id)[U_HANDLE_IDX] + ': ' + message + '\n')
 
     data_store.set(data)
     return {}
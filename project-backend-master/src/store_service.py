@@ -0,0 +1,330 @@
+'''
+store_service.py:
+
+A store daemon which owns the data and serializes every change made to it,
+used when config.store_backend is 'service' so the server can run as
+several worker processes. The daemon keeps the store in a Datastore of its
+own (config.service_backend), while each worker keeps a replica of it in
+memory and talks to the daemon over a Unix domain socket:
+
+    worker                              daemon
+    SNAPSHOT                    ->
+                                <-      STORE version store
+    BEGIN version               ->      waits for the write lease
+                                <-      UPDATES version ops
+    COMMIT ops                  ->      applies and persists the ops, then
+                                <-      DONE version     releases the lease
+    ABORT                       ->      releases the lease
+                                <-      DONE version
+    SYNC version                ->      (no lease)
+                                <-      UPDATES version ops
+
+Every message is a binary header followed by `length` bytes of json:
+
+    <kind: u8> <version: u64> <length: u32>
+
+ops are the log ops of wal.py, which the worker records as its
+transaction changes its replica. The version counts the commits made so
+far, starting from the time the daemon started so versions from before a
+restart are never mistaken for current ones. The daemon keeps the ops of
+the last config.service_history commits; a worker further behind than that
+is sent a STORE with the whole store instead of UPDATES.
+
+A worker's replica doubles as its cache of the whole workspace: requests
+which only read (channels_listall_v1, users_all_v1, ...) sync it with one
+round trip and are then served from memory, without the write lease.
+
+Classes:
+    StoreService(socket_path, datastore)
+    ServiceClient(socket_path)
+
+Functions:
+    main()
+'''
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import deque
+from os.path import exists
+
+from src import config
+from src.wal import apply
+
+HEADER = struct.Struct('<BQI')
+
+SNAPSHOT = 1
+BEGIN = 2
+SYNC = 3
+COMMIT = 4
+ABORT = 5
+STORE = 6
+UPDATES = 7
+DONE = 8
+ERROR = 9
+
+
+def _send(sock, kind, version=0, payload=b''):
+    '''send one message'''
+    sock.sendall(HEADER.pack(kind, version, len(payload)) + payload)
+
+
+def _receive(sock):
+    '''receive one message as (kind, version, payload), None once closed'''
+    header = _read_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    kind, version, length = HEADER.unpack(header)
+    payload = _read_exactly(sock, length) if length else b''
+    if payload is None:
+        return None
+    return kind, version, payload
+
+
+def _read_exactly(sock, size):
+    '''read size bytes, None if the connection closes first'''
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    '''hands each worker's connection to the service'''
+
+    def handle(self):
+        self.server.service.serve(self.request)
+
+
+class StoreService:
+    '''
+    The daemon, serving the store held by datastore to workers
+    member function:
+        __init__(socket_path, datastore)
+        serve_forever()
+        serve(connection)
+        shutdown()
+        close()
+
+    Only one worker at a time holds the write lease, from its BEGIN until
+    its COMMIT or ABORT (or it disconnects), so every commit is made
+    against the version of the store the worker's replica already has.
+    '''
+
+    def __init__(self, socket_path, datastore):
+        self.__path = socket_path
+        self.__datastore = datastore
+        self.__lease = threading.Lock()
+        self.__lock = threading.Lock()
+        self.__version = time.time_ns()
+        self.__history = deque(maxlen=config.service_history)
+        if exists(socket_path):
+            os.remove(socket_path)
+        self.__server = socketserver.ThreadingUnixStreamServer(socket_path,
+                                                               _Handler)
+        self.__server.daemon_threads = True
+        self.__server.service = self
+
+    def serve_forever(self):
+        '''accept workers until shutdown() is called'''
+        self.__server.serve_forever()
+
+    def serve(self, connection):
+        '''serve one worker's requests until its connection closes'''
+        leased = False
+        try:
+            while True:
+                message = _receive(connection)
+                if message is None:
+                    return
+                kind, version, payload = message
+                if kind == SNAPSHOT:
+                    with self.__lock:
+                        _send(connection, STORE, self.__version,
+                              self.__datastore.dump().encode('utf8'))
+                elif kind in (BEGIN, SYNC):
+                    if kind == BEGIN and not leased:
+                        self.__lease.acquire()
+                        leased = True
+                    self.__send_updates(connection, version)
+                elif kind == COMMIT and leased:
+                    try:
+                        version = self.__commit(payload)
+                    except Exception as err:
+                        _send(connection, ERROR,
+                              payload=repr(err).encode('utf8'))
+                    else:
+                        _send(connection, DONE, version)
+                    finally:
+                        leased = False
+                        self.__lease.release()
+                elif kind in (COMMIT, ABORT):
+                    if leased:
+                        leased = False
+                        self.__lease.release()
+                    _send(connection, DONE, self.__version)
+                else:
+                    _send(connection, ERROR,
+                          payload=f'unknown message {kind}'.encode('utf8'))
+        except OSError:
+            return
+        finally:
+            if leased:
+                self.__lease.release()
+
+    def shutdown(self):
+        '''stop serve_forever(), from another thread'''
+        self.__server.shutdown()
+
+    def close(self):
+        '''stop listening and remove the socket'''
+        self.__server.server_close()
+        if exists(self.__path):
+            os.remove(self.__path)
+
+    def __send_updates(self, connection, version):
+        '''send the ops committed after version, or the whole store'''
+        with self.__lock:
+            if version == self.__version:
+                _send(connection, UPDATES, version, b'[]')
+                return
+            if self.__history and \
+                    self.__history[0][0] - 1 <= version < self.__version:
+                ops = [payload[1:-1] for committed, payload in self.__history
+                       if committed > version and len(payload) > 2]
+                _send(connection, UPDATES, self.__version,
+                      b'[' + b','.join(ops) + b']')
+                return
+            _send(connection, STORE, self.__version,
+                  self.__datastore.dump().encode('utf8'))
+
+    def __commit(self, payload):
+        '''apply and persist a worker's ops, returns the new version'''
+        ops = json.loads(payload)
+        with self.__lock:
+            if ops:
+                with self.__datastore.transaction():
+                    store = self.__datastore.get()
+                    for op in ops:
+                        apply(store, op)
+                    self.__datastore.set(store)
+                self.__version += 1
+                self.__history.append((self.__version, payload))
+            return self.__version
+
+
+class ServiceClient:
+    '''
+    A worker's connection to the StoreService
+    member function:
+        __init__(socket_path)
+        snapshot()
+        begin(version, lease)
+        commit(ops)
+        abort()
+        close()
+
+    `leased` is whether the write lease is held. Calls are not thread safe,
+    the Datastore only makes them with its lock held. A forked child opens
+    a connection of its own.
+    '''
+
+    def __init__(self, socket_path):
+        self.__path = socket_path
+        self.__sock = None
+        self.__pid = None
+        self.leased = False
+
+    def snapshot(self):
+        '''
+        Reads the whole store
+
+        Return Value:
+            Returns (version, store)
+        '''
+        _, version, payload = self.__call(SNAPSHOT)
+        return version, json.loads(payload)
+
+    def begin(self, version, lease=True):
+        '''
+        Catches up with the commits made after version, first taking the
+        write lease if lease is True
+
+        Return Value:
+            Returns (version, updates) where updates is the list of ops to
+            apply, or the whole store (dict) if version is too old
+        '''
+        _, version, payload = self.__call(BEGIN if lease else SYNC, version)
+        self.leased = self.leased or lease
+        return version, json.loads(payload)
+
+    def commit(self, ops):
+        '''
+        Commits ops (each already json) and releases the write lease
+
+        Return Value:
+            Returns the version the commit made
+        '''
+        self.leased = False
+        _, version, _ = self.__call(
+            COMMIT, payload=('[' + ','.join(ops) + ']').encode('utf8'))
+        return version
+
+    def abort(self):
+        '''release the write lease without committing anything'''
+        if self.leased:
+            self.leased = False
+            self.__call(ABORT)
+
+    def close(self):
+        '''close the connection, which releases the lease if held'''
+        if self.__sock is not None and self.__pid == os.getpid():
+            self.__sock.close()
+        self.__sock = None
+        self.__pid = None
+        self.leased = False
+
+    def __call(self, kind, version=0, payload=b''):
+        '''send a request and wait for its reply'''
+        if self.__pid != os.getpid():
+            # a forked child must not share its parent's connection
+            self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.__sock.connect(self.__path)
+            self.__pid = os.getpid()
+            self.leased = False
+        _send(self.__sock, kind, version, payload)
+        reply = _receive(self.__sock)
+        if reply is None:
+            self.close()
+            raise ConnectionError('the store service closed the connection')
+        if reply[0] == ERROR:
+            raise ConnectionError(reply[2].decode('utf8'))
+        return reply
+
+
+def main():
+    '''run the daemon until interrupted: python -m src.store_service'''
+    # this process is the one which keeps the store on disk
+    config.store_backend = config.service_backend
+    from src.data_store import data_store
+    service = StoreService(config.store_socket, data_store)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        data_store.close()
+
+
+if __name__ == '__main__':
+    main()
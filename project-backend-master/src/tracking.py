@@ -0,0 +1,500 @@
+'''
+tracking.py:
+
+Change tracking containers used by the Datastore. The workspace is built out
+of TrackedDict and TrackedList objects, which behave exactly like dict and
+list but report every mutation to the Datastore that owns them. This lets the
+Datastore know what a request changed without diffing the whole workspace.
+
+Every container belongs to a segment, which is one of:
+    ()                  - the root store dict
+    ('users',)          - a top level key of the store
+    ('messages', 3)     - one channel's (or dm's) message list
+Below the root of a segment, every container also belongs to an item: the
+element of the segment root it lives in (e.g. one user or one message).
+
+Plain dicts and lists stored into a tracked container are copied into
+tracked ones. Tracked containers moved to another part of the store are
+re-tagged in place, so references held by the caller stay live.
+
+The outer lists of the segmented keys are SegmentedLists, whose segments
+can be left on disk until they are first used (see SegmentedList).
+
+Classes:
+    Segment(key, owner)
+    TrackedDict
+    TrackedList
+    SegmentedList
+    Unloaded(key)
+
+Functions:
+    track(value, segment, item, force)
+    find_path(item, target)
+    undo(container, op, key, old)
+'''
+
+from contextlib import nullcontext
+
+SEGMENTED_KEYS = ('messages', 'dm_messages')
+
+# Top level keys which are never saved, but worked out from the locations of
+# the segmented keys whenever the store is read in
+DERIVED_KEYS = ('message_index', 'message_tombstones')
+
+# Marker passed as `item` for a container that is itself an item root
+ITEM_ROOT = object()
+
+# Marker for the old value of a dict key which did not exist
+MISSING = object()
+
+
+class Segment:
+    '''
+    A unit of persistence. `owner` is the object notified of mutations
+    through owner.on_change(container, op, key, value, old), or None. `lock`
+    is held while a container in the segment is mutated and its owner told.
+    '''
+    __slots__ = ('key', 'owner', 'lock')
+
+    def __init__(self, key, owner=None, lock=None):
+        self.key = key
+        self.owner = owner
+        self.lock = nullcontext() if lock is None else lock
+
+    def child(self, key):
+        '''The segment a direct child of this segment's root is stored in'''
+        if self.key == ():
+            new_key = (key,)
+        elif len(self.key) == 1 and self.key[0] in SEGMENTED_KEYS:
+            new_key = (self.key[0], key)
+        else:
+            return None
+        if self.owner is not None:
+            return self.owner.segment(new_key)
+        return Segment(new_key)
+
+
+def track(value, segment, item=None, force=False):
+    '''
+    Returns value converted into tracked containers belonging to segment.
+
+    Arguments:
+        value - Any json compatible value
+        segment (Segment) - The segment the value is stored in
+        item - The item root the value lives in, ITEM_ROOT if value is an
+               item root, or None if value is the root of segment
+        force (bool) - Re-tag containers which already look correctly tagged
+
+    Return Value:
+        The tracked value (scalars are returned unchanged)
+    '''
+    if isinstance(value, dict):
+        if isinstance(value, TrackedDict):
+            if not force and _tagged(value, segment, item):
+                return value
+            container = value
+        else:
+            container = TrackedDict()
+        _tag(container, segment, item)
+        for key, child in list(value.items()):
+            dict.__setitem__(container, key,
+                             _adopt(container, key, child, force))
+        return container
+
+    if isinstance(value, list):
+        cls = SegmentedList if _segmented(segment, item) else TrackedList
+        if isinstance(value, TrackedList):
+            if not force and type(value) is cls \
+                    and _tagged(value, segment, item):
+                return value
+            container = value
+            # placeholders are kept, unless the list stops being segmented
+            children = enumerate(list.copy(value) if cls is SegmentedList
+                                 else list(value))
+            container.__class__ = cls
+        else:
+            container = cls()
+            children = enumerate(value)
+        _tag(container, segment, item)
+        for idx, child in children:
+            child = _adopt(container, idx, child, force)
+            if idx < len(container):
+                list.__setitem__(container, idx, child)
+            else:
+                list.append(container, child)
+        return container
+
+    return value
+
+
+def find_path(item, target):
+    '''
+    Returns the list of keys leading from item to the nested container
+    target, or None if target is not inside item.
+    '''
+    if item is target:
+        return []
+    if isinstance(item, dict):
+        children = item.items()
+    elif isinstance(item, list):
+        children = enumerate(item)
+    else:
+        return None
+    for key, child in children:
+        if isinstance(child, (dict, list)):
+            path = find_path(child, target)
+            if path is not None:
+                return [key] + path
+    return None
+
+
+def _segmented(segment, item):
+    '''Whether a container is the outer list of a segmented key'''
+    return item is None and len(segment.key) == 1 \
+        and segment.key[0] in SEGMENTED_KEYS
+
+
+def _tag(container, segment, item):
+    '''Set the segment and item a container belongs to'''
+    container._seg = segment
+    container._item = container if item is ITEM_ROOT else item
+
+
+def _tagged(container, segment, item):
+    '''Whether a container is already tagged with segment and item'''
+    if container._seg is not segment:
+        return False
+    if item is ITEM_ROOT:
+        return container._item is container
+    return container._item is item
+
+
+def _adopt(parent, key, value, force=False):
+    '''Track a value being stored under parent[key]'''
+    if not isinstance(value, (dict, list)):
+        return value
+    if parent._item is not None:
+        return track(value, parent._seg, parent._item, force)
+    child_segment = parent._seg.child(key)
+    if child_segment is not None:
+        return track(value, child_segment, None, force)
+    return track(value, parent._seg, ITEM_ROOT, force)
+
+
+def _notify(container, op, key=None, value=None, old=MISSING):
+    '''Tell the owner of container's segment about a mutation'''
+    owner = container._seg.owner
+    if owner is not None:
+        owner.on_change(container, op, key, value, old)
+
+
+def _readopt(container, everything=False):
+    '''
+    Re-track the children of a list after a structural change. Needed for
+    new values stored through a slice, and for the outer message lists
+    whose children's segments are keyed by their position.
+    '''
+    if everything or isinstance(container, SegmentedList):
+        for idx, child in enumerate(list.copy(container)):
+            list.__setitem__(container, idx, _adopt(container, idx, child))
+
+
+def _list_index(container, index):
+    '''Normalise a (possibly negative) index the way list does'''
+    if index < 0:
+        index += len(container)
+    return index
+
+
+class TrackedList(list):
+    '''A list which reports its mutations to its segment's owner'''
+    __slots__ = ('_seg', '_item')
+
+    def __reduce_ex__(self, protocol):
+        # copies of tracked containers are plain lists
+        return (list, (list(self),))
+
+    def __setitem__(self, index, value):
+        with self._seg.lock:
+            if isinstance(index, slice):
+                old = list.copy(self)
+                list.__setitem__(self, index, list(value))
+                _readopt(self, everything=True)
+                _notify(self, 'replace', old=old)
+            else:
+                index = _list_index(self, index)
+                old = list.__getitem__(self, index)
+                value = _adopt(self, index, value)
+                list.__setitem__(self, index, value)
+                _notify(self, 'put', index, value, old)
+
+    def __delitem__(self, index):
+        with self._seg.lock:
+            if isinstance(index, slice):
+                old = list.copy(self)
+                list.__delitem__(self, index)
+                _readopt(self)
+                _notify(self, 'replace', old=old)
+            else:
+                index = _list_index(self, index)
+                old = list.__getitem__(self, index)
+                list.__delitem__(self, index)
+                _readopt(self)
+                _notify(self, 'del', index, old=old)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, count):
+        with self._seg.lock:
+            old = list.copy(self)
+            list.__imul__(self, count)
+            _readopt(self)
+            _notify(self, 'replace', old=old)
+            return self
+
+    def append(self, value):
+        with self._seg.lock:
+            value = _adopt(self, len(self), value)
+            list.append(self, value)
+            _notify(self, 'append', None, value)
+
+    def extend(self, values):
+        for value in list(values):
+            self.append(value)
+
+    def insert(self, index, value):
+        with self._seg.lock:
+            index = min(max(_list_index(self, index), 0), len(self))
+            value = _adopt(self, index, value)
+            list.insert(self, index, value)
+            _readopt(self)
+            _notify(self, 'insert', index, value)
+
+    def pop(self, index=-1):
+        with self._seg.lock:
+            index = _list_index(self, index)
+            value = list.pop(self, index)
+            _readopt(self)
+            _notify(self, 'del', index, old=value)
+            return value
+
+    def remove(self, value):
+        del self[self.index(value)]
+
+    def clear(self):
+        with self._seg.lock:
+            old = list.copy(self)
+            list.clear(self)
+            _notify(self, 'clear', old=old)
+
+    def sort(self, *, key=None, reverse=False):
+        with self._seg.lock:
+            old = list.copy(self)
+            list.sort(self, key=key, reverse=reverse)
+            _readopt(self)
+            _notify(self, 'replace', old=old)
+
+    def reverse(self):
+        with self._seg.lock:
+            old = list.copy(self)
+            list.reverse(self)
+            _readopt(self)
+            _notify(self, 'replace', old=old)
+
+
+class Unloaded:
+    '''Stands in for a segment which is still on disk, see SegmentedList'''
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __repr__(self):
+        return f'Unloaded({self.key!r})'
+
+
+class SegmentedList(TrackedList):
+    '''
+    The outer list of a segmented key, e.g. store['messages']. Elements may
+    be Unloaded placeholders, which are read in through
+    owner.load_segment(key) the first time they are accessed, and every
+    access is reported through owner.segment_used(segment) so the owner can
+    tell which segments are idle. Changes which would move elements to
+    another position load every element first, so a placeholder's key is
+    always its position.
+    '''
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[idx] for idx in range(*index.indices(len(self)))]
+        value = list.__getitem__(self, index)
+        if isinstance(value, Unloaded):
+            value = self._load(_list_index(self, index))
+        owner = self._seg.owner
+        if owner is not None and isinstance(value, TrackedList):
+            owner.segment_used(value._seg)
+        return value
+
+    def __iter__(self):
+        index = 0
+        while index < len(self):
+            yield self[index]
+            index += 1
+
+    def __reversed__(self):
+        for index in range(len(self) - 1, -1, -1):
+            yield self[index]
+
+    def __contains__(self, value):
+        return any(item is value or item == value for item in self)
+
+    def __eq__(self, other):
+        return list(self) == other
+
+    def __ne__(self, other):
+        return list(self) != other
+
+    def __add__(self, other):
+        return list(self) + other
+
+    def copy(self):
+        return list(self)
+
+    def index(self, *args):
+        return list(self).index(*args)
+
+    def count(self, value):
+        return list(self).count(value)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._load_all()
+        TrackedList.__setitem__(self, index, value)
+
+    def __delitem__(self, index):
+        self._load_all()
+        TrackedList.__delitem__(self, index)
+
+    def __imul__(self, count):
+        self._load_all()
+        return TrackedList.__imul__(self, count)
+
+    def insert(self, index, value):
+        self._load_all()
+        TrackedList.insert(self, index, value)
+
+    def pop(self, index=-1):
+        self._load_all()
+        return TrackedList.pop(self, index)
+
+    def sort(self, *, key=None, reverse=False):
+        self._load_all()
+        TrackedList.sort(self, key=key, reverse=reverse)
+
+    def reverse(self):
+        self._load_all()
+        TrackedList.reverse(self)
+
+    def _load(self, index):
+        '''Replace the placeholder at index with the segment it stands for'''
+        with self._seg.lock:
+            value = list.__getitem__(self, index)
+            if isinstance(value, Unloaded):
+                value = _adopt(self, index,
+                               self._seg.owner.load_segment(value.key))
+                list.__setitem__(self, index, value)
+            return value
+
+    def _load_all(self):
+        '''Load every placeholder'''
+        for index in range(len(self)):
+            if isinstance(list.__getitem__(self, index), Unloaded):
+                self._load(index)
+
+
+class TrackedDict(dict):
+    '''A dict which reports its mutations to its segment's owner'''
+    __slots__ = ('_seg', '_item')
+
+    def __reduce_ex__(self, protocol):
+        # copies of tracked containers are plain dicts
+        return (dict, (dict(self),))
+
+    def __setitem__(self, key, value):
+        with self._seg.lock:
+            old = dict.get(self, key, MISSING)
+            value = _adopt(self, key, value)
+            dict.__setitem__(self, key, value)
+            _notify(self, 'put', key, value, old)
+
+    def __delitem__(self, key):
+        with self._seg.lock:
+            old = dict.__getitem__(self, key)
+            dict.__delitem__(self, key)
+            _notify(self, 'del', key, old=old)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *default):
+        with self._seg.lock:
+            if key not in self:
+                return dict.pop(self, key, *default)
+            value = dict.__getitem__(self, key)
+            del self[key]
+            return value
+
+    def popitem(self):
+        with self._seg.lock:
+            key, value = dict.popitem(self)
+            _notify(self, 'del', key, old=value)
+            return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        with self._seg.lock:
+            old = dict(self)
+            dict.clear(self)
+            _notify(self, 'clear', old=old)
+
+
+def undo(container, op, key, old):
+    '''
+    Reverses a mutation reported through on_change, without reporting it.
+    Mutations must be undone newest first.
+    '''
+    if op in ('clear', 'replace'):
+        if isinstance(container, dict):
+            dict.clear(container)
+            dict.update(container, old)
+        else:
+            list.__setitem__(container, slice(None), old)
+    elif op == 'append':
+        list.pop(container)
+    elif op == 'insert':
+        list.pop(container, key)
+    elif op == 'put':
+        if isinstance(container, dict):
+            if old is MISSING:
+                dict.__delitem__(container, key)
+            else:
+                dict.__setitem__(container, key, old)
+        else:
+            list.__setitem__(container, key, old)
+    elif op == 'del':
+        if isinstance(container, dict):
+            dict.__setitem__(container, key, old)
+        else:
+            list.insert(container, key, old)
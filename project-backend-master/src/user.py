@@ -17,14 +17,13 @@ Functions:
 '''
 import jwt
 import sys
-from src.message import check_message_send_later
 from datetime import datetime
 from src import auth
 from src.config import url
 from unicodedata import name
 from signal import SIG_DFL
 import re
-from src.verify_session import verify_session
+from src.verify_session import forget_tokens, verify_session
 from src.other import SECRET, check_channel_id, clear_v1
 from urllib import request as im_request
 import certifi
@@ -33,7 +32,9 @@ from src.error import AccessError
 from src.error import InputError
 from src.data_store import CH_MEMBER_IDX, CH_OWN_IDX, DM_MEMBERS_IDX, \
     DM_OWN_IDX, U_EMAIL_IDX, U_HANDLE_IDX, U_ID_IDX, U_NAME_FIRST_IDX, \
-    U_NAME_LAST_IDX, U_PFP_IDX, data_store
+    U_NAME_LAST_IDX, U_PFP_IDX, channel_by_id, data_store, dm_by_id, is_removed, memberships, \
+    remove_membership, remove_user_sessions, set_user_email, set_user_handle, user_by_email, user_by_handle, \
+    user_by_id
 from flask import request
 from jwt import decode
 import requests
@@ -107,9 +108,8 @@ def upload_pic(token, img_url, x_start, y_start, x_end, y_end):
 
     img = img.save(f"./src/pfps/{auth_user_id}.jpg")
 
-    for user in store['users']:
-        if user[U_ID_IDX] == auth_user_id:
-            user[U_PFP_IDX] = f"{BASE_URL}/imgurl/{auth_user_id}.jpg"
+    user_by_id(store, auth_user_id)[U_PFP_IDX] = \
+        f"{BASE_URL}/imgurl/{auth_user_id}.jpg"
     data_store.set(store)
     return {}
 
@@ -140,14 +140,11 @@ def remove_user_v1(auth_user_id, u_id):
     # Checks
     if auth_user_id not in global_owners:
         raise AccessError("the authorised user is not a global owner")
-    found = False
-    for user in store['users']:
-        if user[U_ID_IDX] == u_id:
-            found = True
-            u_email = user[U_EMAIL_IDX]
-            u_handle = user[U_HANDLE_IDX]
-    if found is False:
+    user = user_by_id(store, u_id)
+    if user is None:
         raise InputError(description="u_id does not refer to a valid user")
+    u_email = user[U_EMAIL_IDX]
+    u_handle = user[U_HANDLE_IDX]
     if [u_id] == global_owners:
         raise InputError(
             description="u_id refers to a user who is the only global owner")
@@ -157,22 +154,19 @@ def remove_user_v1(auth_user_id, u_id):
     store['removed_emails'].append(u_email)
     store['removed_handles'].append(u_handle)
 
-    for user in store['users']:
-        if user[U_ID_IDX] == u_id:
-            user[U_NAME_FIRST_IDX] = "Removed"
-            user[U_NAME_LAST_IDX] = "user"
+    user[U_NAME_FIRST_IDX] = "Removed"
+    user[U_NAME_LAST_IDX] = "user"
     # Remove from chs
-    channels = store['channels']
-    for channel in channels:
+    for channel_id in list(memberships(store, 'user_channels', u_id)):
+        channel = channel_by_id(store, channel_id)
         if u_id in channel[CH_OWN_IDX]:
             channel[CH_OWN_IDX].remove(u_id)
-        if u_id in channel[CH_MEMBER_IDX]:
-            channel[CH_MEMBER_IDX].remove(u_id)
+        channel[CH_MEMBER_IDX].remove(u_id)
+        remove_membership(store, 'user_channels', u_id, channel_id)
 
-    # Remove from dms
-
-    dms = store['dms']
-    for dm in dms:
+    # Remove from dms (an owner who has left is no longer a member)
+    for dm_id in list(memberships(store, 'user_dms', u_id)):
+        dm = dm_by_id(store, dm_id)
         removed = None
         # owner of dm
         if u_id == dm[DM_OWN_IDX]['owner_info'][U_ID_IDX]:
@@ -186,24 +180,17 @@ def remove_user_v1(auth_user_id, u_id):
         # remove the remembered entry from the dm users
         if removed != None:
             dm[DM_MEMBERS_IDX].remove(removed)
+        remove_membership(store, 'user_dms', u_id, dm_id)
 
     # Change all sent messages to Removed user
     message_lists = (store['messages'], store['dm_messages'])
     for message_list in message_lists:
         for channel in message_list:
             for message in channel:
-                if message['u_id'] == u_id:
+                if not is_removed(message) and message['u_id'] == u_id:
                     message['message'] = "Removed user"
     # remove token from valid sessions
-
-    sessions = store['sessions']
-
-    for session in sessions:
-        curr_uid = jwt.decode(session, SECRET, algorithms=[
-                              "HS256"])['auth_user_id']
-        if curr_uid == u_id:
-            print("HERE")
-            sessions.remove(session)
+    forget_tokens(remove_user_sessions(store, u_id))
 
     data_store.set(store)
     return {}
@@ -226,8 +213,6 @@ def user_set_handle(auth_user_id, handle_str):
     Return Value:
         Returns {}
     '''
-    u_id_idx = 0
-    u_handle_idx = 5
     store = data_store.get()
 
     if len(handle_str) < 3 or len(handle_str) > 20:
@@ -237,14 +222,11 @@ def user_set_handle(auth_user_id, handle_str):
     if handle_str.isalnum() is False:
         raise InputError(
             description="Handle contains non alpahnumeric characters")
-    for user in store['users']:
-        if user[u_handle_idx] == handle_str:
-            raise InputError(
-                description="Handle is already in user by another user")
+    if user_by_handle(store, handle_str) is not None:
+        raise InputError(
+            description="Handle is already in user by another user")
 
-    for user in store['users']:
-        if user[u_id_idx] == auth_user_id:
-            user[u_handle_idx] = handle_str
+    set_user_handle(store, user_by_id(store, auth_user_id), handle_str)
 
     for dm in store['dms']:
         if dm[DM_OWN_IDX]['owner_info'][0] == auth_user_id:
@@ -282,22 +264,14 @@ def change_userpermission(auth_user_id, u_id, permission_id):
     Return Value:
         Returns {}
     '''
-    id_idx = 0
     store = data_store.get()
 
     global_owners = store['global_owner']
     if auth_user_id not in global_owners:
         raise AccessError(
             description="The authorised user is not a global owner")
-    valid_user = False
-
-    for user in store['users']:
-        if user[id_idx] == u_id:
-            valid_user = True
-            break
-
     valid_pid = (1, 2)
-    if valid_user is False:
+    if user_by_id(store, u_id) is None:
         raise InputError(description="u_id does not refer to a valid user")
 
     elif global_owners == [u_id] and permission_id == 2:
@@ -351,10 +325,9 @@ def user_profile_setname_v1(auth_user_id, name_first, name_last):
             description="You must enter both a first name and a last name")
 
     else:
-        for user in store['users']:
-            if user[U_ID_IDX] == auth_user_id:
-                user[U_NAME_FIRST_IDX] = name_first
-                user[U_NAME_LAST_IDX] = name_last
+        user = user_by_id(store, auth_user_id)
+        user[U_NAME_FIRST_IDX] = name_first
+        user[U_NAME_LAST_IDX] = name_last
 
     for dm in store['dms']:
         if dm[DM_OWN_IDX]['owner_info'][0] == auth_user_id:
@@ -399,14 +372,10 @@ def user_profile_setemail_v1(auth_user_id, email):
     if match is None:
         raise InputError(description="Invalid email format")
 
-    for user in store['users']:
-        if user[U_EMAIL_IDX] == email:
-            raise InputError(description="Email already in use")
+    if user_by_email(store, email) is not None:
+        raise InputError(description="Email already in use")
 
-    else:
-        for user in store['users']:
-            if user[U_ID_IDX] == auth_user_id:
-                user[U_EMAIL_IDX] = email
+    set_user_email(store, user_by_id(store, auth_user_id), email)
 
     for dm in store['dms']:
         if dm[DM_OWN_IDX]['owner_info'][0] == auth_user_id:
@@ -441,14 +410,11 @@ def user_profile_v1(user_id, token):
 
     verify_session(token)
     store = data_store.get()
-    user_dict = {}
-    for user in store['users']:
-        if int(user[U_ID_IDX]) == int(user_id):
-            user_dict = {'u_id': user_id, 'email': user[U_EMAIL_IDX], 'name_first': user[U_NAME_FIRST_IDX],
-                         'name_last': user[U_NAME_LAST_IDX], 'handle_str': user[U_HANDLE_IDX], "profile_img_url": user[U_PFP_IDX]}
-            break
-    if not user_dict:
+    user = user_by_id(store, int(user_id))
+    if user is None:
         raise InputError(description="u_id does not refer to a valid user")
+    user_dict = {'u_id': user_id, 'email': user[U_EMAIL_IDX], 'name_first': user[U_NAME_FIRST_IDX],
+                 'name_last': user[U_NAME_LAST_IDX], 'handle_str': user[U_HANDLE_IDX], "profile_img_url": user[U_PFP_IDX]}
     return {"user": user_dict}
 
 
@@ -472,7 +438,6 @@ def user_stats_v1(token):
             'involvement_rate': float
     '''
     auth_user_id = verify_session(token)
-    check_message_send_later(token)
 
     store = data_store.get()
     for user in store['channel_track']:
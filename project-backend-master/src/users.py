@@ -9,11 +9,10 @@ Functions:
     users_stats_v1(token)
     get_members_in_channel_or_dm()
 '''
-from src.data_store import CH_MEMBER_IDX, DM_MEMBERS_IDX, data_store, U_ID_IDX, U_EMAIL_IDX,\
+from src.data_store import data_store, U_ID_IDX, U_EMAIL_IDX,\
     U_PFP_IDX, U_NAME_FIRST_IDX, U_NAME_LAST_IDX, U_HANDLE_IDX
 from src.error import InputError
 from src.error import AccessError
-from src.message import check_message_send_later
 from src.verify_session import verify_session
 
 
@@ -74,7 +73,6 @@ def users_stats_v1(token):
             'utilization_rate': float
     '''
     verify_session(token)
-    check_message_send_later(token)
 
     data = users_all_v1()
     total_num_users = len(data['users'])
@@ -105,21 +103,9 @@ def get_members_in_channel_or_dm():
     '''
 
     store = data_store.get()
-    # a list of u_ids that are in at least 1 channel or dm
-    in_ch_or_dm = []
-    # go through all channels and append each user that is in a channel.
-    # only count each member once, even if they are in multiple channels
-    for channel in store['channels']:
-        for user in channel[CH_MEMBER_IDX]:
-            if user not in in_ch_or_dm:
-                in_ch_or_dm.append(user)
-
-    # go through all dms and append each user that is in a dm
-    # don't repeat users, so if they are already in the list, don't append
-    for dm in store['dms']:
-        for user in dm[DM_MEMBERS_IDX]:
-            if user[0] not in in_ch_or_dm:
-                in_ch_or_dm.append(user[0])
+    # a user is in the membership indexes only while they are in at least
+    # 1 channel or dm, so each member is counted once
+    in_ch_or_dm = set(store['user_channels']) | set(store['user_dms'])
 
     # the number of people in at least 1 channel or dm
     one_ch_or_dm = len(in_ch_or_dm)
@@ -3,13 +3,44 @@ verify_session.py:
 
 A helper file designed to validate whether a user is currently logged in.
 
+The claims of each token are decoded once and kept in a least recently used
+cache of config.token_cache_size tokens, so clients making request after
+request with the same token skip verifying its signature each time. A token
+never changes, so a cached entry can only go stale by its session ending,
+which verify_session() checks in the store before using the cache.
+
+Sessions expire (see config.session_idle_ttl and config.session_ttl).
+verify_session() only notes in memory when each token was used, as
+writing to the store on every request would turn reads into writes. Once
+the first session is verified, a sweeper thread starts in the process.
+Every config.session_sweep_interval seconds it writes those times into
+store['session_times'] and ends the expired sessions.
+
 Functions:
     verify_session(user_token)
+    decode_token(user_token)
+    forget_tokens(tokens)
+    session_expired(store, user_token, now)
+    sweep_sessions(now)
 '''
+import os
+import threading
+import time
+from collections import OrderedDict
 import jwt
-from src.data_store import data_store, U_ID_IDX
+from src import config
+from src.data_store import data_store, has_session, remove_session, U_ID_IDX
 from src.error import AccessError
 
+# {token: claims}, least recently used first
+_claims = OrderedDict()
+_claims_lock = threading.Lock()
+
+# {token: when it was last used}, since the sweeper last wrote them down
+_seen = {}
+_seen_lock = threading.Lock()
+_sweeper = {'thread': None, 'pid': None}
+
 
 def verify_session(user_token):
     '''
@@ -25,17 +56,151 @@ def verify_session(user_token):
     # Session is valid if it exists in the session store
     #
     store = data_store.get()
-    found_session = False
-    for session in store['sessions']:
-        if user_token == session:
-            found_session = True
-            break
+    now = int(time.time())
+    found_session = has_session(store, user_token) and \
+        not session_expired(store, user_token, now)
 
     if found_session:
-        data = jwt.decode(user_token, key="BADGER", algorithms=['HS256'])
+        data = decode_token(user_token)
         auth_user_id = data['auth_user_id']
+        with _seen_lock:
+            _seen[user_token] = now
+        _start_sweeper()
     else:
         raise AccessError(
             description="User not authorised (not logged in)") from AccessError
 
     return auth_user_id
+
+
+def decode_token(user_token):
+    '''
+    Decodes a token, checking its signature the first time it is seen
+
+    Arguments:
+        user_token (str) - The json web token
+
+    Return Value:
+        Returns the token's claims (dict), which must not be changed
+    '''
+    with _claims_lock:
+        claims = _claims.get(user_token)
+        if claims is not None:
+            _claims.move_to_end(user_token)
+            return claims
+
+    claims = jwt.decode(user_token, key="BADGER", algorithms=['HS256'])
+    with _claims_lock:
+        _claims[user_token] = claims
+        while len(_claims) > config.token_cache_size:
+            _claims.popitem(last=False)
+    return claims
+
+
+def forget_tokens(tokens):
+    '''
+    Drops the claims of tokens whose sessions have ended from the cache
+
+    Arguments:
+        tokens (list) - The json web tokens
+    '''
+    with _claims_lock:
+        for token in tokens:
+            _claims.pop(token, None)
+    with _seen_lock:
+        for token in tokens:
+            _seen.pop(token, None)
+
+
+def session_expired(store, user_token, now):
+    '''
+    Whether a current session has been idle too long or is too old
+
+    Arguments:
+        store (dict) - The store, as returned by data_store.get()
+        user_token (str) - A token in store['sessions']
+        now (int) - The time in seconds
+
+    Return Value:
+        Returns True or False
+    '''
+    issued, last_seen = store['session_times'][user_token]
+    with _seen_lock:
+        last_seen = max(last_seen, _seen.get(user_token, 0))
+    return now - issued >= config.session_ttl or \
+        now - last_seen >= config.session_idle_ttl
+
+
+def sweep_sessions(now):
+    '''
+    Writes down when this process last saw each session used, then ends
+    the sessions which have expired, config.session_sweep_batch per
+    transaction so requests are not held up for long
+
+    Arguments:
+        now (int) - The time in seconds
+
+    Return Value:
+        Returns the tokens whose sessions were ended (list)
+    '''
+    with _seen_lock:
+        seen = dict(_seen)
+    if seen:
+        with data_store.transaction():
+            store = data_store.get()
+            times = store['session_times']
+            for token, last_seen in seen.items():
+                if token in times and times[token][1] < last_seen:
+                    times[token][1] = last_seen
+            data_store.set(store)
+        with _seen_lock:
+            for token, last_seen in seen.items():
+                if _seen.get(token) == last_seen:
+                    del _seen[token]
+
+    # find them in a snapshot, without holding up requests which write
+    with data_store.transaction(shared=True):
+        store = data_store.get()
+        expired = [token for token in store['session_times']
+                   if session_expired(store, token, now)]
+
+    ended = []
+    batch = config.session_sweep_batch
+    for start in range(0, len(expired), batch):
+        with data_store.transaction():
+            store = data_store.get()
+            for token in expired[start:start + batch]:
+                # it may have been used or ended since the snapshot
+                if has_session(store, token) and \
+                        session_expired(store, token, now):
+                    remove_session(store, token)
+                    ended.append(token)
+            data_store.set(store)
+    forget_tokens(ended)
+    return ended
+
+
+def _start_sweeper():
+    '''start this process' sweeper thread if it is not running'''
+    if _sweeper['pid'] == os.getpid():
+        return
+    with _seen_lock:
+        # a forked worker does not inherit its parent's thread
+        if _sweeper['pid'] == os.getpid():
+            return
+        _sweeper['pid'] = os.getpid()
+        _sweeper['thread'] = threading.Thread(target=_run_sweeper,
+                                              name='session-sweeper',
+                                              daemon=True)
+        _sweeper['thread'].start()
+
+
+def _run_sweeper():
+    '''sweep every session_sweep_interval seconds for the life of the process'''
+    while True:
+        time.sleep(config.session_sweep_interval)
+        try:
+            sweep_sessions(int(time.time()))
+        except Exception as err:
+            # try again next time rather than leave sessions unswept for good
+            print('session sweep failed', err)
@@ -0,0 +1,227 @@
+'''
+wal.py:
+
+Append-only write ahead log used by the Datastore in 'journal' mode. Each
+committed transaction appends one record: a single line of json holding the
+list of changes made to the store since the previous record.
+
+Record format: {"ops": [op, op, ...]} where each op is one of
+    ["set", key, value]                   store[key] = value
+    ["unset", key]                        del store[key]
+    ["reset", value]                      the whole store is replaced
+    ["put", seg, key, value]              segment[key] = value
+    ["del", seg, key]                     del segment[key]
+    ["append", seg, value]                segment.append(value)
+    ["insert", seg, index, value]         segment.insert(index, value)
+    ["clear", seg]                        segment.clear()
+    ["replace", seg, value]               the whole segment is replaced
+    ["append_in", seg, key, path, value]  segment[key][path...].append(value)
+and seg is the key of the segment, e.g. ["users"] or ["messages", 3].
+
+Classes:
+    WriteAheadLog(path, fsync, fsync_interval)
+
+Functions:
+    read_records(path)
+    apply(store, op)
+'''
+import json
+import os
+import threading
+from os.path import exists
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class WriteAheadLog:
+    '''
+    An open log file which records are appended to
+    member function:
+        __init__(path, fsync, fsync_interval)
+        append(ops)
+        commit(lsn)
+        size()
+        sync(lsn)
+        rotate(new_path)
+        close()
+
+    fsync controls when appended records are forced to disk:
+        'always'   - before commit() returns
+        'interval' - by a background thread every fsync_interval milliseconds
+        'never'    - whenever the operating system decides to
+
+    Records are numbered by a log sequence number (lsn) which counts up from
+    1 for the life of the object. Threads waiting on sync() at the same time
+    share a single fsync: the first becomes the leader and forces every
+    record appended so far to disk, the others wait for it to finish.
+    '''
+
+    def __init__(self, path, fsync='interval', fsync_interval=100):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'unknown fsync policy {fsync!r}')
+        self.__path = path
+        self.__fsync = fsync
+        self.__lock = threading.Lock()
+        self.__synced = threading.Condition()
+        self.__lsn = 0
+        self.__synced_lsn = 0
+        self.__syncing = False
+        self.__closing = threading.Event()
+        self.__file = open(path, 'ab')
+        self.__syncer = None
+        if fsync == 'interval':
+            self.__syncer = threading.Thread(target=self.__run_syncer,
+                                             args=(fsync_interval / 1000,),
+                                             name='data_store-wal-sync',
+                                             daemon=True)
+            self.__syncer.start()
+
+    def append(self, ops):
+        '''
+        Appends one record to the log, without waiting for it to reach disk
+
+        Arguments:
+            ops (list of str) - The json encoded ops making up the record
+
+        Return Value:
+            Returns the lsn of the record
+        '''
+        line = ('{"ops": [' + ', '.join(ops) + ']}\n').encode('utf8')
+        with self.__lock:
+            self.__file.write(line)
+            self.__file.flush()
+            self.__lsn += 1
+            return self.__lsn
+
+    def commit(self, lsn):
+        '''wait until record lsn is as durable as the fsync policy promises'''
+        if self.__fsync == 'always':
+            self.sync(lsn)
+
+    def size(self):
+        '''the number of bytes currently in the log'''
+        with self.__lock:
+            return self.__file.tell()
+
+    def sync(self, lsn=None):
+        '''force every record up to lsn (default: all of them) to disk'''
+        with self.__synced:
+            if lsn is None:
+                lsn = self.__lsn
+            while self.__synced_lsn < lsn:
+                if self.__syncing:
+                    self.__synced.wait()
+                    continue
+                self.__syncing = True
+                try:
+                    with self.__lock:
+                        target = self.__lsn
+                        fd = os.dup(self.__file.fileno())
+                    self.__synced.release()
+                    try:
+                        if self.__fsync != 'never':
+                            os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                        self.__synced.acquire()
+                    self.__synced_lsn = max(self.__synced_lsn, target)
+                finally:
+                    self.__syncing = False
+                    self.__synced.notify_all()
+
+    def rotate(self, new_path):
+        '''move the current log to new_path and start an empty one'''
+        self.sync()
+        with self.__lock:
+            self.__file.close()
+            os.replace(self.__path, new_path)
+            self.__file = open(self.__path, 'ab')
+
+    def close(self):
+        '''stop the fsync thread, sync and close the log'''
+        self.__closing.set()
+        if self.__syncer is not None:
+            self.__syncer.join()
+        self.sync()
+        with self.__lock:
+            self.__file.close()
+
+    def __run_syncer(self, interval):
+        '''fsync every interval seconds until close() is called'''
+        while not self.__closing.wait(interval):
+            self.sync()
+
+
+def read_records(path):
+    '''
+    Reads every complete record in the log at path. A torn record left at
+    the end by a crash is cut off the file.
+
+    Return Value:
+        Returns a list of op lists, one per record
+    '''
+    records = []
+    if not exists(path):
+        return records
+    good = 0
+    with open(path, 'rb') as file:
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                records.append(json.loads(line)['ops'])
+            except (ValueError, KeyError, TypeError):
+                break
+            good += len(line)
+    if os.stat(path).st_size != good:
+        os.truncate(path, good)
+    return records
+
+
+def apply(store, op):
+    '''
+    Applies a single logged op to a plain (json loaded) store
+    '''
+    name = op[0]
+    if name == 'set':
+        store[op[1]] = op[2]
+    elif name == 'unset':
+        store.pop(op[1], None)
+    elif name == 'reset':
+        store.clear()
+        store.update(op[1])
+    elif name == 'replace':
+        seg = op[1]
+        if len(seg) == 1:
+            store[seg[0]] = op[2]
+        else:
+            store[seg[0]][_key(store[seg[0]], seg[1])] = op[2]
+    else:
+        target = store
+        for part in op[1]:
+            target = target[_key(target, part)]
+
+        if name == 'put':
+            target[_key(target, op[2])] = op[3]
+        elif name == 'del':
+            del target[_key(target, op[2])]
+        elif name == 'append':
+            target.append(op[2])
+        elif name == 'insert':
+            target.insert(op[2], op[3])
+        elif name == 'clear':
+            target.clear()
+        elif name == 'append_in':
+            target = target[_key(target, op[2])]
+            for part in op[3]:
+                target = target[_key(target, part)]
+            target.append(op[4])
+        else:
+            raise ValueError(f'unknown log op {name!r}')
+
+
+def _key(container, key):
+    '''dict keys come back from json as strings, as they do in the data file'''
+    if isinstance(container, dict) and not isinstance(key, str):
+        return json.dumps(key)
+    return key
@@ -10,6 +10,7 @@ import pytest
 from src.data_store import U_PASSWORD_IDX, U_PW_RESET_CODE_IDX, data_store
 import requests
 from src.config import url
+from src.segments import read_store
 import json
 
 BASE_URL = url
@@ -79,8 +80,7 @@ def test_function_success(clear_reg, register_user):
                              json={"email": "gerardmathews02@gmail.com"})
     assert response.status_code == 200
 
-    with open('src/data_store.json', 'r', encoding="utf8") as file:
-        file_contents = json.load(file)
+    file_contents = read_store('src/data_store.json')
 
     reset_code = file_contents['users'][1][U_PW_RESET_CODE_IDX]['reset_code']
     password = file_contents['users'][1][U_PASSWORD_IDX]
@@ -91,8 +91,7 @@ def test_function_success(clear_reg, register_user):
                                                          "new_password": "password"})
     assert response.status_code == 200
 
-    with open('src/data_store.json', 'r', encoding="utf8") as file:
-        file_contents = json.load(file)
+    file_contents = read_store('src/data_store.json')
 
     reset_code = file_contents['users'][1][U_PW_RESET_CODE_IDX]['reset_code']
     password = file_contents['users'][1][U_PASSWORD_IDX]
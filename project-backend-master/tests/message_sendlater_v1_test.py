@@ -20,6 +20,9 @@ Functions:
     test_delete_msg_before_sent
     test_remove_msg_before_sent
 
+    test_metrics_invalid_token
+    test_metrics
+
 '''
 
 import pytest
@@ -263,3 +266,33 @@ def test_remove_msg_before_sent(clear, register_and_login1):
     response = requests.delete(f"{BASE_URL}/message/remove/v1", json={'token': token,
                                                                       'message_id': message_id})
     assert response.status_code == InputError.code
+
+
+def test_metrics_invalid_token(clear):
+    '''
+    The send-later metrics are only shown to a logged in user
+    '''
+    response = requests.get(f"{BASE_URL}/message/sendlater/metrics/v1",
+                            params={"token": encode_token(-1)})
+    assert response.status_code == AccessError.code
+    response = requests.get(f"{BASE_URL}/message/sendlater/metrics/v1")
+    assert response.status_code == AccessError.code
+
+
+def test_metrics(clear, register_and_login1):
+    '''
+    A message waiting to be sent is counted in the depth of the queue
+    '''
+    token = register_and_login1[0]
+    channel = create_channel(token, "Channel 1", True)
+    time_sent = datetime.timestamp(datetime.now()) + 100
+    response_input = requests.post(f"{BASE_URL}/message/sendlater/v1", json={"token": token,
+                                                                             "channel_id": channel['channel_id'], "message": "later", "time_sent": time_sent})
+    assert response_input.status_code == 200
+
+    response = requests.get(f"{BASE_URL}/message/sendlater/metrics/v1",
+                            params={"token": token})
+    assert response.status_code == 200
+    metrics = response.json()
+    assert metrics['depth'] == 1
+    assert metrics['overdue'] == 0
@@ -4,6 +4,7 @@ from src.other import encode_token
 from src.error import InputError, AccessError
 import requests
 from src.config import url
+from src.segments import read_store
 import json
 
 BASE_URL = url
@@ -74,8 +75,7 @@ def test_answer_correct_whitebox_ch(clear_reg, add_u1, add_u2):
                         json={"token": token1, "channel_id": ch_id, "message": msg})
     assert ans.status_code == 200
     # _____WHITEBOX________________
-    with open('src/data_store.json', 'r', encoding="utf8") as file:
-        file_contents = json.load(file)
+    file_contents = read_store('src/data_store.json')
 
     answer = file_contents['wordle_ch'][ch_id]['wordle_answer']
     answer_rev = answer[::-1]
@@ -234,8 +234,7 @@ def test_answer_correct_whitebox_dm(clear_reg, add_u1, add_u2):
                                                                'dm_id': dm_id, 'message': msg})
     assert ans.status_code == 200
     # _____WHITEBOX________________
-    with open('src/data_store.json', 'r', encoding="utf8") as file:
-        file_contents = json.load(file)
+    file_contents = read_store('src/data_store.json')
 
     answer = file_contents['wordle_dm'][dm_id]['wordle_answer']
     answer_rev = answer[::-1]
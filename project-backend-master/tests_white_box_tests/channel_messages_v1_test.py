@@ -11,12 +11,15 @@ Functions:
     test_user_not_member_of_channel()
     test_valid_input()
     test_correct_return_type()
+    test_reacts_shown_to_each_viewer()
 '''
 import pytest
 from src.auth import auth_register_v2
-from src.channel import channel_messages_v1
+from src.channel import channel_join_v1, channel_messages_v1
 from src.channels import channels_create_v1
+from src.data_store import data_store
 from src.error import InputError, AccessError
+from src.message import message_react_unreact_v1, message_send_v1
 from src.other import clear_v1
 
 
@@ -91,3 +94,29 @@ def test_correct_return_type(clear_register_user_and_create_channel):
     assert isinstance(output['messages'], list)
     assert isinstance(output['start'], int)
     assert isinstance(output['end'], int)
+
+
+def test_reacts_shown_to_each_viewer(clear_register_user_and_create_channel):
+    '''
+    Each user is shown whether they reacted themselves, worked out without
+    writing to the store, which a read-only transaction would not allow
+    '''
+    user, channel = clear_register_user_and_create_channel
+    other = auth_register_v2('jane.smith@unsw.edu.au',
+                             'password', 'Jane', 'Smith')
+    channel_join_v1(other['auth_user_id'], channel['channel_id'])
+    message_id = message_send_v1(
+        user['token'], channel['channel_id'], 'hello', False)['message_id']
+    with data_store.transaction():
+        message_react_unreact_v1(other['token'], message_id, 1, False)
+
+    with data_store.transaction(read_only=True):
+        for viewer, reacted in [(user, False), (other, True)]:
+            react = channel_messages_v1(viewer['auth_user_id'],
+                                        channel['channel_id'],
+                                        0)['messages'][0]['reacts'][0]
+            assert react['u_ids'] == [other['auth_user_id']]
+            assert react['is_this_user_reacted'] == reacted
+    stored = data_store.get()['messages'][channel['channel_id']][0]
+    assert stored['reacts'] == [{'react_id': 1,
+                                 'u_ids': [other['auth_user_id']]}]
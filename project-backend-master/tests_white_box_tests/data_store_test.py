@@ -0,0 +1,1269 @@
+'''
+This test file aims to validate the persistence modes of the Datastore
+class using pytest.
+
+These tests are White Box tests.
+
+Functions:
+    read_file(path)
+    saved(data)
+    test_sync_mode_writes_through()
+    test_sync_mode_detects_external_change()
+    test_sync_mode_reloads_other_datastore()
+    test_sync_mode_conflicting_change()
+    test_sync_mode_reloads_after_rollback()
+    count_up(store, times)
+    test_processes_share_store()
+    test_sync_mode_get_only_stats()
+    test_write_behind_get_returns_memory()
+    test_write_behind_background_flush()
+    test_write_behind_close_flushes()
+    test_invalid_mode()
+    test_journal_appends_changes_only()
+    test_journal_replays_log_on_load()
+    test_journal_discards_torn_record()
+    test_journal_compaction()
+    test_journal_interrupted_compaction()
+    test_transaction_commits_once()
+    test_transaction_rollback()
+    test_nested_transaction_rollback()
+    test_transaction_group_commit()
+    add_channels(data, count)
+    test_segments_written_independently()
+    test_segments_loaded_lazily()
+    test_segment_eviction()
+    test_legacy_data_file_split()
+    test_journal_folds_into_segments()
+    test_recent_messages()
+    test_only_changed_keys_written()
+    test_shared_transaction_reads_snapshot()
+    test_snapshot_copies_changed_path()
+    test_item_changed_after_others_removed()
+    test_snapshot_reads_unloaded_locations()
+    test_transaction_inside_shared_transaction()
+    test_read_only_transaction()
+    send(store, channel_id, sent)
+    test_scoped_transactions_run_together()
+    test_scoped_transaction_rollback()
+    test_scoped_transaction_locking()
+    test_ids_reserved_in_blocks()
+    test_ids_in_order_with_workers()
+    test_user_indexes_added_to_old_store()
+    test_user_indexes_updated()
+    test_message_index_built_at_load()
+    test_membership_indexes()
+    test_session_indexes()
+    test_messages_later_in_time_order()
+    test_standup_registry()
+    test_standup_started_before_last_sent()
+    test_message_tombstones()
+'''
+import gc
+import json
+import multiprocessing
+import os
+import threading
+import time
+import jwt
+import pytest
+from src import config
+from src.data_store import Datastore, active_standup, add_membership, \
+    add_session, add_user, count_due, find_message, finish_standup, \
+    has_session, index_message, is_channel_member, is_dm_member, \
+    memberships, queue_message, record_removal, remove_membership, \
+    remove_session, remove_user_sessions, set_user_email, set_user_handle, \
+    start_standup, tombstone_message, user_by_email, user_by_handle, \
+    user_by_id, user_sessions
+from src.error import AccessError
+from src.segments import read_store
+from src.tracking import DERIVED_KEYS, Unloaded
+
+
+def read_file(path):
+    '''
+    Helper that loads the json currently on disk at path
+    '''
+    with open(path, 'r', encoding="utf8") as file:
+        return json.load(file)
+
+
+def saved(data):
+    '''
+    Helper that leaves out the keys of a store which are not saved
+    '''
+    return {key: value for key, value in data.items()
+            if key not in DERIVED_KEYS}
+
+
+def test_sync_mode_writes_through(tmp_path):
+    '''
+    Every set() in sync mode is written to disk before it returns
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    data['users'].append([1, 'a@b.com'])
+    store.set(data)
+    assert read_store(path)['users'] == [[1, 'a@b.com']]
+
+
+def test_sync_mode_detects_external_change(tmp_path):
+    '''
+    Sync mode refuses to hand out a store that differs from the file
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    with open(path, 'w', encoding="utf8") as file:
+        json.dump({'users': []}, file)
+    with pytest.raises(AccessError):
+        store.get()
+
+
+def test_sync_mode_reloads_other_datastore(tmp_path):
+    '''
+    A write by another Datastore on the same files is read in by the next
+    get(), which only re-reads the top level keys that changed
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    users = store.get()['users']
+    other = Datastore(path=path, mode='sync')
+    data = other.get()
+    data['sessions'].append('token')
+    other.set(data)
+    assert store.get()['sessions'] == ['token']
+    assert store.get()['users'] is users
+
+
+def test_sync_mode_conflicting_change(tmp_path):
+    '''
+    Changes which have not been written yet are not silently dropped when
+    another Datastore writes first
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    other = Datastore(path=path, mode='sync')
+    data = store.get()
+    data['sessions'].append('mine')
+    data = other.get()
+    data['sessions'].append('theirs')
+    other.set(data)
+    with pytest.raises(AccessError):
+        store.set(store.get())
+
+
+def test_sync_mode_reloads_after_rollback(tmp_path):
+    '''
+    A rolled back transaction leaves nothing unwritten behind, so writes by
+    another Datastore are still read in afterwards
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    other = Datastore(path=path, mode='sync')
+    with pytest.raises(ValueError):
+        with store.transaction():
+            store.get()['sessions'].append('mine')
+            raise ValueError()
+    data = other.get()
+    data['sessions'].append('theirs')
+    other.set(data)
+    assert store.get()['sessions'] == ['theirs']
+
+
+def count_up(store, times):
+    '''
+    Helper that increments message_counter one transaction at a time
+    '''
+    for _ in range(times):
+        with store.transaction():
+            data = store.get()
+            data['message_counter'] += 1
+            store.set(data)
+
+
+def test_processes_share_store(tmp_path):
+    '''
+    Several processes using the same files, including ones forked from a
+    process which already had the store open, never lose each other's writes
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=count_up, args=(store, 20))
+               for _ in range(3)]
+    workers.append(context.Process(
+        target=lambda: count_up(Datastore(path=path, mode='sync'), 20)))
+    for worker in workers:
+        worker.start()
+    count_up(store, 20)
+    for worker in workers:
+        worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+    assert store.get()['message_counter'] == 100
+    assert read_store(path)['message_counter'] == 100
+
+
+def test_sync_mode_get_only_stats(tmp_path, monkeypatch):
+    '''
+    While nothing else writes to the files get() does not read them
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    data['users'].append([1, 'a@b.com'])
+    store.set(data)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('get() opened a file')
+    monkeypatch.setattr('builtins.open', fail)
+    assert store.get()['users'] == [[1, 'a@b.com']]
+    monkeypatch.undo()
+
+
+def test_write_behind_get_returns_memory(tmp_path):
+    '''
+    In write behind mode get() never touches the file
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='write_behind', flush_interval=60)
+    data = store.get()
+    data['sessions'].append('token')
+    store.set(data)
+    assert store.get()['sessions'] == ['token']
+    assert read_store(path)['sessions'] == []
+    store.close()
+
+
+def test_write_behind_background_flush(tmp_path):
+    '''
+    The background flusher persists dirty data within a few intervals
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='write_behind', flush_interval=0.01)
+    data = store.get()
+    data['message_counter'] = 7
+    store.set(data)
+
+    deadline = time.time() + 5
+    while read_store(path)['message_counter'] != 7 and time.time() < deadline:
+        time.sleep(0.01)
+    assert read_store(path)['message_counter'] == 7
+    store.close()
+
+
+def test_write_behind_close_flushes(tmp_path):
+    '''
+    close() writes anything still outstanding and stops the flusher
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='write_behind', flush_interval=60)
+    data = store.get()
+    data['register_counter'] = 3
+    store.set(data)
+    store.close()
+    assert read_store(path)['register_counter'] == 3
+    assert Datastore(path=path, mode='write_behind').get()[
+        'register_counter'] == 3
+
+
+def test_invalid_mode(tmp_path):
+    '''
+    An unknown persistence mode is rejected
+    '''
+    with pytest.raises(ValueError):
+        Datastore(path=str(tmp_path / 'store.json'), mode='carrier_pigeon')
+
+
+def test_journal_appends_changes_only(tmp_path):
+    '''
+    A set() in journal mode appends what changed, not the whole store
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='journal')
+    data = store.get()
+    data['messages'].append([])
+    for idx in range(100):
+        data['messages'][1].append({'message_id': idx, 'message': 'x' * 100})
+    store.set(data)
+    size = os.stat(str(tmp_path / 'store.wal')).st_size
+
+    data['messages'][1][5]['is_pinned'] = True
+    store.set(data)
+    assert os.stat(str(tmp_path / 'store.wal')).st_size - size < 500
+    assert read_file(path)['locations']['messages'] == 1
+    store.close()
+
+
+def test_journal_replays_log_on_load(tmp_path):
+    '''
+    A store loaded after a crash includes everything in the log
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='journal')
+    data = store.get()
+    data['users'].append([1, 'a@b.com', []])
+    data['users'][0][2].append({'notification_message': 'hi'})
+    data['message_counter'] = 4
+    data['sessions'].append('token')
+    data['sessions'].remove('token')
+    store.set(data)
+    expected = json.loads(json.dumps(data))
+
+    # simulate a crash: the log is on disk but was never folded in
+    assert Datastore(path=path, mode='journal').get() == expected
+    assert read_store(path) == saved(expected)
+
+
+def test_journal_discards_torn_record(tmp_path):
+    '''
+    A record only partly written when the process died is ignored
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='journal')
+    data = store.get()
+    data['register_counter'] = 1
+    store.set(data)
+    with open(str(tmp_path / 'store.wal'), 'a', encoding="utf8") as file:
+        file.write('{"ops": [["set", "register_counter", 2]')
+
+    assert Datastore(path=path, mode='sync').get()['register_counter'] == 1
+
+
+def test_journal_compaction(tmp_path, monkeypatch):
+    '''
+    The log is folded into the data file once it passes wal_compact_size
+    '''
+    monkeypatch.setattr(config, 'wal_compact_size', 1000)
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='journal')
+    data = store.get()
+    for idx in range(50):
+        data['sessions'].append(f'token{idx}')
+        store.set(data)
+    store.close()
+    assert read_store(path)['sessions'] == [f'token{idx}' for idx in range(50)]
+    assert not os.path.exists(str(tmp_path / 'store.wal.old'))
+
+
+def test_journal_interrupted_compaction(tmp_path):
+    '''
+    A compaction that died after writing the new data file, but before
+    renaming it into place, is finished on the next load
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='journal')
+    data = store.get()
+    data['message_counter'] = 9
+    store.close()
+    os.replace(path, path + '.new')
+    with open(path, 'w', encoding="utf8") as file:
+        file.write('{}')
+
+    assert Datastore(path=path, mode='sync').get()['message_counter'] == 9
+
+
+def test_transaction_commits_once(tmp_path, monkeypatch):
+    '''
+    Every set() inside a transaction is written out by one commit at the end
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    writes = []
+    monkeypatch.setattr(os, 'replace',
+                        lambda src, dst, _replace=os.replace: (
+                            writes.append(dst), _replace(src, dst)))
+    with store.transaction():
+        data = store.get()
+        for idx in range(5):
+            data['sessions'].append(f'token{idx}')
+            store.set(data)
+        assert read_store(path)['sessions'] == []
+    assert writes == [str(tmp_path / 'store.segments' / 'sessions.json'),
+                      str(tmp_path / 'store.gen')]
+    assert read_store(path)['sessions'] == [f'token{idx}' for idx in range(5)]
+
+
+def test_transaction_rollback(tmp_path):
+    '''
+    An exception inside a transaction undoes everything it changed
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='journal')
+    data = store.get()
+    data['users'].append([1, 'a@b.com', {'notifications': []}])
+    store.set(data)
+    before = json.loads(json.dumps(data))
+
+    with pytest.raises(AccessError):
+        with store.transaction():
+            data = store.get()
+            data['users'][0][1] = 'c@d.com'
+            data['users'][0][2]['notifications'].append('hi')
+            data['users'].insert(0, [2, 'e@f.com'])
+            data['message_counter'] = 10
+            store.set(data)
+            del data['sessions']
+            store.set({'users': []})
+            raise AccessError(description='nope')
+
+    assert store.get() == before
+    store.close()
+    assert read_store(path) == saved(before)
+
+
+def test_nested_transaction_rollback(tmp_path):
+    '''
+    A nested transaction which fails only undoes its own changes
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    with store.transaction():
+        data = store.get()
+        data['sessions'].append('outer')
+        store.set(data)
+        try:
+            with store.transaction():
+                data['sessions'].append('inner')
+                store.set(data)
+                raise ValueError
+        except ValueError:
+            pass
+        assert store.in_transaction()
+    assert not store.in_transaction()
+    assert read_store(path)['sessions'] == ['outer']
+
+
+def test_transaction_group_commit(tmp_path, monkeypatch):
+    '''
+    Transactions committing from many threads at once are all durable
+    '''
+    monkeypatch.setattr(config, 'wal_fsync', 'always')
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='journal')
+
+    def worker(idx):
+        for count in range(20):
+            with store.transaction():
+                data = store.get()
+                data['sessions'].append(f'{idx}-{count}')
+                store.set(data)
+
+    threads = [threading.Thread(target=worker, args=(idx,))
+               for idx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # recover from the log alone, without close() folding it in
+    sessions = Datastore(path=path, mode='sync').get()['sessions']
+    assert sorted(sessions) == sorted(f'{idx}-{count}' for idx in range(8)
+                                      for count in range(20))
+
+
+def add_channels(data, count):
+    '''
+    Helper that adds count channels holding one message each
+    '''
+    for channel_id in range(1, count + 1):
+        data['messages'].append([{'message_id': channel_id,
+                                  'message': 'x' * 100}])
+        index_message(data, channel_id, 'messages', channel_id, 0)
+
+
+def test_segments_written_independently(tmp_path, monkeypatch):
+    '''
+    Sending a message only appends it to that channel's log
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 3)
+    store.set(data)
+    assert read_file(path)['locations']['messages'] == 4
+    logs = tmp_path / 'store.segments' / 'messages'
+    sizes = [os.stat(str(logs / f'{idx}.log')).st_size for idx in range(4)]
+
+    writes = []
+    monkeypatch.setattr(os, 'replace',
+                        lambda src, dst, _replace=os.replace: (
+                            writes.append(dst), _replace(src, dst)))
+    data['messages'][2].append({'message_id': 4, 'message': 'hi'})
+    data['messages'][2][0]['is_pinned'] = True
+    store.set(data)
+    assert writes == [str(tmp_path / 'store.gen')]
+    growth = [os.stat(str(logs / f'{idx}.log')).st_size - sizes[idx]
+              for idx in range(4)]
+    # just the two changed messages
+    assert growth[:2] == [0, 0] and growth[3] == 0 and 0 < growth[2] < 250
+    assert read_store(path)['messages'][2] == [
+        {'message_id': 2, 'message': 'x' * 100, 'is_pinned': True},
+        {'message_id': 4, 'message': 'hi'}]
+
+
+def test_segments_loaded_lazily(tmp_path):
+    '''
+    A channel's messages are only read from disk when first used
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 3)
+    store.set(data)
+
+    data = Datastore(path=path, mode='sync').get()
+    assert all(isinstance(location, Unloaded)
+               for location in list.copy(data['messages']))
+    assert data['messages'][2] == [{'message_id': 2, 'message': 'x' * 100}]
+    assert not isinstance(list.__getitem__(data['messages'], 2), Unloaded)
+    assert isinstance(list.__getitem__(data['messages'], 1), Unloaded)
+    assert len(list(data['messages'])) == 4
+
+
+def test_segment_eviction(tmp_path, monkeypatch):
+    '''
+    Idle segments are dropped from memory once they exceed the cache, and
+    come back unchanged when used again
+    '''
+    monkeypatch.setattr(config, 'segment_cache_size', 500)
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 10)
+    store.set(data)
+
+    for channel_id in range(1, 11):
+        data['messages'][channel_id][0]['is_pinned'] = True
+        store.set(data)
+    resident = [not isinstance(location, Unloaded)
+                for location in list.copy(data['messages'])]
+    assert 1 < resident.count(True) < 11
+    # the most recently used are the ones kept
+    assert resident[10] and not resident[1]
+    assert data['messages'][1][0] == {'message_id': 1, 'message': 'x' * 100,
+                                      'is_pinned': True}
+
+
+def test_legacy_data_file_split(tmp_path):
+    '''
+    A data file which still holds every message is split into segments
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = json.loads(json.dumps(store.get()))
+    add_channels(data, 2)
+    with open(path, 'w', encoding="utf8") as file:
+        json.dump(data, file)
+
+    assert Datastore(path=path, mode='sync').get() == data
+    assert read_file(path)['locations']['messages'] == 3
+    assert read_store(path) == saved(data)
+
+
+def test_journal_folds_into_segments(tmp_path):
+    '''
+    Folding the log only rewrites the segments it changed
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='journal')
+    data = store.get()
+    add_channels(data, 3)
+    store.close()
+    segment = tmp_path / 'store.segments' / 'messages' / '3.log'
+    mtime = os.stat(str(segment)).st_mtime_ns
+
+    store = Datastore(path=path, mode='journal')
+    data = store.get()
+    data['messages'][1].append({'message_id': 4, 'message': 'hi'})
+    store.set(data)
+    store.close()
+    assert os.stat(str(segment)).st_mtime_ns == mtime
+    assert read_store(path)['messages'][1][1]['message'] == 'hi'
+
+
+def test_recent_messages(tmp_path):
+    '''
+    A page of a location still on disk is read without loading the rest
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    data['messages'].append([{'message_id': idx} for idx in range(120)])
+    store.set(data)
+    expected = (120, [{'message_id': idx} for idx in range(69, 19, -1)])
+    assert store.recent_messages('messages', 1, 50, 50) == expected
+
+    store = Datastore(path=path, mode='sync')
+    assert store.recent_messages('messages', 1, 50, 50) == expected
+    assert store.recent_messages('messages', 1, -10, 50)[1] == \
+        [{'message_id': idx} for idx in range(119, 79, -1)]
+    assert isinstance(list.__getitem__(store.get()['messages'], 1), Unloaded)
+
+
+def test_only_changed_keys_written(tmp_path, monkeypatch):
+    '''
+    Logging out only rewrites the sessions, not the users or any messages
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 3)
+    data['users'].append([1, 'a@b.com'])
+    data['sessions'].append('token')
+    store.set(data)
+    mtimes = {name: os.stat(str(tmp_path / 'store.segments' / name))
+              .st_mtime_ns for name in ['users.json', 'messages/1.log']}
+
+    writes = []
+    monkeypatch.setattr(os, 'replace',
+                        lambda src, dst, _replace=os.replace: (
+                            writes.append(dst), _replace(src, dst)))
+    data['sessions'].remove('token')
+    store.set(data)
+    assert writes == [str(tmp_path / 'store.segments' / 'sessions.json'),
+                      str(tmp_path / 'store.gen')]
+    assert all(os.stat(str(tmp_path / 'store.segments' / name))
+               .st_mtime_ns == mtime for name, mtime in mtimes.items())
+    assert read_store(path)['sessions'] == []
+    assert Datastore(path=path, mode='sync').get()['users'] == [[1, 'a@b.com']]
+
+
+def test_shared_transaction_reads_snapshot(tmp_path, monkeypatch):
+    '''
+    A shared transaction reads the store as it was last committed, without
+    waiting for a transaction which is part way through changing it, and
+    only what changed is copied for the next snapshot
+    '''
+    monkeypatch.setattr(config, 'segment_cache_size', 1 << 20)
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 2)
+    data['users'].append([1, 'a@b.com'])
+    store.set(data)
+
+    changed = threading.Event()
+    done = threading.Event()
+
+    def write():
+        with store.transaction():
+            data = store.get()
+            data['users'].append([2, 'c@d.com'])
+            data['messages'][1].append({'message_id': 3, 'message': 'hi'})
+            changed.set()
+            done.wait(5)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    changed.wait()
+    with store.transaction(shared=True):
+        before = store.get()
+        assert before['users'] == [[1, 'a@b.com']]
+        done.set()
+        writer.join()
+        assert before['users'] == [[1, 'a@b.com']]
+        assert len(before['messages'][1]) == 1
+        with pytest.raises(TypeError):
+            before['users'].append([3, 'e@f.com'])
+    with store.transaction(shared=True):
+        after = store.get()
+    assert after['users'] == [[1, 'a@b.com'], [2, 'c@d.com']]
+    assert after['messages'][1][1] == {'message_id': 3, 'message': 'hi'}
+    assert after['users'][0] is before['users'][0]
+    assert after['messages'][1][0] is before['messages'][1][0]
+    assert after['messages'][2] is before['messages'][2]
+    assert after['sessions'] is before['sessions']
+
+
+def test_snapshot_copies_changed_path(tmp_path):
+    '''
+    Changing a user's history only copies the containers on the way to the
+    change for the next snapshot, reusing the rest of the user's history
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    data['message_track'].append({'auth_user_id': 1, 'messages_sent': [
+        {'num_messages_sent': count, 'time_stamp': count}
+        for count in range(3)]})
+    data['message_track'].append({'auth_user_id': 2, 'messages_sent': []})
+    store.set(data)
+    with store.transaction(shared=True):
+        before = store.get()['message_track']
+
+    data = store.get()
+    data['message_track'][0]['messages_sent'].append(
+        {'num_messages_sent': 3, 'time_stamp': 3})
+    data['message_track'][0]['messages_sent'][1]['time_stamp'] = 10
+    store.set(data)
+    with store.transaction(shared=True):
+        after = store.get()['message_track']
+    sent = after[0]['messages_sent']
+    assert [entry['time_stamp'] for entry in sent] == [0, 10, 2, 3]
+    assert [entry['time_stamp'] for entry in before[0]['messages_sent']] == \
+        [0, 1, 2]
+    assert sent[0] is before[0]['messages_sent'][0]
+    assert sent[2] is before[0]['messages_sent'][2]
+    assert after[1] is before[1]
+
+
+def test_item_changed_after_others_removed(tmp_path):
+    '''
+    Changing an item in place commits after items of other keys were
+    changed and removed, even when it is given the memory one of them had
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    for u_id in range(20):
+        data = store.get()
+        data['user_channels'][str(u_id)] = [1]
+        store.set(data)
+        data['user_channels'][str(u_id)].append(2)
+        store.set(data)
+        del data['user_channels'][str(u_id)]
+        store.set(data)
+        # free the removed item, so the next one may be put in its place
+        gc.collect()
+        data['users'].append([u_id])
+        store.set(data)
+        data['users'][-1].append('a@b.com')
+        store.set(data)
+    assert read_store(path)['users'] == \
+        [[u_id, 'a@b.com'] for u_id in range(20)]
+
+
+def test_snapshot_reads_unloaded_locations(tmp_path):
+    '''
+    A snapshot reads a location still on disk from its file, and keeps the
+    messages it had once the store reads the location in and changes it
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 2)
+    store.set(data)
+    first = [{'message_id': 1, 'message': 'x' * 100}]
+
+    store = Datastore(path=path, mode='sync')
+    with store.transaction(shared=True):
+        view = store.get()
+        assert view['messages'][1] == first
+        assert store.recent_messages('messages', 2, 0, 50) == \
+            (1, [{'message_id': 2, 'message': 'x' * 100}])
+    assert isinstance(list.__getitem__(view['messages'], 1), Unloaded)
+
+    data = store.get()
+    data['messages'][1].append({'message_id': 3, 'message': 'hi'})
+    store.set(data)
+    assert view['messages'][1] == first
+    with store.transaction(shared=True):
+        assert store.recent_messages('messages', 1, 0, 1) == \
+            (2, [{'message_id': 3, 'message': 'hi'}])
+
+
+def test_transaction_inside_shared_transaction(tmp_path):
+    '''
+    A transaction begun inside a shared one commits on its own, after which
+    the shared transaction reads what it wrote
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    with store.transaction(shared=True):
+        assert store.get()['message_counter'] == 0
+        with pytest.raises(ValueError):
+            with store.transaction():
+                store.get()['message_counter'] = 1
+                raise ValueError()
+        assert store.get()['message_counter'] == 0
+        with store.transaction():
+            data = store.get()
+            data['message_counter'] = 2
+            store.set(data)
+        assert read_store(path)['message_counter'] == 2
+        assert store.get()['message_counter'] == 2
+    assert not store.in_transaction()
+
+
+def test_read_only_transaction(tmp_path):
+    '''
+    Nothing run inside a read-only transaction can begin a transaction
+    which writes, though it can nest shared ones
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    with store.transaction(read_only=True):
+        with store.transaction(shared=True):
+            assert store.get()['message_counter'] == 0
+        with pytest.raises(TypeError):
+            with store.transaction():
+                pass
+        assert store.get()['message_counter'] == 0
+    assert not store.in_transaction()
+    with store.transaction():
+        data = store.get()
+        data['message_counter'] = 1
+        store.set(data)
+    assert Datastore(path=path, mode='sync').get()['message_counter'] == 1
+
+
+def send(store, channel_id, sent):
+    '''
+    Helper that sends a message to a channel in a scoped transaction, the
+    way message_send_v1 does
+    '''
+    data = store.get()
+    store.lock(('messages', channel_id))
+    message_id = store.next_id('message_counter')
+    data['messages'][channel_id].append({'message_id': message_id})
+    store.defer(sent.append, message_id)
+    store.set(data)
+    return message_id
+
+
+def test_scoped_transactions_run_together(tmp_path, monkeypatch):
+    '''
+    Scoped transactions changing different channels run at the same time
+    and take different ids, while one changing the same channel waits
+    '''
+    monkeypatch.setattr(config, 'id_block_size', 10)
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 2)
+    data['message_counter'] = 2
+    store.set(data)
+
+    sent = []
+    locked = threading.Event()
+    done = threading.Event()
+    ids = {}
+
+    def first():
+        with store.transaction(scoped=True):
+            ids['first'] = send(store, 1, sent)
+            locked.set()
+            done.wait(5)
+
+    def same_channel():
+        with store.transaction(scoped=True):
+            ids['same'] = send(store, 1, sent)
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    locked.wait()
+    with store.transaction(scoped=True):
+        ids['other'] = send(store, 2, sent)
+    assert sent == [ids['other']]
+    waiting = threading.Thread(target=same_channel)
+    waiting.start()
+    waiting.join(0.2)
+    assert waiting.is_alive()
+    done.set()
+    thread.join()
+    waiting.join()
+
+    assert sorted(ids.values()) == [3, 4, 5]
+    assert sent == [ids['other'], ids['first'], ids['same']]
+    on_disk = read_store(path)
+    assert on_disk['message_counter'] == 12
+    assert [m['message_id'] for m in on_disk['messages'][1][1:]] == \
+        [ids['first'], ids['same']]
+    assert on_disk['messages'][2][1] == {'message_id': ids['other']}
+
+
+def test_scoped_transaction_rollback(tmp_path, monkeypatch):
+    '''
+    A scoped transaction which rolls back undoes its changes and drops what
+    it deferred, but the id it took stays taken
+    '''
+    monkeypatch.setattr(config, 'id_block_size', 10)
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 1)
+    store.set(data)
+
+    sent = []
+    with pytest.raises(ValueError):
+        with store.transaction(scoped=True):
+            send(store, 1, sent)
+            raise ValueError()
+    assert sent == []
+    assert len(store.get()['messages'][1]) == 1
+    assert read_store(path)['message_counter'] == 10
+    with store.transaction(scoped=True):
+        assert send(store, 1, sent) == 2
+    assert sent == [2]
+
+
+def test_scoped_transaction_locking(tmp_path):
+    '''
+    A scoped transaction can only change the locations it locked, must lock
+    them in order, and can take the whole workspace before anything else
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 2)
+    store.set(data)
+
+    with pytest.raises(RuntimeError):
+        with store.transaction(scoped=True):
+            store.get()['messages'][1].append({'message_id': 3})
+    with pytest.raises(RuntimeError):
+        with store.transaction(scoped=True):
+            store.lock(('messages', 2))
+            store.lock(('messages', 1))
+    with pytest.raises(RuntimeError):
+        with store.transaction(scoped=True):
+            store.lock(('messages', 1))
+            store.lock()
+    assert len(store.get()['messages'][1]) == 1
+
+    with store.transaction(scoped=True):
+        store.lock()
+        data = store.get()
+        data['users'].append([1, 'a@b.com'])
+        data['messages'][1].append({'message_id': 3})
+        store.set(data)
+    on_disk = read_store(path)
+    assert on_disk['users'] == [[1, 'a@b.com']]
+    assert len(on_disk['messages'][1]) == 2
+
+
+def test_ids_reserved_in_blocks(tmp_path, monkeypatch):
+    '''
+    Each Datastore reserves a block of ids at a time, so ids are unique
+    between processes and the counter is only written once per block, and
+    starts again once the store is cleared
+    '''
+    monkeypatch.setattr(config, 'id_block_size', 10)
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    with store.transaction():
+        assert [store.next_id('message_counter') for _ in range(3)] == \
+            [1, 2, 3]
+    assert read_store(path)['message_counter'] == 10
+
+    other = Datastore(path=path, mode='sync')
+    with other.transaction():
+        assert other.next_id('message_counter') == 11
+    with store.transaction():
+        assert [store.next_id('message_counter') for _ in range(8)] == \
+            [4, 5, 6, 7, 8, 9, 10, 21]
+    assert read_store(path)['message_counter'] == 30
+
+    with store.transaction():
+        data = dict(store.get())
+        data['message_counter'] = 0
+        store.set(data)
+        assert store.next_id('message_counter') == 1
+
+
+def test_ids_in_order_with_workers(tmp_path, monkeypatch):
+    '''
+    By default several workers take one id at a time, so ids come in the
+    order they were taken
+    '''
+    monkeypatch.setattr(config, 'id_block_size', None)
+    monkeypatch.setattr(config, 'workers', 4)
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    other = Datastore(path=path, mode='sync')
+    ids = []
+    for worker in [store, other, store, other]:
+        with worker.transaction():
+            ids.append(worker.next_id('message_counter'))
+    assert ids == [1, 2, 3, 4]
+    assert read_store(path)['message_counter'] == 4
+
+
+def test_user_indexes_added_to_old_store(tmp_path):
+    '''
+    A data file from before users were indexed has the indexes built and
+    saved when it is loaded
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = json.loads(json.dumps(store.get()))
+    for key in ('user_index', 'email_index', 'handle_index',
+                'handle_suffixes'):
+        del data[key]
+    data['users'] = [[4, 'a@b.com', '', '', '', 'ab'],
+                     [2, 'c@d.com', '', '', '', 'ab0']]
+    with open(path, 'w', encoding="utf8") as file:
+        json.dump(data, file)
+
+    data = Datastore(path=path, mode='sync').get()
+    assert data['user_index'] == {'4': 0, '2': 1}
+    assert data['email_index'] == {'a@b.com': 4, 'c@d.com': 2}
+    assert data['handle_index'] == {'ab': 4, 'ab0': 2}
+    assert data['handle_suffixes'] == {'ab': 2}
+    assert user_by_id(data, 2)[0] == 2
+    assert user_by_id(data, 3) is None
+    assert read_store(path)['handle_suffixes'] == {'ab': 2}
+
+
+def test_user_indexes_updated(tmp_path):
+    '''
+    Changing a user's email or handle moves them in the indexes, leaving
+    another user who was given the same one before where they are
+    '''
+    store = Datastore(path=str(tmp_path / 'store.json'), mode='sync')
+    with store.transaction():
+        data = store.get()
+        add_user(data, [1, 'a@b.com', '', '', '', 'ab'])
+        add_user(data, [2, 'a@b.com', '', '', '', 'ab0'])
+        set_user_handle(data, user_by_id(data, 1), 'cd12')
+        assert user_by_handle(data, 'ab') is None
+        assert user_by_handle(data, 'cd12')[0] == 1
+        assert data['handle_suffixes'] == {'ab': 1, 'cd': 1}
+
+        assert user_by_email(data, 'a@b.com')[0] == 2
+        set_user_email(data, user_by_id(data, 1), 'e@f.com')
+        assert user_by_email(data, 'a@b.com')[0] == 2
+        set_user_email(data, user_by_id(data, 2), 'g@h.com')
+        assert user_by_email(data, 'a@b.com') is None
+        assert user_by_email(data, 'g@h.com')[0] == 2
+
+
+def test_message_index_built_at_load(tmp_path):
+    '''
+    The message index is never saved, but built when the store is loaded
+    from the logs' indexes, without reading in the locations still on
+    disk. One saved by an older version is ignored and deleted.
+    '''
+    path = str(tmp_path / 'store.json')
+    segments = tmp_path / 'store.segments'
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    add_channels(data, 2)
+    data['dm_messages'].append([{'message_id': 3, 'message': 'hi'}])
+    store.set(data)
+    assert not (segments / 'message_index.json').exists()
+    main = read_file(path)
+    assert 'message_index' not in main['keys']
+    main['keys'].append('message_index')
+    with open(path, 'w', encoding="utf8") as file:
+        json.dump(main, file)
+    (segments / 'message_index.json').write_text('{"1": ["dm_messages", 9, 9]}')
+    # an index from before it held where the messages are is rebuilt
+    os.remove(str(segments / 'dm_messages' / '1.idx'))
+
+    data = Datastore(path=path, mode='sync').get()
+    assert data['message_index'] == {'1': ['messages', 1, 0],
+                                     '2': ['messages', 2, 0],
+                                     '3': ['dm_messages', 1, 0]}
+    assert all(isinstance(location, Unloaded)
+               for location in list.copy(data['messages'])[1:])
+    assert find_message(data, 3) == \
+        ('dm_messages', 1, {'message_id': 3, 'message': 'hi'})
+    assert find_message(data, 4) is None
+    assert 'message_index' not in read_file(path)['keys']
+    assert not (segments / 'message_index.json').exists()
+
+
+def test_membership_indexes(tmp_path):
+    '''
+    A data file from before memberships were indexed has them built when it
+    is loaded, and adding or removing a membership keeps them in order
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    data['channels'].append([1, 'a', True, [1], [1, 2]])
+    data['channels'].append([2, 'b', True, [2], [2]])
+    data['dms'].append([1, {'owner_info': [1], 'status': 'present'},
+                        [[1], [3]], 'c'])
+    store.set(data)
+    main = read_file(path)
+    main['keys'].remove('user_channels')
+    main['keys'].remove('user_dms')
+    with open(path, 'w', encoding="utf8") as file:
+        json.dump(main, file)
+
+    data = Datastore(path=path, mode='sync').get()
+    assert data['user_channels'] == {'1': [1], '2': [1, 2]}
+    assert data['user_dms'] == {'1': [1], '3': [1]}
+    assert is_channel_member(data, 2, 2)
+    assert not is_channel_member(data, 1, 2)
+    assert is_dm_member(data, 3, 1)
+    assert not is_dm_member(data, 2, 1)
+
+    add_membership(data, 'user_channels', 1, 2)
+    add_membership(data, 'user_channels', 1, 2)
+    assert memberships(data, 'user_channels', 1) == [1, 2]
+    remove_membership(data, 'user_dms', 3, 1)
+    assert memberships(data, 'user_dms', 3) == []
+    assert '3' not in data['user_dms']
+
+
+def test_session_indexes(tmp_path):
+    '''
+    A data file from before sessions were indexed has them built when it is
+    loaded, and ending a session moves the last token into its place
+    '''
+    tokens = [jwt.encode({'auth_user_id': u_id, 'uuid': str(idx)}, 'key')
+              for idx, u_id in enumerate([1, 2, 1, 3])]
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    data['sessions'].extend(tokens)
+    store.set(data)
+    main = read_file(path)
+    for key in ('session_index', 'user_sessions', 'session_times'):
+        main['keys'].remove(key)
+    with open(path, 'w', encoding="utf8") as file:
+        json.dump(main, file)
+
+    data = Datastore(path=path, mode='sync').get()
+    assert data['session_index'] == {token: idx
+                                     for idx, token in enumerate(tokens)}
+    assert user_sessions(data, 1) == [tokens[0], tokens[2]]
+    assert remove_session(data, tokens[1])
+    assert not remove_session(data, tokens[1])
+    assert not has_session(data, tokens[1])
+    assert data['sessions'] == [tokens[0], tokens[3], tokens[2]]
+    assert data['session_index'][tokens[3]] == 1
+
+    assert remove_user_sessions(data, 1) == [tokens[0], tokens[2]]
+    assert data['sessions'] == [tokens[3]]
+    assert data['session_index'] == {tokens[3]: 0}
+    assert data['user_sessions'] == {'3': [tokens[3]]}
+    assert list(data['session_times']) == [tokens[3]]
+    add_session(data, tokens[0], 1)
+    assert has_session(data, tokens[0])
+    assert user_sessions(data, 1) == [tokens[0]]
+
+
+def test_messages_later_in_time_order(tmp_path):
+    '''
+    messages_later is kept in order of time_sent, so the messages due are
+    the ones at the front, and a data file with it out of order is sorted
+    when it is loaded
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    for message_id, time_sent in enumerate([30, 10, 20, 10], 1):
+        queue_message(data, {'channel': True, 'location_id': 1,
+                             'message_data': {'message_id': message_id,
+                                              'time_sent': time_sent}})
+    assert [later['message_data']['message_id']
+            for later in data['messages_later']] == [2, 4, 3, 1]
+    assert count_due(data, 5) == 0
+    assert count_due(data, 10) == 2
+    assert count_due(data, 25.5) == 3
+
+    data['messages_later'].reverse()
+    store.set(data)
+    data = Datastore(path=path, mode='sync').get()
+    assert [later['message_data']['time_sent']
+            for later in data['messages_later']] == [10, 10, 20, 30]
+
+
+def test_standup_registry(tmp_path):
+    '''
+    Only the standup running in a channel is kept in standups, and it is
+    moved to standup_archive when its message is sent. The list of every
+    standup an older version kept is split between the two when loaded
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    start_standup(data, 1, 2, 100, 7)
+    assert active_standup(data, 2, 99)[3] == 7
+    assert active_standup(data, 2, 100) is None
+    assert active_standup(data, 3, 99) is None
+    active_standup(data, 2, 99)[4].extend(['a: hi\n', 'b: yo\n'])
+    assert finish_standup(data, 2, 8) is None
+    assert finish_standup(data, 2, 7) == 'a: hi\nb: yo\n'
+    assert data['standups'] == {}
+    assert data['standup_archive'] == [[1, 2, 100, 7]]
+
+    data['standups'] = [[1, 2, 300, {'message_id': 9}], [1, 2, 100, 7]]
+    data['messages_later'] = [{'channel': True, 'location_id': 2,
+                               'message_data': {'message_id': 9,
+                                                'message': 'a: hi\n',
+                                                'time_sent': 300}}]
+    del data['standup_archive']
+    store.set(data)
+    data = Datastore(path=path, mode='sync').get()
+    assert data['standups'] == {'2': [1, 2, 300, 9, ['a: hi\n']]}
+    assert data['standup_archive'] == [[1, 2, 100, 7]]
+
+
+def test_standup_started_before_last_sent():
+    '''
+    A standup started once the last one in the channel has finished, but
+    before its message was sent, leaves the last one's message holding what
+    was sent to it
+    '''
+    data = {'standups': {}, 'standup_archive': [], 'messages_later': []}
+    for message_id, time_sent in [(6, 100), (7, 100), (9, 150)]:
+        queue_message(data, {'channel': True, 'location_id': 2,
+                             'message_data': {'message_id': message_id,
+                                              'message': 'placeholder_1',
+                                              'time_sent': time_sent}})
+    start_standup(data, 1, 2, 100, 7)
+    active_standup(data, 2, 99)[4].append('a: hi\n')
+    start_standup(data, 1, 2, 200, 8)
+    assert [later['message_data']['message']
+            for later in data['messages_later']] == \
+        ['placeholder_1', 'a: hi\n', 'placeholder_1']
+    assert data['standup_archive'] == [[1, 2, 100, 7]]
+    assert finish_standup(data, 2, 7) is None
+    assert active_standup(data, 2, 101)[3] == 8
+    assert finish_standup(data, 2, 8) == ''
+
+
+def test_message_tombstones(tmp_path):
+    '''
+    A removed message leaves a tombstone which pages skip over, whether
+    the channel is in memory or on disk, until more than half the channel
+    is tombstones and they are dropped. Where they are is read back from
+    the channel's log.
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync')
+    data = store.get()
+    data['messages'].append([])
+    for message_id in range(10):
+        data['messages'][1].append({'message_id': message_id})
+        index_message(data, message_id, 'messages', 1, message_id)
+    for message_id in [2, 5, 8]:
+        tombstone_message(data, message_id)
+        record_removal(data, message_id)
+    store.set(data)
+    assert data['message_tombstones']['messages'] == {'1': [2, 5, 8]}
+    assert find_message(data, 5) is None
+    assert find_message(data, 6) == ('messages', 1, {'message_id': 6})
+    expected = (7, [{'message_id': idx} for idx in [6, 4, 3]])
+    assert store.recent_messages('messages', 1, 2, 3) == expected
+    # the tombstones are only saved in the channel's log
+    assert not (tmp_path / 'store.segments' / 'message_tombstones.json').exists()
+    store = Datastore(path=path, mode='sync')
+    assert store.get()['message_tombstones']['messages'] == {'1': [2, 5, 8]}
+    assert store.recent_messages('messages', 1, 2, 3) == expected
+    assert store.recent_messages('messages', 1, 6, 50)[1] == \
+        [{'message_id': 0}]
+    assert store.recent_messages('messages', 1, 7, 50) == (7, [])
+
+    # removing 3 drops every tombstone, before the message sent after it
+    # is indexed
+    data = store.get()
+    for message_id in [0, 1]:
+        tombstone_message(data, message_id)
+        record_removal(data, message_id)
+    tombstone_message(data, 3)
+    data['messages'][1].append({'message_id': 10})
+    index_message(data, 10, 'messages', 1, len(data['messages'][1]) - 1)
+    record_removal(data, 3)
+    store.set(data)
+    assert [message['message_id'] for message in data['messages'][1]] == \
+        [4, 6, 7, 9, 10]
+    assert data['message_tombstones']['messages'] == {}
+    assert [data['message_index'][str(message_id)][2]
+            for message_id in [4, 6, 7, 9, 10]] == [0, 1, 2, 3, 4]
+    assert store.recent_messages('messages', 1, 0, 2) == \
+        (5, [{'message_id': 10}, {'message_id': 9}])
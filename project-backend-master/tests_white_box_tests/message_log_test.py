@@ -0,0 +1,117 @@
+'''
+This test file aims to validate the MessageLog class using pytest.
+
+These tests are White Box tests.
+
+Functions:
+    message(message_id)
+    test_put_and_read()
+    test_page()
+    test_rewrite_and_compact()
+    test_torn_record()
+    test_stale_index_rebuilt()
+    test_places()
+'''
+import os
+from src.message_log import MessageLog
+
+
+def message(message_id):
+    '''
+    Helper that builds a message dict
+    '''
+    return {'message_id': message_id, 'u_id': 1, 'message': f'hi {message_id}',
+            'time_sent': 0, 'is_pinned': False, 'reacts': []}
+
+
+def test_put_and_read(tmp_path):
+    '''
+    Appended and replaced messages come back in position order
+    '''
+    log = MessageLog(str(tmp_path / 'segment'))
+    assert log.read() == ([], 0)
+    log.put([(0, message(1)), (1, message(2))])
+    edited = dict(message(1), message='edited')
+    log.put([(0, edited), (2, message(3))])
+    assert MessageLog(str(tmp_path / 'segment')).read()[0] == [
+        edited, message(2), message(3)]
+
+
+def test_page(tmp_path):
+    '''
+    A page is read newest first
+    '''
+    log = MessageLog(str(tmp_path / 'segment'))
+    log.rewrite([message(idx) for idx in range(120)])
+    total, page = log.page(50, 50)
+    assert total == 120
+    assert [msg['message_id'] for msg in page] == list(range(69, 19, -1))
+    assert [msg['message_id'] for msg in log.page(100, 50)[1]] == \
+        list(range(19, -1, -1))
+    assert log.page(120, 50) == (120, [])
+
+
+def test_rewrite_and_compact(tmp_path):
+    '''
+    A log mostly made of replaced records is compacted
+    '''
+    log = MessageLog(str(tmp_path / 'segment'))
+    log.rewrite([message(1)])
+    for idx in range(1000):
+        log.put([(0, dict(message(1), message='x' * 100, edit=idx))])
+    assert os.stat(log.log_path).st_size < 64 * 1024
+    assert log.read()[0] == [dict(message(1), message='x' * 100, edit=999)]
+
+
+def test_torn_record(tmp_path):
+    '''
+    A record only partly written when the process died is cut off
+    '''
+    log = MessageLog(str(tmp_path / 'segment'))
+    log.put([(0, message(1))])
+    with open(log.log_path, 'ab') as file:
+        file.write(b'\x50\x00\x00\x00\x01\x00\x00\x00{"message_id": 2')
+    os.remove(log.index_path)
+    assert log.read()[0] == [message(1)]
+    log.put([(1, message(3))])
+    assert log.read()[0] == [message(1), message(3)]
+
+
+def test_stale_index_rebuilt(tmp_path):
+    '''
+    Records appended after the index was saved are found, and an index
+    belonging to another log is ignored
+    '''
+    log = MessageLog(str(tmp_path / 'segment'))
+    log.put([(0, message(1))])
+    with open(log.index_path, 'rb') as file:
+        index = file.read()
+    log.put([(1, message(2)), (0, message(3))])
+    with open(log.index_path, 'wb') as file:
+        file.write(index)
+    assert log.read()[0] == [message(3), message(2)]
+
+    other = MessageLog(str(tmp_path / 'other'))
+    other.rewrite([message(4)] * 5)
+    os.replace(other.index_path, log.index_path)
+    assert log.read()[0] == [message(3), message(2)]
+
+
+def test_places(tmp_path):
+    '''
+    Where each message and tombstone is comes from the index alone, however
+    the log was written
+    '''
+    log = MessageLog(str(tmp_path / 'segment'))
+    log.rewrite([message(idx) for idx in range(4)])
+    log.put([(1, {'message_id': 1, 'is_removed': True}), (4, message(7))])
+    assert list(log.places()) == [0, ~1, 2, 3, 7]
+    with open(log.index_path, 'rb') as file:
+        index = file.read()
+    log.put([(2, {'message_id': 2, 'is_removed': True})])
+    with open(log.index_path, 'wb') as file:
+        file.write(index)
+    assert list(log.places()) == [0, ~1, ~2, 3, 7]
+    log.compact()
+    assert list(MessageLog(str(tmp_path / 'segment')).places()) == \
+        [0, ~1, ~2, 3, 7]
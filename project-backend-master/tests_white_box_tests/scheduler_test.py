@@ -0,0 +1,158 @@
+'''
+This test file aims to validate the Scheduler class using pytest.
+
+These tests are White Box tests.
+
+Functions:
+    recorder(jobs)
+    held_up(scheduler, loaded)
+    waiting_load(loaded)
+    test_delivers_when_due()
+    test_loads_waiting_jobs()
+    test_run_due()
+    test_job_scheduled_while_delivering()
+    test_failed_delivery_kept()
+    test_failed_load_retried()
+'''
+import threading
+import time
+import pytest
+from src.scheduler import Scheduler
+
+
+def recorder(jobs):
+    '''
+    Helper that makes a Scheduler whose deliver() records when it was called
+    '''
+    calls = []
+    delivered = threading.Event()
+
+    def deliver(now):
+        calls.append(now)
+        delivered.set()
+    return Scheduler(deliver, lambda: jobs), calls, delivered
+
+
+def held_up(scheduler, loaded):
+    '''
+    Helper that starts a Scheduler whose load() waits for loaded to be set,
+    so only run_due() delivers until then, and returns its thread
+    '''
+    before = set(threading.enumerate())
+    scheduler.start()
+    thread, = set(threading.enumerate()) - before
+    return thread
+
+
+def waiting_load(loaded):
+    '''
+    Helper that makes a load() which finds no jobs once loaded is set
+    '''
+    def load():
+        loaded.wait()
+        return []
+    return load
+
+
+def test_delivers_when_due():
+    '''
+    A job is delivered once it is due, and not before
+    '''
+    scheduler, calls, delivered = recorder([])
+    due = time.time() + 0.3
+    scheduler.schedule(due + 10, 2)
+    scheduler.schedule(due, 1)
+    assert scheduler.pending() == 2
+    assert delivered.wait(5)
+    assert calls[0] >= due
+    assert scheduler.pending() == 1
+
+
+def test_loads_waiting_jobs():
+    '''
+    Jobs already waiting in the store are delivered once the thread starts
+    '''
+    scheduler, calls, delivered = recorder([(time.time() - 5, 1)])
+    scheduler.start()
+    assert delivered.wait(5)
+    assert len(calls) == 1
+
+
+def test_run_due():
+    '''
+    run_due() delivers straight away, but only if something is due
+    '''
+    scheduler, calls, _ = recorder([])
+    scheduler.schedule(time.time() + 60, 1)
+    scheduler.run_due(time.time())
+    assert calls == []
+    scheduler.run_due(time.time() + 61)
+    assert len(calls) == 1
+    assert scheduler.pending() == 0
+
+
+def test_job_scheduled_while_delivering():
+    '''
+    A job which is already due but is scheduled while deliver() runs is
+    left on the timetable, since deliver() may not have seen it
+    '''
+    calls = []
+    loaded = threading.Event()
+
+    def deliver(now):
+        if not calls:
+            scheduler.schedule(now - 1, 2)
+        calls.append(now)
+    scheduler = Scheduler(deliver, waiting_load(loaded))
+    thread = held_up(scheduler, loaded)
+    now = time.time()
+    scheduler.schedule(now + 60, 1)
+    scheduler.run_due(now + 61)
+    assert scheduler.pending() == 1
+    scheduler.run_due(now + 61)
+    assert len(calls) == 2
+    assert scheduler.pending() == 0
+    loaded.set()
+    thread.join(0.2)
+    assert thread.is_alive()
+
+
+def test_failed_delivery_kept():
+    '''
+    The jobs go back on the timetable when deliver() raises
+    '''
+    loaded = threading.Event()
+
+    def deliver(now):
+        raise ValueError()
+    scheduler = Scheduler(deliver, waiting_load(loaded))
+    thread = held_up(scheduler, loaded)
+    scheduler.schedule(time.time() + 60, 1)
+    with pytest.raises(ValueError):
+        scheduler.run_due(time.time() + 61)
+    assert scheduler.pending() == 1
+    loaded.set()
+    thread.join(0.2)
+    assert thread.is_alive()
+    assert scheduler.pending() == 1
+
+
+def test_failed_load_retried(monkeypatch):
+    '''
+    load() is tried again until it succeeds, and the jobs it finds are
+    then delivered
+    '''
+    monkeypatch.setattr('src.scheduler.RETRY_INTERVAL', 0.01)
+    attempts = []
+    delivered = threading.Event()
+
+    def load():
+        attempts.append(time.time())
+        if len(attempts) < 3:
+            raise OSError('store unavailable')
+        return [(time.time() - 5, 1)]
+    scheduler = Scheduler(lambda now: delivered.set(), load)
+    scheduler.start()
+    assert delivered.wait(5)
+    assert len(attempts) == 3
+    assert scheduler.pending() == 0
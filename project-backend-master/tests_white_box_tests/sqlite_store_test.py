@@ -0,0 +1,144 @@
+'''
+This test file aims to validate the SQLite backend of the Datastore class
+using pytest.
+
+These tests are White Box tests.
+
+Functions:
+    sample_store(store)
+    reload(path)
+    test_round_trip()
+    test_only_changed_items_written()
+    test_removing_a_message()
+    test_clear_replaces_everything()
+    test_migrate_json()
+'''
+import json
+import sqlite3
+from src.data_store import Datastore, index_message
+from src.sqlite_store import migrate
+
+
+def sample_store(store):
+    '''
+    Helper that fills a store with one of everything
+    '''
+    store['users'].append([1, 'a@b.com', 'pw', 'first', 'last', 'firstlast',
+                           'url', {'reset_code': 0}, []])
+    store['channels'].append([1, 'channel', True, [1], [1]])
+    store['messages'].append([])
+    for message_id in range(1, 4):
+        store['messages'][1].append({
+            'message_id': message_id, 'u_id': 1, 'message': 'hi',
+            'time_sent': 0, 'is_pinned': False,
+            'reacts': [{'react_id': 1, 'u_ids': [],
+                        'is_this_user_reacted': False}]})
+        index_message(store, message_id, 'messages', 1, message_id - 1)
+    store['dms'].append([1, {'owner_info': [1], 'status': 'present'},
+                         [[1, 'a@b.com', 'first', 'last', 'firstlast']],
+                         'firstlast', []])
+    store['dm_messages'].append([])
+    store['sessions'].append('token')
+    store['message_counter'] = 3
+    store['channel_track'].append({'auth_user_id': 1, 'channels_joined': [
+        {'num_channels_joined': 1, 'time_stamp': 0}]})
+    store['channels_exist'].append({'num_channels_exist': 1, 'time_stamp': 0})
+
+
+def reload(path):
+    '''
+    Helper that loads the store back out of the database at path
+    '''
+    store = Datastore(path=path, mode='sync', backend='sqlite')
+    data = json.loads(json.dumps(store.get()))
+    store.close()
+    return data
+
+
+def test_round_trip(tmp_path):
+    '''
+    Everything written to the database comes back out unchanged
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync', backend='sqlite')
+    data = store.get()
+    sample_store(data)
+    data['users'][0][8].append({'channel_id': 1, 'dm_id': -1,
+                                'notification_message': 'hello'})
+    data['messages'][1][0]['reacts'][0]['u_ids'].append(1)
+    store.set(data)
+    expected = json.loads(json.dumps(data))
+    store.close()
+    assert reload(path) == expected
+
+
+def test_only_changed_items_written(tmp_path):
+    '''
+    Changing one message only rewrites that message's rows
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync', backend='sqlite')
+    data = store.get()
+    sample_store(data)
+    store.set(data)
+
+    conn = sqlite3.connect(str(tmp_path / 'store.db'))
+    conn.execute("UPDATE messages SET data = json_set(data, '$.message', "
+                 "'untouched') WHERE message_id = 1")
+    conn.commit()
+    data['messages'][1][1]['message'] = 'edited'
+    store.set(data)
+    store.close()
+
+    messages = reload(path)['messages'][1]
+    assert messages[0]['message'] == 'untouched'
+    assert messages[1]['message'] == 'edited'
+    assert conn.execute('SELECT u_id FROM channel_members').fetchall() == [(1,)]
+
+
+def test_removing_a_message(tmp_path):
+    '''
+    Removing a message rewrites the positions of those after it
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync', backend='sqlite')
+    data = store.get()
+    sample_store(data)
+    store.set(data)
+    data['messages'][1].pop(0)
+    store.set(data)
+    store.close()
+    assert [message['message_id']
+            for message in reload(path)['messages'][1]] == [2, 3]
+
+
+def test_clear_replaces_everything(tmp_path):
+    '''
+    Setting a brand new store (as clear_v1 does) empties the database
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync', backend='sqlite')
+    data = store.get()
+    sample_store(data)
+    store.set(data)
+    store.set({'users': [], 'messages': [[]], 'dm_messages': [[]]})
+    store.close()
+    assert reload(path)['users'] == []
+    assert reload(path)['messages'] == [[]]
+
+
+def test_migrate_json(tmp_path):
+    '''
+    An existing json data file is carried over into a new database
+    '''
+    path = str(tmp_path / 'store.json')
+    store = Datastore(path=path, mode='sync', backend='json')
+    data = store.get()
+    sample_store(data)
+    store.set(data)
+    expected = json.loads(json.dumps(data))
+
+    assert migrate(path, str(tmp_path / 'migrated.db'))
+    assert reload(str(tmp_path / 'migrated.json')) == expected
+    # the first load with the sqlite backend migrates automatically
+    assert reload(path) == expected
@@ -0,0 +1,228 @@
+'''
+This test file aims to validate the store daemon and the 'service' backend
+of the Datastore class using pytest.
+
+These tests are White Box tests.
+
+Functions:
+    service(tmp_path, monkeypatch)
+    count_up(store, times)
+    test_workers_see_each_others_commits()
+    test_shared_transaction_reads_snapshot()
+    test_rollback_releases_lease()
+    test_far_behind_gets_whole_store()
+    test_worker_processes()
+    worker(service, monkeypatch)
+    test_messages_through_daemon()
+    test_dms_and_users_through_daemon()
+'''
+import multiprocessing
+import sys
+import threading
+import pytest
+from src import config
+from src.auth import auth_register_v2
+from src.channel import channel_join_v1, channel_messages_v1
+from src.channels import channels_create_v1
+from src.data_store import Datastore, data_store
+from src.dm import dm_create_v1, dm_messages_v1
+from src.message import message_edit_v1, message_remove_v1, \
+    message_send_v1, message_senddm_v1
+from src.other import clear_v1
+from src.segments import read_store
+from src.store_service import StoreService
+from src.user import remove_user_v1
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    '''
+    Runs a daemon keeping its store in tmp_path, returns the data file path
+    '''
+    monkeypatch.setattr(config, 'service_history', 2)
+    monkeypatch.setattr(config, 'store_socket', str(tmp_path / 's.sock'))
+    path = str(tmp_path / 'store.json')
+    datastore = Datastore(path=path, mode='sync', backend='json')
+    daemon = StoreService(config.store_socket, datastore)
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    yield path
+    daemon.shutdown()
+    thread.join()
+    daemon.close()
+    datastore.close()
+
+
+def count_up(store, times):
+    '''
+    Helper that increments message_counter one transaction at a time
+    '''
+    for _ in range(times):
+        with store.transaction():
+            data = store.get()
+            data['message_counter'] += 1
+            store.set(data)
+
+
+def test_workers_see_each_others_commits(service):
+    '''
+    A commit by one worker is persisted by the daemon and shows up in every
+    other worker's replica
+    '''
+    worker = Datastore(backend='service')
+    other = Datastore(backend='service')
+    data = worker.get()
+    data['users'].append([1, 'a@b.com'])
+    data['messages'].append([{'message_id': 1, 'message': 'hi'}])
+    worker.set(data)
+
+    assert other.get()['users'] == [[1, 'a@b.com']]
+    assert other.get()['messages'][1] == [{'message_id': 1, 'message': 'hi'}]
+    assert read_store(service)['users'] == [[1, 'a@b.com']]
+    worker.close()
+    other.close()
+
+
+def test_shared_transaction_reads_snapshot(service):
+    '''
+    A shared transaction keeps reading the version of the store it began
+    with while other workers commit, and cannot change it
+    '''
+    worker = Datastore(backend='service')
+    other = Datastore(backend='service')
+    with worker.transaction(shared=True):
+        data = worker.get()
+        count_up(other, 1)
+        assert worker.get()['message_counter'] == 0
+        with pytest.raises(TypeError):
+            data['message_counter'] += 5
+        with pytest.raises(TypeError):
+            worker.set(data)
+    with worker.transaction(shared=True):
+        assert worker.get()['message_counter'] == 1
+    assert read_store(service)['message_counter'] == 1
+    worker.close()
+    other.close()
+
+
+def test_rollback_releases_lease(service):
+    '''
+    A transaction which rolls back lets other workers commit
+    '''
+    worker = Datastore(backend='service')
+    other = Datastore(backend='service')
+    with pytest.raises(ValueError):
+        with worker.transaction():
+            worker.get()['sessions'].append('token')
+            raise ValueError()
+    count_up(other, 1)
+    assert worker.get()['sessions'] == []
+    assert worker.get()['message_counter'] == 1
+    worker.close()
+    other.close()
+
+
+def test_far_behind_gets_whole_store(service):
+    '''
+    A worker further behind than the daemon's history is sent the whole
+    store instead of the ops it missed
+    '''
+    worker = Datastore(backend='service')
+    other = Datastore(backend='service')
+    count_up(other, 5)
+    assert worker.get()['message_counter'] == 5
+    count_up(worker, 1)
+    assert other.get()['message_counter'] == 6
+    worker.close()
+    other.close()
+
+
+def test_worker_processes(service):
+    '''
+    Several worker processes, including ones forked from a process already
+    connected to the daemon, never lose each other's writes
+    '''
+    worker = Datastore(backend='service')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=count_up, args=(worker, 20))
+                 for _ in range(3)]
+    for process in processes:
+        process.start()
+    count_up(worker, 20)
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert worker.get()['message_counter'] == 80
+    assert read_store(service)['message_counter'] == 80
+    worker.close()
+
+
+@pytest.fixture
+def worker(service, monkeypatch):
+    '''
+    Has every module use a worker of the daemon in place of data_store,
+    returns the worker
+    '''
+    worker = Datastore(backend='service')
+    for module in list(sys.modules.values()):
+        if getattr(module, 'data_store', None) is data_store:
+            monkeypatch.setattr(module, 'data_store', worker)
+    yield worker
+    worker.close()
+
+
+def test_messages_through_daemon(service, worker):
+    '''
+    Joining channels and sending, editing and removing messages through a
+    worker are committed by the daemon and seen by other workers, however
+    many times the store was cleared before
+    '''
+    for _ in range(5):
+        clear_v1()
+        owner = auth_register_v2('a@b.com', 'password', 'Ann', 'Bee')
+        member = auth_register_v2('c@d.com', 'password', 'Cat', 'Dee')
+        channel_id = channels_create_v1(member['auth_user_id'], 'general',
+                                        True)['channel_id']
+        channels_create_v1(owner['auth_user_id'], 'other', True)
+        channel_join_v1(owner['auth_user_id'], channel_id)
+        first = message_send_v1(owner['token'], channel_id, 'hi', '')
+        second = message_send_v1(member['token'], channel_id, 'hello', '')
+        message_edit_v1(owner['token'], first['message_id'], 'hey')
+        message_remove_v1(member['token'], second['message_id'])
+
+    messages = channel_messages_v1(member['auth_user_id'], channel_id, 0)
+    assert [message['message'] for message in messages['messages']] == \
+        ['hey']
+    other = Datastore(backend='service')
+    assert [message['message']
+            for message in other.get()['messages'][channel_id]
+            if message['message_id'] == first['message_id']] == ['hey']
+    other.close()
+
+
+def test_dms_and_users_through_daemon(service, worker):
+    '''
+    Creating dms, sending to them and removing users through a worker are
+    committed by the daemon, kept in its data file and seen by other
+    workers
+    '''
+    clear_v1()
+    owner = auth_register_v2('a@b.com', 'password', 'Ann', 'Bee')
+    member = auth_register_v2('c@d.com', 'password', 'Cat', 'Dee')
+    leaver = auth_register_v2('e@f.com', 'password', 'Eve', 'Eff')
+    dm_id = dm_create_v1(owner['token'], [member['auth_user_id'],
+                                          leaver['auth_user_id']])['dm_id']
+    message_senddm_v1(member['token'], dm_id, 'psst', '')
+    message_senddm_v1(leaver['token'], dm_id, 'bye', '')
+    remove_user_v1(owner['auth_user_id'], leaver['auth_user_id'])
+
+    messages = dm_messages_v1(owner['auth_user_id'], dm_id, 0)
+    assert [message['message'] for message in messages['messages']] == \
+        ['Removed user', 'psst']
+    other = Datastore(backend='service')
+    assert len(other.get()['users']) == 3
+    assert other.get()['dm_messages'][dm_id] == \
+        worker.get()['dm_messages'][dm_id]
+    assert read_store(service)['removed_users'] == \
+        [leaver['auth_user_id']]
+    other.close()
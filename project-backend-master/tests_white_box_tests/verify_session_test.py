@@ -1,10 +1,14 @@
 '''
 docstring
 '''
+import time
+import jwt
 import pytest
-from src.auth import auth_login_v2, auth_register_v2, create_token
+from src import config
+from src.auth import auth_login_v2, auth_logout_v1, auth_register_v2, create_token
+from src.data_store import data_store
 from src.error import AccessError
-from src.verify_session import verify_session
+from src.verify_session import sweep_sessions, verify_session
 from src.other import clear_v1
 
 ''''
@@ -49,3 +53,48 @@ def test_valid_session():
     return_value = auth_login_v2('gerard.mathews@unsw.edu.au', 'password')
     assert verify_session(
         return_value['token']) == return_value['auth_user_id']
+
+
+def test_claims_cached_until_logout(monkeypatch):
+    '''
+    A token's signature is checked once, and logging out still ends the
+    session even though its claims were cached
+    '''
+    clear_v1()
+    return_value = auth_register_v2('gerard.mathews@unsw.edu.au',
+                                    'password', 'gerard', 'mathews')
+    decoded = []
+    decode = jwt.decode
+    monkeypatch.setattr(jwt, 'decode', lambda *args, **kwargs:
+                        decoded.append(args) or decode(*args, **kwargs))
+    for _ in range(3):
+        assert verify_session(
+            return_value['token']) == return_value['auth_user_id']
+    assert len(decoded) == 1
+
+    auth_logout_v1(return_value['token'])
+    with pytest.raises(AccessError):
+        verify_session(return_value['token'])
+
+
+def test_sessions_expire(monkeypatch):
+    '''
+    A session ends once it has been idle for session_idle_ttl seconds, and
+    the sweeper takes it out of the store; no session outlives session_ttl
+    '''
+    clear_v1()
+    return_value = auth_register_v2('gerard.mathews@unsw.edu.au',
+                                    'password', 'gerard', 'mathews')
+    token = return_value['token']
+    now = int(time.time())
+    verify_session(token)
+    assert sweep_sessions(now) == []
+    assert sweep_sessions(now + config.session_idle_ttl) == [token]
+    assert token not in data_store.get()['session_times']
+    with pytest.raises(AccessError):
+        verify_session(token)
+
+    token = auth_login_v2('gerard.mathews@unsw.edu.au', 'password')['token']
+    monkeypatch.setattr(config, 'session_ttl', 0)
+    with pytest.raises(AccessError):
+        verify_session(token)